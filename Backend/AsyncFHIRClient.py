@@ -0,0 +1,96 @@
+import asyncio
+import functools
+import itertools
+from FHIRClient import FHIRClient
+
+
+class AsyncFHIRClient:
+    """asyncio sibling of FHIRClient with the same method surface
+
+    Every FHIRClient method is available as a coroutine. Calls run the
+    blocking client on worker threads, so they share its connection pool,
+    and a semaphore bounds how many FHIR requests are in flight at once.
+    Multi-resource calls such as get_patient_summary fan out concurrently.
+    """
+
+    def __init__(self, client=None, max_concurrency=8, **client_kwargs):
+        """
+        Args:
+            client: Existing FHIRClient to wrap (a new one is built from client_kwargs otherwise)
+            max_concurrency: Maximum number of concurrent FHIR requests
+        """
+        self.client = client or FHIRClient(**client_kwargs)
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def base_url(self):
+        return self.client.base_url
+
+    async def _call(self, method, *args, **kwargs):
+        """Run a blocking client method on a worker thread under the concurrency limit"""
+        async with self._semaphore:
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self._call(attr, *args, **kwargs)
+
+        return call
+
+    async def get_patient_summary(self, patient_id, elements=None):
+        """Get complete patient summary, in one _revinclude search or by fetching all sections concurrently"""
+        elements = elements or {}
+        summary = await self._call(self.client.get_patient_summary_bundle, patient_id, elements=elements)
+        if summary is not None:
+            return summary
+
+        patient, conditions, medications, observations = await asyncio.gather(
+            self._call(self.client.get_patient, patient_id, elements=elements.get("Patient")),
+            self._call(self.client.get_patient_conditions, patient_id, elements=elements.get("Condition")),
+            self._call(self.client.get_patient_medications, patient_id, elements=elements.get("MedicationRequest")),
+            self._call(self.client.get_patient_observations, patient_id, elements=elements.get("Observation")),
+        )
+
+        summary = {
+            "patient": patient,
+            "conditions": conditions,
+            "medications": medications,
+            "observations": observations
+        }
+        self.client.note_summary_sections(patient_id, summary)
+        return summary
+
+    async def get_patient_summaries(self, patient_ids, elements=None, batch_size=20):
+        """Get summaries for many patients, running the batched searches concurrently (see FHIRClient)"""
+        patient_ids = list(dict.fromkeys(patient_ids))
+        results = await asyncio.gather(*(
+            self._call(self.client.search_summary_batch, resource_type, chunk, elements=elements)
+            for resource_type, chunk in self.client.summary_batches(patient_ids, batch_size)
+        ))
+        return await asyncio.to_thread(self.client.merge_summary_batches, patient_ids, results, elements=elements)
+
+    async def iter_search(self, resource_type, params=None, batch_size=100, **kwargs):
+        """Async iterator over FHIRClient.iter_search results
+        
+        Resources are pulled from the blocking iterator on a worker thread in
+        batches of batch_size, so the event loop never waits on the network.
+        """
+        iterator = self.client.iter_search(resource_type, params, **kwargs)
+        try:
+            while True:
+                batch = await self._call(lambda: list(itertools.islice(iterator, batch_size)))
+                for resource in batch:
+                    yield resource
+                if len(batch) < batch_size:
+                    return
+        finally:
+            iterator.close()
+
+    async def close(self):
+        await asyncio.to_thread(self.client.close)
@@ -1,13 +1,449 @@
 import requests
+import hashlib
 import json
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from fhir_cache import patient_id_for_resource, tags_for_url
 
 ## Testing 3209597
 
+FHIR_SERVERS = {
+    "smart": "https://launch.smarthealthit.org/v/r4/fhir",
+    "hapi": "http://hapi.fhir.org/baseR4",
+}
+
+DEFAULT_HEADERS = {
+    "Accept": "application/fhir+json",
+    "Connection": "keep-alive",
+}
+
+# Types read by the per-type search fallback when a server has no $everything
+EVERYTHING_TYPES = ("Patient", "Condition", "MedicationRequest", "Observation")
+
+# Statuses servers answer an unknown operation with
+EVERYTHING_UNSUPPORTED_STATUSES = (400, 404, 405, 501)
+
+# Search parameters behind the status and date filters of the patient resource searches
+PATIENT_SEARCH_PARAMS = {
+    "Condition": {"status": "clinical-status", "date": "onset-date"},
+    "MedicationRequest": {"status": "status", "date": "authoredon"},
+    "Observation": {"status": "status", "date": "date"},
+}
+
+# Summary sections, their resource type and the _revinclude that pulls them in with the Patient
+SUMMARY_SECTIONS = {
+    "conditions": ("Condition", "Condition:patient"),
+    "medications": ("MedicationRequest", "MedicationRequest:patient"),
+    "observations": ("Observation", "Observation:patient"),
+}
+
+def _has_category(resource, categories):
+    """True if any of the resource's categories matches a "code" or "system|code" token"""
+    for concept in resource.get("category") or []:
+        for coding in concept.get("coding", []):
+            for token in categories:
+                system, _, value = token.rpartition("|")
+                if coding.get("code") == value and (not system or coding.get("system") == system):
+                    return True
+    return False
+
+def _location_id(location, resource_type):
+    """Resource id from a relative (Patient/123/_history/1) or absolute transaction response location"""
+    segments = [s for s in location.split("?")[0].split("/_history")[0].split("/") if s]
+    for index in range(len(segments) - 2, -1, -1):
+        if segments[index] == resource_type:
+            return segments[index + 1]
+    return None
+
 class FHIRClient:
-    """FHIR client that connects to local Docker HAPI server"""
+    """FHIR client that connects to local Docker HAPI server
+    
+    All calls share one pooled keep-alive requests.Session, so repeated
+    requests to the same FHIR host reuse open TCP/TLS connections.
+    """
     
-    def __init__(self, base_url=None):
-        self.base_url = base_url or "https://launch.smarthealthit.org/v/r4/fhir"
+    def __init__(self, base_url=None, pool_connections=4, pool_maxsize=10,
+                 timeout=(5, 30), headers=None, max_retries=2, cache=None, max_snapshots=64, store=None):
+        """
+        Args:
+            base_url: FHIR server base URL (defaults to the SMART sandbox)
+            pool_connections: Number of per-host connection pools to keep
+            pool_maxsize: Maximum open connections kept alive per host
+            timeout: Seconds, or a (connect, read) tuple, applied to every request
+            headers: Extra default headers sent with every request
+            max_retries: Retries for idempotent GETs on connection errors and 502/503/504
+            cache: Optional fhir_cache.ResourceCache for GET responses; writes made
+                through this client invalidate the affected patient's entries
+            max_snapshots: Number of patients whose $everything snapshot is kept
+                for incremental refreshes
+            store: Optional fhir_store.ResourceStore; patient reads are answered
+                from it while younger than its max_age, and writes made through
+                this client update it after the server accepts them
+        """
+        self.base_url = (base_url or FHIR_SERVERS["smart"]).rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        if headers:
+            self.session.headers.update(headers)
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry,
+        )
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+        self.cache = cache
+        self.store = store
+        self.max_snapshots = max_snapshots
+        self._snapshots = OrderedDict()
+        self._snapshot_lock = threading.Lock()
+        # None until the server has been asked for Patient/$everything once
+        self._everything_supported = None
+        # None until a _revinclude summary search showed whether the server honors it
+        self._revinclude_supported = None
+        # Patients whose _revinclude reply could not tell an ignored parameter from an empty record
+        self._revinclude_unproven = set()
+        # Guards the capability flags above, which concurrent reads learn
+        self._capability_lock = threading.Lock()
+
+    def _request(self, method, path, **kwargs):
+        """Send a request through the shared session
+        
+        path is either relative to base_url ("Patient/123") or an absolute URL
+        such as a Bundle next link.
+        """
+        url = path if path.startswith(("http://", "https://")) else f"{self.base_url}/{path}"
+        kwargs.setdefault("timeout", self.timeout)
+        if method == "GET":
+            if self.cache is None:
+                return self.session.request(method, url, **kwargs)
+            return self._cached_get(url, **kwargs)
+
+        response = self.session.request(method, url, **kwargs)
+        if response.ok:
+            if method == "DELETE":
+                self._forget_in_snapshots(url)
+            if self.cache is not None:
+                self._invalidate_for_write(url, kwargs.get("json"), response)
+            if self.store is not None:
+                self._update_store_for_write(method, url, kwargs.get("json"), response)
+        return response
+
+    def _cached_get(self, url, params=None, headers=None, **kwargs):
+        """GET through the resource cache, revalidating stale entries with the server's validators"""
+        url = requests.Request("GET", url, params=params).prepare().url
+        entry, fresh = self.cache.lookup(url)
+        if entry is not None and fresh:
+            return entry.to_response()
+
+        headers = dict(headers or {})
+        if entry is not None:
+            headers.update(entry.validators())
+        response = self.session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.mark_revalidated(entry)
+            return entry.to_response()
+        if response.status_code == 200:
+            self.cache.store(url, response, self.base_url)
+        return response
+
+    def _invalidate_for_write(self, url, body, response):
+        """Drop cached reads made stale by a create, update or delete"""
+        resource_type, patient_id = tags_for_url(url, self.base_url)
+        patient_id = patient_id or patient_id_for_resource(body)
+        if patient_id is None and response.content:
+            try:
+                patient_id = patient_id_for_resource(response.json())
+            except ValueError:
+                pass
+        if patient_id is None:
+            # A delete carries no body; the cached copy may still know the patient
+            cached = self.cache.get_entry(url)
+            patient_id = cached.patient_id if cached is not None else None
+        self.cache.invalidate(patient_id=patient_id, resource_type=resource_type, url=url)
+
+    def _update_store_for_write(self, method, url, body, response):
+        """Mirror a create, update or delete the server accepted into the local store"""
+        resource_type, _ = tags_for_url(url, self.base_url)
+        if resource_type is None:
+            return
+        if method == "DELETE":
+            self.store.delete(resource_type, url.rstrip("/").rsplit("/", 1)[-1])
+            return
+        try:
+            resource = response.json() if response.content else None
+        except ValueError:
+            resource = None
+        if isinstance(resource, dict) and resource.get("resourceType") == resource_type:
+            self.store.upsert([resource])
+        else:
+            # Prefer: return=minimal; the stored set no longer matches the server
+            patient_id = patient_id_for_resource(body)
+            if patient_id:
+                self.store.invalidate_patient(patient_id, resource_type)
+
+    def _patient_search(self, resource_type, patient_id, max_resources=None, elements=None, status=None, code=None,
+                        category=None, date_from=None, date_to=None, sort=None, count=None, summary_count=False):
+        """Search one type of a patient's resources, from the local store while it is fresh
+        
+        With a store and no filters the full, uncapped set is fetched so later
+        reads (of any projection) can be answered locally; max_resources is
+        applied after. Filtered searches are sent to the server as search
+        parameters unless the fresh store can answer them.
+        
+        Args:
+            status: Status (clinical status for Conditions); comma-separated values are ORed
+            code: "code" or "system|code"; comma-separated values are ORed
+            category: Category token, e.g. "laboratory" or "vital-signs"
+            date_from / date_to: Inclusive bounds on the onset, authored or effective date
+            sort: _sort, e.g. "-date" for newest first
+            count: Return at most this many resources, from a single page (0 returns none)
+            summary_count: Only count the matches (_summary=count); the Bundle has a total and no entries
+        """
+        filters = {
+            name: value for name, value in (
+                ("status", status), ("code", code), ("category", category), ("date_from", date_from),
+                ("date_to", date_to), ("sort", sort), ("count", count),
+            ) if value is not None
+        }
+        if summary_count:
+            filters["summary_count"] = True
+        if count is not None:
+            max_resources = count if max_resources is None else min(max_resources, count)
+
+        if self.store is not None and self._store_can_answer(resource_type, filters) \
+                and self.store.is_fresh(resource_type, patient_id):
+            return self._store_search(resource_type, patient_id, max_resources, filters)
+
+        if self.store is not None and not filters:
+            bundle = self.search_all(resource_type, {"patient": patient_id})
+            if "error" not in bundle:
+                self.store.replace_patient_resources(
+                    resource_type, patient_id, [entry["resource"] for entry in bundle["entry"] if "resource" in entry]
+                )
+                if max_resources is not None:
+                    bundle["entry"] = bundle["entry"][:max_resources]
+            return bundle
+
+        params = self._search_params(resource_type, patient_id, filters)
+        if self.store is None:
+            params = self._with_elements(params, elements)
+        bundle = self.search_all(resource_type, params, max_resources=0 if summary_count else max_resources,
+                                 prefetch=count is None)
+        if self.store is not None and "error" not in bundle and not summary_count:
+            # Current server copies, but not the complete set, so the set is not marked fresh
+            self.store.upsert([entry["resource"] for entry in bundle["entry"] if "resource" in entry])
+        return bundle
+
+    @staticmethod
+    def _search_params(resource_type, patient_id, filters):
+        """Search parameters for a filtered patient search (a list, since date bounds repeat a name)"""
+        names = PATIENT_SEARCH_PARAMS[resource_type]
+        params = [("patient", patient_id)]
+        if "status" in filters:
+            params.append((names["status"], filters["status"]))
+        if "code" in filters:
+            params.append(("code", filters["code"]))
+        if "category" in filters:
+            params.append(("category", filters["category"]))
+        if "date_from" in filters:
+            params.append((names["date"], f"ge{filters['date_from']}"))
+        if "date_to" in filters:
+            params.append((names["date"], f"le{filters['date_to']}"))
+        if "sort" in filters:
+            params.append(("_sort", filters["sort"]))
+        if "count" in filters:
+            params.append(("_count", filters["count"]))
+        if "summary_count" in filters:
+            params.append(("_summary", "count"))
+        return params
+
+    @staticmethod
+    def _store_can_answer(resource_type, filters):
+        """True unless the search sorts on something other than the date the store orders by"""
+        sort = filters.get("sort")
+        return not sort or sort.lstrip("-") in ("date", PATIENT_SEARCH_PARAMS[resource_type]["date"])
+
+    def _store_search(self, resource_type, patient_id, max_resources, filters):
+        """Answer a (filtered) patient search from the local store"""
+        resources = self.store.search(
+            resource_type, patient_id,
+            code=filters["code"].split(",") if "code" in filters else None,
+            status=filters["status"].split(",") if "status" in filters else None,
+            date_from=filters.get("date_from"), date_to=filters.get("date_to"),
+        )
+        if "category" in filters:
+            categories = filters["category"].split(",")
+            resources = [r for r in resources if _has_category(r, categories)]
+        if "sort" in filters and not filters["sort"].startswith("-"):
+            resources.reverse()
+        if filters.get("summary_count"):
+            max_resources = 0
+        return {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(resources),
+            "entry": [{"resource": resource} for resource in resources[:max_resources]],
+        }
+
+    def pool_stats(self):
+        """Return per-host connection pool statistics
+        
+        connections is the number of connections opened, requests the number
+        of requests sent over them; reuse_rate is the share of requests that
+        did not need a new connection.
+        """
+        pools = self._adapter.poolmanager.pools
+        stats = []
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent = pool.num_requests
+            connections = pool.num_connections
+            stats.append({
+                "host": f"{key.key_scheme}://{key.key_host}:{key.key_port}",
+                "connections": connections,
+                "requests": requests_sent,
+                "idle": pool.pool.qsize() if pool.pool is not None else 0,
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+                "reuse_rate": round(1 - connections / requests_sent, 3) if requests_sent else 0.0,
+            })
+        return stats
+
+    def capabilities(self):
+        """What this client has learned the server supports: True, False or None (not known yet)"""
+        with self._capability_lock:
+            return {"everything": self._everything_supported, "revinclude": self._revinclude_supported}
+
+    def close(self):
+        """Close all pooled connections"""
+        self.session.close()
+
+    # SEARCH PAGINATION
+    def _fetch_page(self, path, params=None):
+        """Fetch one search Bundle page, returning (bundle, size in bytes)"""
+        response = self._request("GET", path, params=params)
+        response.raise_for_status()
+        return response.json(), len(response.content)
+
+    def iter_pages(self, resource_type, params=None, max_bytes=None, prefetch=False):
+        """Lazily yield search Bundle pages, following Bundle.link[relation=next]
+        
+        Args:
+            resource_type: FHIR resource type to search, e.g. "Observation"
+            params: Search parameters for the first page
+            max_bytes: Stop requesting pages once this many bytes were downloaded
+            prefetch: Request the next page in the background while the caller
+                consumes the current one
+        
+        Raises requests.HTTPError if a page cannot be fetched.
+        """
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        pending = None
+        downloaded = 0
+        try:
+            bundle, size = self._fetch_page(resource_type, params)
+            while True:
+                downloaded += size
+                next_url = self._next_link(bundle)
+                if max_bytes is not None and downloaded >= max_bytes:
+                    next_url = None
+                if next_url and executor:
+                    pending = executor.submit(self._fetch_page, next_url)
+
+                yield bundle
+
+                if not next_url:
+                    return
+                if pending:
+                    bundle, size = pending.result()
+                    pending = None
+                else:
+                    bundle, size = self._fetch_page(next_url)
+        finally:
+            if pending:
+                pending.cancel()
+            if executor:
+                executor.shutdown(wait=False)
+
+    def iter_search(self, resource_type, params=None, max_resources=None, max_bytes=None, prefetch=False):
+        """Lazily yield resources from every page of a search
+        
+        Stops after max_resources resources or once max_bytes bytes of Bundles
+        were downloaded, whichever comes first. See iter_pages for the other
+        arguments.
+        """
+        pages = self.iter_pages(resource_type, params, max_bytes=max_bytes, prefetch=prefetch)
+        yielded = 0
+        try:
+            for bundle in pages:
+                for entry in bundle.get("entry", []):
+                    if max_resources is not None and yielded >= max_resources:
+                        return
+                    if "resource" in entry:
+                        yielded += 1
+                        yield entry["resource"]
+        finally:
+            pages.close()
+
+    def search_all(self, resource_type, params=None, max_resources=None, max_bytes=None, prefetch=True):
+        """Collect every page of a search into a single searchset Bundle"""
+        try:
+            pages = self.iter_pages(resource_type, params, max_bytes=max_bytes, prefetch=prefetch)
+            total = None
+            entries = []
+            try:
+                for bundle in pages:
+                    if total is None:
+                        total = bundle.get("total")
+                    for entry in bundle.get("entry", []):
+                        if max_resources is not None and len(entries) >= max_resources:
+                            break
+                        entries.append(entry)
+                    if max_resources is not None and len(entries) >= max_resources:
+                        break
+            finally:
+                pages.close()
+
+            return {
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "total": total if total is not None else len(entries),
+                "entry": entries
+            }
+        except Exception as e:
+            return {"error": str(e)}
+
+    @staticmethod
+    def _with_elements(params, elements):
+        """Add a server-side _elements filter to search parameters (a dict or a list of pairs)"""
+        if elements:
+            if isinstance(params, list):
+                return params + [("_elements", ",".join(elements))]
+            params = dict(params, _elements=",".join(elements))
+        return params
+
+    @staticmethod
+    def _next_link(bundle):
+        for link in bundle.get("link", []):
+            if link.get("relation") == "next":
+                return link.get("url")
+        return None
 
     # PATIENT CRUD
     def create_patient(self, given_name, family_name, gender=None, birth_date=None):
@@ -24,34 +460,38 @@ def create_patient(self, given_name, family_name, gender=None, birth_date=None):
             patient_data["birthDate"] = birth_date
             
         try:
-            response = requests.post(f"{self.base_url}/Patient", json=patient_data)
+            response = self._request("POST", "Patient", json=patient_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
             return {"error": str(e)}
 
-    def list_patients(self, count=10):
-        """List patients from FHIR server"""
-        try:
-            response = requests.get(f"{self.base_url}/Patient?_count={count}")
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            return {"error": str(e)}
+    def list_patients(self, count=10, elements=None):
+        """List up to count patients from FHIR server, following result pages if needed"""
+        return self.search_all("Patient", self._with_elements({"_count": count}, elements), max_resources=count)
 
-    def get_patient(self, patient_id):
+    def get_patient(self, patient_id, elements=None):
         """Get specific patient by ID"""
+        if self.store is not None:
+            stored = self.store.get("Patient", patient_id)
+            if stored is not None:
+                return stored
+            # Keep the whole resource locally; projection happens later anyway
+            elements = None
         try:
-            response = requests.get(f"{self.base_url}/Patient/{patient_id}")
+            response = self._request("GET", f"Patient/{patient_id}", params=self._with_elements({}, elements))
             response.raise_for_status()
-            return response.json()
+            patient = response.json()
         except Exception as e:
             return {"error": str(e)}
+        if self.store is not None:
+            self.store.upsert([patient])
+        return patient
 
     def update_patient(self, patient_id, patient_data):
         """Update existing patient"""
         try:
-            response = requests.put(f"{self.base_url}/Patient/{patient_id}", json=patient_data)
+            response = self._request("PUT", f"Patient/{patient_id}", json=patient_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -60,7 +500,7 @@ def update_patient(self, patient_id, patient_data):
     def delete_patient(self, patient_id):
         """Delete patient"""
         try:
-            response = requests.delete(f"{self.base_url}/Patient/{patient_id}")
+            response = self._request("DELETE", f"Patient/{patient_id}")
             response.raise_for_status()
             return {"success": True}
         except Exception as e:
@@ -121,20 +561,22 @@ def create_condition(self, condition_data):
         Minimum required: resourceType, subject
         """
         try:
-            response = requests.post(f"{self.base_url}/Condition", json=condition_data)
+            response = self._request("POST", "Condition", json=condition_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
             return {"error": str(e)}
 
-    def get_patient_conditions(self, patient_id):
-        """Get conditions for a specific patient"""
-        try:
-            response = requests.get(f"{self.base_url}/Condition?patient={patient_id}")
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            return {"error": str(e)}
+    def get_patient_conditions(self, patient_id, max_resources=None, elements=None, **filters):
+        """Get conditions for a specific patient, following every result page
+        
+        Args:
+            max_resources: Optional cap on the number of resources returned
+            elements: Optional list of element names to request with _elements
+            filters: status, code, category, date_from, date_to, sort, count
+                and summary_count search filters (see _patient_search)
+        """
+        return self._patient_search("Condition", patient_id, max_resources, elements, **filters)
 
     def update_condition(self, condition_id, condition_data):
         """Update existing condition with complete FHIR R4 JSON structure
@@ -144,7 +586,7 @@ def update_condition(self, condition_id, condition_data):
         Minimum required: resourceType, subject
         """
         try:
-            response = requests.put(f"{self.base_url}/Condition/{condition_id}", json=condition_data)
+            response = self._request("PUT", f"Condition/{condition_id}", json=condition_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -153,7 +595,7 @@ def update_condition(self, condition_id, condition_data):
     def delete_condition(self, condition_id):
         """Delete condition"""
         try:
-            response = requests.delete(f"{self.base_url}/Condition/{condition_id}")
+            response = self._request("DELETE", f"Condition/{condition_id}")
             response.raise_for_status()
             return {"success": True}
         except Exception as e:
@@ -237,20 +679,22 @@ def create_medication(self, medication_data):
         Minimum required: resourceType, status, intent, medicationCodeableConcept OR medicationReference, subject
         """
         try:
-            response = requests.post(f"{self.base_url}/MedicationRequest", json=medication_data)
+            response = self._request("POST", "MedicationRequest", json=medication_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
             return {"error": str(e)}
 
-    def get_patient_medications(self, patient_id):
-        """Get medications for a specific patient"""
-        try:
-            response = requests.get(f"{self.base_url}/MedicationRequest?patient={patient_id}")
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            return {"error": str(e)}
+    def get_patient_medications(self, patient_id, max_resources=None, elements=None, **filters):
+        """Get medications for a specific patient, following every result page
+        
+        Args:
+            max_resources: Optional cap on the number of resources returned
+            elements: Optional list of element names to request with _elements
+            filters: status, code, category, date_from, date_to, sort, count
+                and summary_count search filters (see _patient_search)
+        """
+        return self._patient_search("MedicationRequest", patient_id, max_resources, elements, **filters)
 
     def update_medication(self, medication_id, medication_data):
         """Update existing medication request with complete FHIR R4 JSON structure
@@ -260,7 +704,7 @@ def update_medication(self, medication_id, medication_data):
         Minimum required: resourceType, status, intent, medicationCodeableConcept OR medicationReference, subject
         """
         try:
-            response = requests.put(f"{self.base_url}/MedicationRequest/{medication_id}", json=medication_data)
+            response = self._request("PUT", f"MedicationRequest/{medication_id}", json=medication_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -269,7 +713,7 @@ def update_medication(self, medication_id, medication_data):
     def delete_medication(self, medication_id):
         """Delete medication"""
         try:
-            response = requests.delete(f"{self.base_url}/MedicationRequest/{medication_id}")
+            response = self._request("DELETE", f"MedicationRequest/{medication_id}")
             response.raise_for_status()
             return {"success": True}
         except Exception as e:
@@ -344,20 +788,22 @@ def create_observation(self, observation_data):
         Minimum required: resourceType, status, code, subject
         """
         try:
-            response = requests.post(f"{self.base_url}/Observation", json=observation_data)
+            response = self._request("POST", "Observation", json=observation_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
             return {"error": str(e)}
 
-    def get_patient_observations(self, patient_id):
-        """Get observations for a specific patient"""
-        try:
-            response = requests.get(f"{self.base_url}/Observation?patient={patient_id}")
-            response.raise_for_status()
-            return response.json()
-        except Exception as e:
-            return {"error": str(e)}
+    def get_patient_observations(self, patient_id, max_resources=None, elements=None, **filters):
+        """Get observations for a specific patient, following every result page
+        
+        Args:
+            max_resources: Optional cap on the number of resources returned
+            elements: Optional list of element names to request with _elements
+            filters: status, code, category, date_from, date_to, sort, count
+                and summary_count search filters (see _patient_search)
+        """
+        return self._patient_search("Observation", patient_id, max_resources, elements, **filters)
 
     def update_observation(self, observation_id, observation_data):
         """Update existing observation with complete FHIR R4 JSON structure
@@ -374,7 +820,7 @@ def update_observation(self, observation_id, observation_data):
         Must include resourceType, status, code, subject at minimum.
         """
         try:
-            response = requests.put(f"{self.base_url}/Observation/{observation_id}", json=observation_data)
+            response = self._request("PUT", f"Observation/{observation_id}", json=observation_data)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -383,22 +829,548 @@ def update_observation(self, observation_id, observation_data):
     def delete_observation(self, observation_id):
         """Delete observation"""
         try:
-            response = requests.delete(f"{self.base_url}/Observation/{observation_id}")
+            response = self._request("DELETE", f"Observation/{observation_id}")
             response.raise_for_status()
             return {"success": True}
         except Exception as e:
             return {"error": str(e)}
 
-    def get_patient_summary(self, patient_id):
-        """Get complete patient summary"""
-        patient = self.get_patient(patient_id)
-        conditions = self.get_patient_conditions(patient_id)
-        medications = self.get_patient_medications(patient_id)
-        observations = self.get_patient_observations(patient_id)
+    def get_patient_summary(self, patient_id, elements=None):
+        """Get complete patient summary
         
-        return {
+        Uses a single _revinclude search (get_patient_summary_bundle) when the
+        server honors it, and one request per section otherwise.
+        
+        Args:
+            elements: Optional {resourceType: [element names]} to request with _elements
+        """
+        elements = elements or {}
+        summary = self.get_patient_summary_bundle(patient_id, elements=elements)
+        if summary is not None:
+            return summary
+
+        patient = self.get_patient(patient_id, elements=elements.get("Patient"))
+        conditions = self.get_patient_conditions(patient_id, elements=elements.get("Condition"))
+        medications = self.get_patient_medications(patient_id, elements=elements.get("MedicationRequest"))
+        observations = self.get_patient_observations(patient_id, elements=elements.get("Observation"))
+        summary = {
             "patient": patient,
             "conditions": conditions,
             "medications": medications,
             "observations": observations
-        }
\ No newline at end of file
+        }
+        self.note_summary_sections(patient_id, summary)
+        return summary
+
+    def get_patient_summary_bundle(self, patient_id, elements=None):
+        """Fetch the patient and all summary sections with one search, split back into sections
+        
+        Sends Patient?_id=X&_revinclude=Condition:patient&_revinclude=MedicationRequest:patient
+        &_revinclude=Observation:patient, follows its pages and sorts the mixed
+        Bundle into the same shape get_patient_summary returns.
+        
+        Returns None when the caller should fall back to per-section reads: the
+        server is known not to honor _revinclude (an error status, or a reply
+        whose self link dropped the parameter), it is not known yet and this
+        reply holds no included resources to prove it, the patient was not
+        found, or the local store can already answer every section.
+        """
+        if self._revinclude_supported is False:
+            return None
+        if self.store is not None and self._summary_in_store(patient_id):
+            return None
+
+        params = [("_id", patient_id)] + [("_revinclude", include) for _, include in SUMMARY_SECTIONS.values()]
+        elements = elements or {}
+        if elements and self.store is None:
+            # One _elements applies to every type in the Bundle, so ask for the union
+            names = sorted({name for type_elements in elements.values() for name in type_elements})
+            params.append(("_elements", ",".join(names)))
+
+        resources, included, self_link = [], False, None
+        try:
+            for bundle in self.iter_pages("Patient", params, prefetch=True):
+                if self_link is None:
+                    self_link = next((l.get("url") for l in bundle.get("link", []) if l.get("relation") == "self"), "")
+                for entry in bundle.get("entry", []):
+                    if "resource" not in entry:
+                        continue
+                    resources.append(entry["resource"])
+                    included = included or (entry.get("search") or {}).get("mode") == "include" \
+                        or entry["resource"].get("resourceType") != "Patient"
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status in EVERYTHING_UNSUPPORTED_STATUSES:
+                self._learn_capability("_revinclude_supported", False)
+            return None
+        except Exception:
+            return None
+
+        if included:
+            self._learn_capability("_revinclude_supported", True)
+        else:
+            with self._capability_lock:
+                # Without included resources the reply only counts once support is proven
+                if self._revinclude_supported is not True:
+                    if self._revinclude_supported is None and self_link and "_revinclude" not in self_link:
+                        self._revinclude_supported = False
+                    elif self._revinclude_supported is None:
+                        self._revinclude_unproven.add(patient_id)
+                    return None
+
+        patient = next((r for r in resources if r.get("resourceType") == "Patient" and r.get("id") == patient_id), None)
+        if patient is None:
+            return None
+        summary = {"patient": patient}
+        for section, (resource_type, _) in SUMMARY_SECTIONS.items():
+            section_resources = [
+                r for r in resources
+                if r.get("resourceType") == resource_type and patient_id_for_resource(r) == patient_id
+            ]
+            summary[section] = {
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "total": len(section_resources),
+                "entry": [{"resource": resource} for resource in section_resources],
+            }
+            if self.store is not None:
+                self.store.replace_patient_resources(resource_type, patient_id, section_resources)
+        if self.store is not None:
+            self.store.upsert([patient])
+        return summary
+
+    def note_summary_sections(self, patient_id, summary):
+        """Learn from a per-section summary whether an inconclusive _revinclude reply was ignored
+        
+        A _revinclude search that came back with only the Patient is what a
+        server ignoring the parameter returns, but also what an honoring
+        server returns for a patient with no records. Records found by the
+        per-section reads that followed it settle it.
+        """
+        found = any(summary[section].get("entry") for section in SUMMARY_SECTIONS if "error" not in summary[section])
+        with self._capability_lock:
+            if patient_id not in self._revinclude_unproven:
+                return
+            self._revinclude_unproven.discard(patient_id)
+            if found and self._revinclude_supported is None:
+                self._revinclude_supported = False
+
+    def _learn_capability(self, flag, supported):
+        """Set a capability flag unless an earlier reply already settled it"""
+        with self._capability_lock:
+            if getattr(self, flag) is None:
+                setattr(self, flag, supported)
+
+    def patient_data_version(self, patient_id):
+        """Cheap version of a patient's summary data, for keying cached answers
+        
+        One small search per summary type, run in parallel, each asking for
+        only the newest resource's meta and the match total
+        (Type?patient=X&_sort=-_lastUpdated&_count=1&_elements=id,meta&_total=accurate).
+        A create or an edit of any field moves the newest lastUpdated and a
+        delete lowers the total, so the version changes with any change to
+        the record. The searches bypass the resource cache, whose fresh pages
+        could hide a change.
+        
+        Returns None when a search fails or the server leaves out the total
+        or meta the version depends on.
+        """
+        def probe(resource_type):
+            params = {
+                "_id" if resource_type == "Patient" else "patient": patient_id,
+                "_sort": "-_lastUpdated", "_count": 1, "_elements": "id,meta", "_total": "accurate",
+            }
+            response = self.session.get(f"{self.base_url}/{resource_type}", params=params, timeout=self.timeout)
+            response.raise_for_status()
+            bundle = response.json()
+            newest = next((entry["resource"] for entry in bundle.get("entry", []) if "resource" in entry), None)
+            meta = (newest or {}).get("meta") or {}
+            if bundle.get("total") is None or (newest is not None and not meta.get("lastUpdated")):
+                raise ValueError(f"{resource_type} search has no total or meta.lastUpdated")
+            return [resource_type, bundle["total"], newest and newest.get("id"), meta.get("versionId"),
+                    meta.get("lastUpdated")]
+
+        types = ["Patient"] + [resource_type for resource_type, _ in SUMMARY_SECTIONS.values()]
+        try:
+            with ThreadPoolExecutor(max_workers=len(types)) as executor:
+                probes = list(executor.map(probe, types))
+        except (requests.RequestException, ValueError):
+            return None
+        return hashlib.sha256(json.dumps(probes).encode()).hexdigest()[:16]
+
+    # MULTI-PATIENT SUMMARIES
+    def get_patient_summaries(self, patient_ids, elements=None, batch_size=20, max_workers=4):
+        """Get summaries for many patients with a few multi-id searches
+        
+        Ids are batched into Patient?_id=a,b,c and patient=a,b,c searches,
+        one per section and batch, run concurrently. A failed search only
+        fails that section for the patients in its batch.
+        
+        Args:
+            patient_ids: FHIR patient ids (duplicates are ignored)
+            elements: Optional {resourceType: [element names]} to request with _elements
+            batch_size: Patients per search
+            max_workers: Searches in flight at once
+        
+        Returns {"requested", "succeeded", "failed": [patient ids], "errors":
+        [{"resource_type", "patient_ids", "error"}], "summaries": {patient id:
+        summary shaped like get_patient_summary}}.
+        """
+        patient_ids = list(dict.fromkeys(patient_ids))
+        batches = self.summary_batches(patient_ids, batch_size)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda batch: self.search_summary_batch(*batch, elements=elements), batches))
+        return self.merge_summary_batches(patient_ids, results, elements=elements)
+
+    def summary_batches(self, patient_ids, batch_size=20):
+        """(resource type, patient ids) for every search get_patient_summaries needs
+        
+        Patients the local store can summarize on its own are left out.
+        """
+        if self.store is not None:
+            patient_ids = [pid for pid in patient_ids if not self._summary_in_store(pid)]
+        chunks = [patient_ids[i:i + batch_size] for i in range(0, len(patient_ids), batch_size)]
+        types = ["Patient"] + [resource_type for resource_type, _ in SUMMARY_SECTIONS.values()]
+        return [(resource_type, chunk) for chunk in chunks for resource_type in types]
+
+    def search_summary_batch(self, resource_type, patient_ids, elements=None, page_size=200):
+        """Run one multi-patient search; returns (resource_type, patient_ids, searchset Bundle or error)"""
+        params = {"_id" if resource_type == "Patient" else "patient": ",".join(patient_ids), "_count": page_size}
+        type_elements = (elements or {}).get(resource_type)
+        if type_elements and self.store is None:
+            if resource_type != "Patient" and "subject" not in type_elements:
+                # Results are split by patient, so the reference must come back
+                type_elements = list(type_elements) + ["subject"]
+            params = self._with_elements(params, type_elements)
+        return resource_type, patient_ids, self.search_all(resource_type, params)
+
+    def merge_summary_batches(self, patient_ids, results, elements=None):
+        """Split the batched search results back into per-patient summaries"""
+        sections = {"Patient": "patient"}
+        sections.update({resource_type: section for section, (resource_type, _) in SUMMARY_SECTIONS.items()})
+        summaries = {pid: {} for pid in patient_ids}
+        errors = []
+        for resource_type, chunk, bundle in results:
+            section = sections[resource_type]
+            if "error" in bundle:
+                errors.append({"resource_type": resource_type, "patient_ids": chunk, "error": bundle["error"]})
+                for pid in chunk:
+                    summaries[pid][section] = {"error": bundle["error"]}
+                continue
+
+            by_patient = {pid: [] for pid in chunk}
+            for entry in bundle.get("entry", []):
+                pid = patient_id_for_resource(entry.get("resource"))
+                if pid in by_patient:
+                    by_patient[pid].append(entry["resource"])
+            for pid, resources in by_patient.items():
+                if resource_type == "Patient":
+                    summaries[pid][section] = resources[0] if resources else {"error": f"Patient {pid} not found"}
+                else:
+                    summaries[pid][section] = {
+                        "resourceType": "Bundle",
+                        "type": "searchset",
+                        "total": len(resources),
+                        "entry": [{"resource": resource} for resource in resources],
+                    }
+            if self.store is not None:
+                if resource_type == "Patient":
+                    self.store.upsert([resources[0] for resources in by_patient.values() if resources])
+                else:
+                    for pid, resources in by_patient.items():
+                        self.store.replace_patient_resources(resource_type, pid, resources)
+
+        for pid in patient_ids:
+            if not summaries[pid]:
+                # Left out of the searches because the store has it all
+                summaries[pid] = self.get_patient_summary(pid, elements=elements)
+        order = ["patient"] + list(SUMMARY_SECTIONS)
+        summaries = {pid: {section: summary[section] for section in order} for pid, summary in summaries.items()}
+        failed = [pid for pid, summary in summaries.items() if any("error" in value for value in summary.values())]
+        return {
+            "requested": len(patient_ids),
+            "succeeded": len(patient_ids) - len(failed),
+            "failed": failed,
+            "errors": errors,
+            "summaries": summaries,
+        }
+
+    def _summary_in_store(self, patient_id):
+        """True if the local store can answer every section of a patient's summary"""
+        return self.store.get("Patient", patient_id) is not None and all(
+            self.store.is_fresh(resource_type, patient_id) for resource_type, _ in SUMMARY_SECTIONS.values()
+        )
+
+    # PATIENT $EVERYTHING
+    def get_patient_everything(self, patient_id, incremental=True, changes_only=False, types=None, page_size=200):
+        """Fetch everything about a patient, grouped by resource type
+        
+        Uses Patient/{id}/$everything and follows every result page. The result
+        is kept as a snapshot, and with incremental=True later calls only ask for
+        what changed since the previous fetch (_since) and merge it in. Servers
+        without the operation are read with parallel per-type searches instead,
+        filtered on _lastUpdated when refreshing.
+        
+        Args:
+            patient_id: FHIR patient id
+            incremental: Refresh the cached snapshot instead of refetching everything
+            changes_only: Return only the resources fetched by this call rather
+                than the whole merged snapshot
+            types: Optional resource types to restrict the fetch to (_type);
+                defaults to everything the server returns, or EVERYTHING_TYPES
+                when falling back to searches
+            page_size: _count requested per page
+        
+        Returns {"patient_id", "mode", "incremental", "since", "fetched_at",
+        "changed", "resources": {resourceType: searchset Bundle}}.
+        Deletions made elsewhere are not reported by either method; they are
+        only dropped from the snapshot when made through this client.
+        """
+        key = (patient_id, tuple(types or ()))
+        with self._snapshot_lock:
+            snapshot = self._snapshots.get(key) if incremental else None
+        since = snapshot["fetched_at"] if snapshot else None
+        # Stamp the fetch before sending it so nothing written meanwhile is missed
+        started = datetime.now(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+        try:
+            resources, mode, server_time = None, "search", None
+            if self._everything_supported is not False:
+                resources, server_time = self._fetch_everything(patient_id, since, types, page_size)
+                mode = "everything"
+            if resources is None:
+                resources = self._fetch_everything_by_search(patient_id, since, types, page_size)
+                mode = "search"
+        except Exception as e:
+            return {"error": str(e)}
+
+        grouped = {t: OrderedDict(r) for t, r in snapshot["resources"].items()} if snapshot else {}
+        for resource in resources:
+            grouped.setdefault(resource["resourceType"], OrderedDict())[resource.get("id")] = resource
+
+        if server_time is None:
+            # Prefer the server's own clock: the newest lastUpdated it has shown us
+            stamps = [r.get("meta", {}).get("lastUpdated") for by_id in grouped.values() for r in by_id.values()]
+            server_time = max(filter(None, stamps), default=None)
+        snapshot = {"fetched_at": server_time or started, "resources": grouped}
+        with self._snapshot_lock:
+            self._snapshots[key] = snapshot
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+
+        if changes_only:
+            grouped = OrderedDict()
+            for resource in resources:
+                grouped.setdefault(resource["resourceType"], OrderedDict())[resource.get("id")] = resource
+
+        return {
+            "patient_id": patient_id,
+            "mode": mode,
+            "incremental": since is not None,
+            "since": since,
+            "fetched_at": snapshot["fetched_at"],
+            "changed": len(resources),
+            "resources": {
+                resource_type: {
+                    "resourceType": "Bundle",
+                    "type": "searchset",
+                    "total": len(by_id),
+                    "entry": [{"resource": resource} for resource in by_id.values()],
+                }
+                for resource_type, by_id in grouped.items()
+            },
+        }
+
+    def _fetch_everything(self, patient_id, since, types, page_size):
+        """Run Patient/$everything; returns (resources, server time) or (None, None) if unsupported"""
+        params = {"_count": page_size}
+        if since:
+            params["_since"] = since
+        if types:
+            params["_type"] = ",".join(types)
+
+        resources, server_time = [], None
+        try:
+            for bundle in self.iter_pages(f"Patient/{patient_id}/$everything", params, prefetch=True):
+                server_time = server_time or bundle.get("meta", {}).get("lastUpdated")
+                resources.extend(entry["resource"] for entry in bundle.get("entry", []) if "resource" in entry)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status not in EVERYTHING_UNSUPPORTED_STATUSES:
+                raise
+            self._learn_capability("_everything_supported", False)
+            return None, None
+        self._learn_capability("_everything_supported", True)
+        return resources, server_time
+
+    def _fetch_everything_by_search(self, patient_id, since, types, page_size):
+        """Fallback for servers without $everything: one search per type, run in parallel"""
+        def search(resource_type):
+            params = {"_id": patient_id} if resource_type == "Patient" else {"patient": patient_id}
+            params["_count"] = page_size
+            if since:
+                params["_lastUpdated"] = f"gt{since}"
+            return list(self.iter_search(resource_type, params, prefetch=True))
+
+        types = types or EVERYTHING_TYPES
+        with ThreadPoolExecutor(max_workers=len(types)) as executor:
+            results = list(executor.map(search, types))
+        return [resource for resources in results for resource in resources]
+
+    def _forget_in_snapshots(self, url):
+        """Drop a resource deleted through this client from every $everything snapshot"""
+        segments = [s for s in url[len(self.base_url):].split("/") if s]
+        if len(segments) != 2:
+            return
+        resource_type, resource_id = segments
+        with self._snapshot_lock:
+            for snapshot in self._snapshots.values():
+                snapshot["resources"].get(resource_type, {}).pop(resource_id, None)
+
+    # REMOTE CHANGES
+    def apply_remote_changes(self, changed=(), deleted=()):
+        """Bring the cache, store and $everything snapshots up to date with changes made on the server
+        
+        Args:
+            changed: Created or updated resources
+            deleted: (resource_type, id) pairs of deleted resources
+        """
+        changed = list(changed)
+        for resource in changed:
+            resource_type, resource_id = resource.get("resourceType"), resource.get("id")
+            patient_id = patient_id_for_resource(resource)
+            if self.cache is not None:
+                self.cache.invalidate(patient_id=patient_id, resource_type=resource_type,
+                                      url=f"{self.base_url}/{resource_type}/{resource_id}")
+            with self._snapshot_lock:
+                for (snapshot_patient, types), snapshot in self._snapshots.items():
+                    if snapshot_patient == patient_id and (not types or resource_type in types):
+                        snapshot["resources"].setdefault(resource_type, OrderedDict())[resource_id] = resource
+        if self.store is not None and changed:
+            self.store.upsert(changed)
+
+        for resource_type, resource_id in deleted:
+            url = f"{self.base_url}/{resource_type}/{resource_id}"
+            if self.cache is not None:
+                cached = self.cache.get_entry(url)
+                self.cache.invalidate(patient_id=cached.patient_id if cached else None,
+                                      resource_type=resource_type, url=url)
+            if self.store is not None:
+                self.store.delete(resource_type, resource_id)
+            self._forget_in_snapshots(url)
+
+    def invalidate_patient(self, patient_id=None):
+        """Drop cached reads and mark stored sets stale for a patient written through another client
+        
+        With no patient every cached read is dropped.
+        """
+        if self.cache is not None:
+            if patient_id is None:
+                self.cache.clear()
+            else:
+                self.cache.invalidate(patient_id=patient_id)
+        if self.store is not None and patient_id is not None:
+            self.store.invalidate_patient(patient_id)
+
+    # TRANSACTION
+    def create_patient_record(self, patient, conditions=None, medications=None, observations=None):
+        """Create a patient and all of their clinical resources in one FHIR transaction
+        
+        Args:
+            patient: Patient resource
+            conditions: Condition resources, or plain strings such as "Diabetes"
+            medications: MedicationRequest resources, or plain strings such as "Insulin"
+            observations: Observation resources, or plain strings such as "Glucose 140 mg/dL"
+        
+        Each clinical resource's subject references the new patient through a
+        urn:uuid fullUrl, which the server rewrites to the assigned Patient id,
+        so the whole record is created in a single round trip.
+        
+        Returns {"patient_id": ..., "created": [{"resourceType", "id", "status"}]}
+        """
+        patient_urn = f"urn:uuid:{uuid.uuid4()}"
+        entries = [self._transaction_entry(dict(patient, resourceType="Patient"), patient_urn)]
+
+        for items, builder in ((conditions, self._condition_from_text),
+                               (medications, self._medication_from_text),
+                               (observations, self._observation_from_text)):
+            for item in items or []:
+                resource = builder(item) if isinstance(item, str) else dict(item)
+                resource["subject"] = {"reference": patient_urn}
+                entries.append(self._transaction_entry(resource, f"urn:uuid:{uuid.uuid4()}"))
+
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": entries
+        }
+
+        try:
+            response = self._request("POST", self.base_url, json=bundle)
+            response.raise_for_status()
+            result = response.json()
+        except Exception as e:
+            return {"error": str(e)}
+
+        created = []
+        for request_entry, response_entry in zip(entries, result.get("entry", [])):
+            outcome = response_entry.get("response", {})
+            resource_type = request_entry["resource"]["resourceType"]
+            created.append({
+                "resourceType": resource_type,
+                # Servers may answer with an absolute or relative location, or only the resource
+                "id": _location_id(outcome.get("location", ""), resource_type)
+                      or (response_entry.get("resource") or {}).get("id"),
+                "status": outcome.get("status")
+            })
+
+        patient_id = created[0]["id"] if created else None
+        if self.store is not None and patient_id:
+            # Store what was sent, with the ids and patient reference the server assigned
+            stored = []
+            for request_entry, outcome in zip(entries, created):
+                resource = dict(request_entry["resource"], id=outcome["id"])
+                if resource["resourceType"] != "Patient":
+                    resource["subject"] = {"reference": f"Patient/{patient_id}"}
+                stored.append(resource)
+            self.store.upsert(stored)
+
+        return {
+            "patient_id": patient_id,
+            "created": created
+        }
+
+    @staticmethod
+    def _transaction_entry(resource, full_url):
+        return {
+            "fullUrl": full_url,
+            "resource": resource,
+            "request": {"method": "POST", "url": resource["resourceType"]}
+        }
+
+    @staticmethod
+    def _condition_from_text(text):
+        return {
+            "resourceType": "Condition",
+            "clinicalStatus": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-clinical", "code": "active"}]},
+            "code": {"text": text.strip()}
+        }
+
+    @staticmethod
+    def _medication_from_text(text):
+        return {
+            "resourceType": "MedicationRequest",
+            "status": "active",
+            "intent": "order",
+            "medicationCodeableConcept": {"text": text.strip()}
+        }
+
+    @staticmethod
+    def _observation_from_text(text):
+        return {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"text": text.strip()},
+            "valueString": text.strip()
+        }
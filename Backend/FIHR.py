@@ -1,4 +1,8 @@
+from FHIRClient import FHIR_SERVERS
+
+
+# Server URLs live in FHIRClient.FHIR_SERVERS (see server_registry for the live registry)
 class FHIRClient:
     def __init__(self):
-        self.hapi_base_url = "http://hapi.fhir.org/baseR4"
-        self.smart_base_url = "https://launch.smarthealthit.org/v/r4/fhir"
\ No newline at end of file
+        self.hapi_base_url = FHIR_SERVERS["hapi"]
+        self.smart_base_url = FHIR_SERVERS["smart"]
\ No newline at end of file
@@ -6,8 +6,21 @@
 # from typing import List, Dict, Any
 # from FIHR import FHIRClient
 # from answer_accuarcy import similarity_score
+import asyncio
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import anyio
+from mcp.shared.exceptions import McpError
+from strands.types.exceptions import MCPClientInitializationError
 from agent import get_agent
-from tools import stdio_mcp_client
+from answer_cache import AnswerCache
+from context_compaction import CompactionStats, ContextCompactor, compact_text
+from fhir_projection import project
+from MCPSessionManager import MCPSessionManager
+from tools import bind_server
+from turn_memo import TurnMemo
+from worker_pool import AgentWorkerPool
 
 
 # class HealthcareAssistant:
@@ -168,40 +181,252 @@
 #         return "\n".join(formatted) if formatted else "No observations recorded"
 
 
+# Errors of the MCP connection itself; tool calls that fail on it come back as error results instead
+MCP_CONNECTION_ERRORS = (MCPClientInitializationError, McpError, anyio.ClosedResourceError,
+                         anyio.BrokenResourceError, anyio.EndOfStream)
+
+
+def _is_mcp_failure(error: BaseException | None) -> bool:
+    """True if an exception, or one it was raised from, is a failure of the MCP connection"""
+    while error is not None:
+        if isinstance(error, MCP_CONNECTION_ERRORS):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
 class HealthcareAssistant:
-    def __init__(self):
-        self.mcp_client = stdio_mcp_client
-        self.server = "smart"
+    def __init__(self, mcp_session: MCPSessionManager | None = None, worker_pool: AgentWorkerPool | None = None,
+                 servers: list[str] | None = None, default_server: str = "smart",
+                 answer_cache: AnswerCache | None = None, data_version=None, context_budget: int | None = 4000,
+                 on_write=None):
+        # One warm MCP server process shared by every query
+        self.mcp_session = mcp_session or MCPSessionManager()
+        # Agent loops block, so they run on a bounded pool instead of the event loop
+        self.worker_pool = worker_pool or AgentWorkerPool()
+        # Names of the FHIR servers in the MCP server's registry
+        self.servers = servers or ["hapi", "smart"]
+        self.server = default_server
+        # Optional answer cache for questions about a patient; data_version(server, patient_id)
+        # returns a version of the patient's FHIR data (None when it cannot be read, which
+        # skips the cache). Versions only needed to store an answer are read in the background.
+        self.answer_cache = answer_cache
+        self.data_version = data_version
+        self._version_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="data-version")
+        # Optional on_write(server, patient_id or None), called after a tool writes FHIR data so
+        # copies kept outside the assistant (e.g. session snapshots) can be refreshed
+        self.on_write = on_write
+        # Token budget for each FHIR tool result and the prefetched record (0 or None: no compaction)
+        self.context_budget = context_budget
+        self.compaction_stats = CompactionStats()
 
     def set_server(self, server: str):
-        if server.lower() in ["hapi", "smart"]:
+        if server.lower() in self.servers:
             self.server = server.lower()
             return f"Server set to {self.server.upper()}"
         else:
             return "Invalid server."
 
-    async def answer_medical_query(self, query: str, patient_id: str | None = None) -> dict:
+    async def answer_medical_query(self, query: str, patient_id: str | None = None, context: dict | None = None,
+                                   server: str | None = None) -> dict:
+        """Answer a query on the worker pool
+        
+        context is optional prefetched patient data (see sessions.py) that is
+        handed to the agent so it does not have to fetch it again. server is
+        the FHIR server the agent's tools use (defaults to self.server).
+        
+        Answers found in the answer cache are returned without queueing, with
+        "cached": True.
+        
+        Raises worker_pool.PoolSaturated or worker_pool.QueueTimeout when the
+        pool cannot take the query.
+        """
+        server = server or self.server
+        version, answer = await asyncio.to_thread(self._cached_answer, query, patient_id, server)
+        if answer is not None:
+            return {"answer": answer, "cached": True}
+        return await self.worker_pool.run(self._answer_medical_query, query, patient_id, context, server, version)
+
+    def _answer_medical_query(self, query: str, patient_id: str | None = None, context: dict | None = None,
+                              server: str | None = None, version: str | Future | None = None) -> dict:
+        server = server or self.server
+        memo = TurnMemo(on_write=self._write_listener(server))
+        started = time.perf_counter()
+        generation, error = None, None
         try:
-            with self.mcp_client:
-                agent = get_agent(self.mcp_client.list_tools_sync())
-                
-                if patient_id:
-                    prompt = f"""You are a healthcare assistant. Answer this medical query for patient {patient_id}: {query}
-                    
-                    Use the available FHIR tools to gather relevant patient information before answering.
-                    
-                    Please provide a clear and accurate response based on the available information.
-                    If you're unsure about anything, please acknowledge the uncertainty."""
-                else:
-                    prompt = f"""You are a healthcare assistant. Answer this medical query: {query}
-                    
-                    Please provide a clear and accurate response based on the available information.
-                    If you're unsure about anything, please acknowledge the uncertainty."""
-                
-                response = agent(prompt)
-                answer = str(response)
-                
-                return {"answer": answer}
+            with self.mcp_session.turn() as generation:
+                agent = get_agent(self._tools(memo, server, query))
+                response = agent(self._build_prompt(query, patient_id, context))
+            answer = str(response)
+            self._cache_answer(query, patient_id, server, version, answer, time.perf_counter() - started, memo)
+            
+            return {"answer": answer}
+        
+        except Exception as e:
+            error = e
+            return {"error": f"I apologize, but I encountered an error: {str(e)}"}
+        finally:
+            memo.log_stats()
+            self._recover_mcp(memo, error, generation)
+
+    async def stream_medical_query(self, query: str, patient_id: str | None = None, context: dict | None = None,
+                                   server: str | None = None):
+        """Answer a query on the worker pool, yielding progress events as they happen
         
+        Events are dicts with a "type" of:
+        - "token": {"text"} a chunk of the answer
+        - "tool": {"name"} the agent started a FHIR tool call
+        - "done": {"answer"} the complete answer ("cached": True when it came from the answer cache)
+        - "error": {"error"} the query failed (including a saturated worker pool)
+        """
+        server = server or self.server
+        version, answer = await asyncio.to_thread(self._cached_answer, query, patient_id, server)
+        if answer is not None:
+            yield {"type": "token", "text": answer}
+            yield {"type": "done", "answer": answer, "cached": True}
+            return
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        finished = object()
+
+        def emit(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        def on_done(future):
+            if not future.cancelled() and future.exception() is not None:
+                events.put_nowait({"type": "error", "error": str(future.exception())})
+            events.put_nowait(finished)
+
+        job = asyncio.ensure_future(
+            self.worker_pool.run(self._stream_medical_query, query, patient_id, context, emit, server, version)
+        )
+        job.add_done_callback(on_done)
+        try:
+            while True:
+                event = await events.get()
+                if event is finished:
+                    return
+                yield event
+        finally:
+            job.remove_done_callback(on_done)
+
+    def _stream_medical_query(self, query: str, patient_id: str | None, context: dict | None, emit,
+                              server: str | None = None, version: str | Future | None = None) -> None:
+        server = server or self.server
+        memo = TurnMemo(on_write=self._write_listener(server))
+        started = time.perf_counter()
+
+        async def consume():
+            agent = get_agent(self._tools(memo, server, query))
+            chunks = []
+            tool_calls = set()
+            async for event in agent.stream_async(self._build_prompt(query, patient_id, context)):
+                if "data" in event:
+                    chunks.append(event["data"])
+                    emit({"type": "token", "text": event["data"]})
+                elif "current_tool_use" in event:
+                    tool_use = event["current_tool_use"]
+                    if tool_use.get("toolUseId") not in tool_calls:
+                        tool_calls.add(tool_use.get("toolUseId"))
+                        emit({"type": "tool", "name": tool_use.get("name")})
+                elif "result" in event:
+                    answer = str(event["result"]) or "".join(chunks)
+                    self._cache_answer(query, patient_id, server, version, answer, time.perf_counter() - started, memo)
+                    emit({"type": "done", "answer": answer})
+
+        generation, error = None, None
+        try:
+            with self.mcp_session.turn() as generation:
+                # Each worker thread drives its own event loop for the agent stream
+                asyncio.run(consume())
         except Exception as e:
-            return {"error": f"I apologize, but I encountered an error: {str(e)}"}
\ No newline at end of file
+            error = e
+            emit({"type": "error", "error": f"I apologize, but I encountered an error: {str(e)}"})
+        finally:
+            memo.log_stats()
+            self._recover_mcp(memo, error, generation)
+
+    def _recover_mcp(self, memo: TurnMemo, error: Exception | None, generation: int | None) -> None:
+        """Probe the MCP server, restarting it if the probe fails, after a turn its tools or connection failed
+        
+        Model errors and the like leave the server alone. The turn has released
+        the server by now, so a restart only waits for other running turns.
+        """
+        if memo.failures or _is_mcp_failure(error):
+            self.mcp_session.ensure_healthy(generation)
+
+    def _tools(self, memo: TurnMemo, server: str, query: str) -> list:
+        """The MCP tools for one turn: bound to its server, memoized, and compacted to the context budget"""
+        tools = memo.wrap(bind_server(self.mcp_session.get_tools(), server))
+        if self.context_budget:
+            tools = ContextCompactor(self.context_budget, query, self.compaction_stats).wrap(tools)
+        return tools
+
+    def _cached_answer(self, query: str, patient_id: str | None,
+                       server: str) -> tuple[str | Future | None, str | None]:
+        """(data version, cached answer or None) for a query; the version is None when the answer is not cacheable
+        
+        Questions without a patient are not cached: there is no data version to
+        tell when their answer goes stale. When nothing is cached for the
+        patient the lookup is skipped and the version, only needed to store the
+        answer, is read while the agent runs and returned as a Future.
+        """
+        if self.answer_cache is None or self.data_version is None or not patient_id:
+            return None, None
+        if not self.answer_cache.may_hit(server, patient_id):
+            return self._version_executor.submit(self.data_version, server, patient_id), None
+        version = self.data_version(server, patient_id)
+        if version is None:
+            return None, None
+        return version, self.answer_cache.lookup(server, patient_id, query, version)
+
+    def _cache_answer(self, query: str, patient_id: str | None, server: str, version: str | Future | None,
+                      answer: str, seconds: float, memo: TurnMemo) -> None:
+        # Answers to turns that wrote data are not reusable: a repeat must write again
+        if self.answer_cache is None or memo.writes or version is None:
+            return
+        if isinstance(version, Future):
+            version = version.result()
+            if version is None:
+                return
+        self.answer_cache.store(server, patient_id, query, version, answer, seconds)
+
+    def _write_listener(self, server: str):
+        """TurnMemo on_write callback dropping the cached answers a write made stale and passing the write on"""
+        if self.answer_cache is None and self.on_write is None:
+            return None
+
+        def listener(tool_name, patient_id):
+            if self.answer_cache is not None:
+                self.answer_cache.invalidate(server, patient_id)
+            if self.on_write is not None:
+                self.on_write(server, patient_id)
+        return listener
+
+    def _build_prompt(self, query: str, patient_id: str | None = None, context: dict | None = None) -> str:
+        if patient_id and context:
+            record = json.dumps(project(context, "compact"), separators=(",", ":"))
+            if self.context_budget:
+                record, stats = compact_text(record, self.context_budget, query)
+                self.compaction_stats.record(stats)
+            return f"""You are a healthcare assistant. Answer this medical query for patient {patient_id}: {query}
+            
+            The patient's current record (demographics, conditions, medications, observations) was already fetched:
+            {record}
+            
+            Answer from this record first. Only use the FHIR tools for details it does not contain, or to create or update data.
+            
+            Please provide a clear and accurate response based on the available information.
+            If you're unsure about anything, please acknowledge the uncertainty."""
+        if patient_id:
+            return f"""You are a healthcare assistant. Answer this medical query for patient {patient_id}: {query}
+            
+            Use the available FHIR tools to gather relevant patient information before answering.
+            
+            Please provide a clear and accurate response based on the available information.
+            If you're unsure about anything, please acknowledge the uncertainty."""
+        return f"""You are a healthcare assistant. Answer this medical query: {query}
+            
+            Please provide a clear and accurate response based on the available information.
+            If you're unsure about anything, please acknowledge the uncertainty."""
\ No newline at end of file
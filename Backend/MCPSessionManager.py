@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from tools import create_stdio_mcp_client
+
+logger = logging.getLogger(__name__)
+
+
+class MCPSessionManager:
+    """Keeps one FHIR MCP server process warm and shares it across requests
+
+    The server is spawned once, its tool list is cached, and a background
+    thread probes it periodically. A crashed or unresponsive server is
+    restarted and the tool list refreshed. Agent turns hold the server
+    through turn(); a restart waits for the turns holding it to finish, and
+    new turns wait for the restart.
+    """
+
+    def __init__(self, client_factory=create_stdio_mcp_client, health_interval=30, health_timeout=10,
+                 drain_timeout=30):
+        """
+        Args:
+            client_factory: Callable returning a new, unstarted strands MCPClient
+            health_interval: Seconds between background health probes (0 disables the monitor)
+            health_timeout: Seconds a probe may take before the server counts as unhealthy
+            drain_timeout: Seconds a restart waits for running turns before replacing the server anyway
+        """
+        self.client_factory = client_factory
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.drain_timeout = drain_timeout
+        self.client = None
+        self._tools = None
+        self._lock = threading.RLock()
+        # Signalled when a turn ends or a restart completes
+        self._changed = threading.Condition(self._lock)
+        self._active_turns = 0
+        self._restarting = False
+        # Bumped every time a server process is started
+        self.generation = 0
+        self._stop_event = threading.Event()
+        self._monitor = None
+
+        self.started_at = None
+        self.restarts = 0
+        self.last_health_check = None
+        self.last_healthy = None
+        self.last_error = None
+
+    def start(self):
+        """Spawn the MCP server and start the health monitor"""
+        with self._lock:
+            if self.client is None:
+                self._start_client()
+        if self._monitor is None and self.health_interval:
+            self._stop_event.clear()
+            self._monitor = threading.Thread(target=self._monitor_loop, name="mcp-health", daemon=True)
+            self._monitor.start()
+
+    def stop(self):
+        """Stop the health monitor and the MCP server"""
+        self._stop_event.set()
+        if self._monitor is not None:
+            self._monitor.join(timeout=self.health_timeout)
+            self._monitor = None
+        with self._lock:
+            self._stop_client()
+
+    def restart(self, reason=""):
+        """Replace the MCP server process with a fresh one, once the turns using it are done"""
+        with self._lock:
+            self._restarting = True
+            try:
+                # A turn stuck on a hung server is not waited for beyond drain_timeout
+                if not self._changed.wait_for(lambda: self._active_turns == 0, timeout=self.drain_timeout):
+                    logger.warning("Restarting MCP server with %s turns still running", self._active_turns)
+                logger.warning("Restarting MCP server%s", f": {reason}" if reason else "")
+                self._stop_client()
+                self._start_client()
+                self.restarts += 1
+            finally:
+                self._restarting = False
+                self._changed.notify_all()
+
+    @contextmanager
+    def turn(self):
+        """Hold the server for one agent turn, starting it on first use
+
+        Yields the server generation, to pass to ensure_healthy() if the turn fails.
+        """
+        with self._lock:
+            self._changed.wait_for(lambda: not self._restarting)
+            if self.client is None:
+                self._start_client()
+            self._active_turns += 1
+            generation = self.generation
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                self._active_turns -= 1
+                self._changed.notify_all()
+
+    def get_tools(self):
+        """Return the cached tool list, starting the server on first use"""
+        with self._lock:
+            if self.client is None:
+                self._start_client()
+            return self._tools
+
+    def check_health(self):
+        """Probe the server with a tool listing bounded by health_timeout"""
+        client = self.client
+        self.last_health_check = time.time()
+        if client is None:
+            return False
+
+        result = {}
+
+        def probe():
+            try:
+                result["tools"] = client.list_tools_sync()
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=probe, name="mcp-probe", daemon=True)
+        thread.start()
+        thread.join(timeout=self.health_timeout)
+
+        if "tools" in result:
+            self.last_healthy = self.last_health_check
+            return True
+        self.last_error = str(result.get("error", f"health probe timed out after {self.health_timeout}s"))
+        return False
+
+    def ensure_healthy(self, generation=None):
+        """Restart the server if a health probe fails; returns True if it was healthy
+
+        Args:
+            generation: Server generation a failed turn used (from turn()); the
+                server is not restarted again if it was already replaced since
+        """
+        if self.check_health():
+            return True
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            try:
+                self.restart(self.last_error)
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error("MCP server restart failed: %s", e)
+        return False
+
+    def status(self):
+        """Snapshot of the session state for health endpoints"""
+        return {
+            "running": self.client is not None,
+            "started_at": self.started_at,
+            "restarts": self.restarts,
+            "active_turns": self._active_turns,
+            "cached_tools": len(self._tools) if self._tools is not None else 0,
+            "last_health_check": self.last_health_check,
+            "last_healthy": self.last_healthy,
+            "last_error": self.last_error,
+        }
+
+    def _start_client(self):
+        client = self.client_factory()
+        client.start()
+        try:
+            tools = client.list_tools_sync()
+        except Exception:
+            client.stop(None, None, None)
+            raise
+        self.client = client
+        self._tools = tools
+        self.started_at = time.time()
+        self.generation += 1
+
+    def _stop_client(self):
+        client, self.client, self._tools = self.client, None, None
+        if client is not None:
+            try:
+                client.stop(None, None, None)
+            except Exception as e:
+                logger.warning("Error while stopping MCP server: %s", e)
+
+    def _monitor_loop(self):
+        while not self._stop_event.wait(self.health_interval):
+            self.ensure_healthy()
@@ -1,23 +1,286 @@
-from sentence_transformers import SentenceTransformer, util
+import hashlib
+import json
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Empty, Queue
+import numpy as np
+from fhir_projection import project_resource
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
+BACKENDS = ("torch", "onnx", "quantized")
+
+
+def clean_text(t: str) -> str:
+    return re.sub(r'[^a-z0-9\s]', '', t.lower().strip())
+
+
+def split_sentences(text: str) -> list:
+    """Split an answer into sentences, dropping list bullets and fragments"""
+    parts = re.split(r'(?<=[.!?])\s+|\n+', text)
+    sentences = [re.sub(r'^\s*(?:[-*\u2022]|\d+[.)])\s*', '', part).strip() for part in parts]
+    return [sentence for sentence in sentences if len(clean_text(sentence).split()) >= 2]
 
-def similarity_score(answer: str, context: str) -> float:
 
-    def clean_text(t: str) -> str:
-        return re.sub(r'[^a-z0-9\s]', '', t.lower().strip())
+def context_chunks(context, max_words=120) -> list:
+    """Split a FHIR context into (label, text) chunks, one per resource
 
-    clean_answer = clean_text(answer)
-    clean_context = clean_text(context)
-    if not clean_answer or not clean_context:
-        return 0.0
-    emb1 = model.encode(clean_answer, convert_to_tensor=True)
-    emb2 = model.encode(clean_context, convert_to_tensor=True)
-    raw_sim = util.cos_sim(emb1, emb2).item()
+    context may be a client result (resource, Bundle or dict of those), its
+    JSON text, or free text, which is split into windows of max_words words.
+    """
+    if isinstance(context, str):
+        try:
+            context = json.loads(context)
+        except ValueError:
+            words = context.split()
+            return [(f"text[{i // max_words}]", " ".join(words[i:i + max_words]))
+                    for i in range(0, len(words), max_words)]
 
+    chunks = []
+
+    def walk(value):
+        if isinstance(value, list):
+            for item in value:
+                walk(item)
+        elif isinstance(value, dict):
+            if value.get("resourceType") and value["resourceType"] != "Bundle":
+                record = project_resource(value, "compact")
+                text = " ".join(str(v) for k, v in record.items() if k != "id")
+                chunks.append((f"{value['resourceType']}/{value.get('id', '')}", f"{value['resourceType']} {text}"))
+            else:
+                for item in value.values():
+                    walk(item)
+
+    walk(context)
+    return chunks
+
+
+def human_scale(raw_sim: float) -> float:
     # Normalize cosine similarity from [-1,1] → [0,1]
     normalized = (raw_sim + 1) / 2
     human_scaled = normalized ** 0.7
 
     return round(human_scaled, 3)
+
+
+class GroundingScorer:
+    """Scores how well an answer is grounded in its FHIR context
+
+    The sentence-transformers model is loaded on first use, embeddings are
+    kept in an LRU cache keyed by a hash of the text, and concurrent callers
+    are micro-batched into a single encode call.
+    """
+
+    def __init__(self, model_name="all-MiniLM-L6-v2", backend="torch", cache_size=2048,
+                 batch_window=0.005, max_batch_size=64, local_files_only=False):
+        """
+        Args:
+            model_name: sentence-transformers model name or local path
+            backend: "torch", "onnx" (ONNX Runtime on CPU) or "quantized" (int8 dynamic quantization on CPU)
+            cache_size: Number of embeddings kept in the LRU cache
+            batch_window: Seconds to wait for more requests before encoding a batch
+            max_batch_size: Maximum number of texts per encode call
+            local_files_only: Load the model from the local Hugging Face cache only
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+        self.model_name = model_name
+        self.backend = backend
+        self.cache_size = cache_size
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.local_files_only = local_files_only
+
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._requests = Queue()
+        self._batcher = None
+        self._batcher_lock = threading.Lock()
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.batches = 0
+        self.encoded = 0
+
+    @property
+    def model(self):
+        """The sentence-transformers model, loaded on first access"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    def _load_model(self):
+        from sentence_transformers import SentenceTransformer
+
+        if self.backend == "onnx":
+            # Needs sentence-transformers>=3.2 with optimum[onnxruntime]
+            return SentenceTransformer(self.model_name, device="cpu", backend="onnx",
+                                       local_files_only=self.local_files_only)
+
+        model = SentenceTransformer(self.model_name, device="cpu" if self.backend == "quantized" else None,
+                                    local_files_only=self.local_files_only)
+        if self.backend == "quantized":
+            import torch
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def embed(self, texts):
+        """Return L2-normalized embeddings for texts as a (len(texts), dim) array"""
+        keys = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        found = {}
+        with self._cache_lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+                    self.cache_hits += 1
+                else:
+                    self.cache_misses += 1
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            future = Future()
+            self._ensure_batcher()
+            self._requests.put((list(missing.values()), future))
+            for key, vector in zip(missing, future.result()):
+                found[key] = vector
+            with self._cache_lock:
+                for key in missing:
+                    self._cache[key] = found[key]
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return np.stack([found[key] for key in keys])
+
+    def score(self, answer: str, context: str) -> float:
+        """Cosine similarity between answer and context, scaled to [0, 1]"""
+        clean_answer = clean_text(answer)
+        clean_context = clean_text(context)
+        if not clean_answer or not clean_context:
+            return 0.0
+        emb = self.embed([clean_answer, clean_context])
+        raw_sim = float(np.dot(emb[0], emb[1]))
+        return human_scale(raw_sim)
+
+    def grounding_report(self, answer: str, context) -> dict:
+        """Score each answer sentence against each context resource
+        
+        The context is split into per-resource chunks (see context_chunks) so
+        nothing is lost to the model's token window. All sentences and chunks
+        are embedded in one batch, and the full sentence x chunk similarity
+        matrix is computed with a single matrix product.
+        
+        Returns {"score": overall grounding in [0, 1],
+                 "sentences": [{"sentence", "score", "resource"}]} where resource
+        is the best-supporting chunk for that sentence.
+        """
+        sentences = split_sentences(answer)
+        chunks = [(label, text) for label, text in context_chunks(context) if clean_text(text)]
+        if not sentences or not chunks:
+            return {"score": 0.0, "sentences": []}
+
+        embeddings = self.embed([clean_text(s) for s in sentences] + [clean_text(text) for _, text in chunks])
+        sentence_emb, chunk_emb = embeddings[:len(sentences)], embeddings[len(sentences):]
+        similarity = sentence_emb @ chunk_emb.T
+        best = similarity.argmax(axis=1)
+        best_scores = similarity[np.arange(len(sentences)), best]
+
+        return {
+            "score": human_scale(float(best_scores.mean())),
+            "sentences": [
+                {"sentence": sentence, "score": human_scale(float(score)), "resource": chunks[index][0]}
+                for sentence, score, index in zip(sentences, best_scores, best)
+            ]
+        }
+
+    def stats(self):
+        with self._cache_lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "backend": self.backend,
+                "model_loaded": self._model is not None,
+                "cache_entries": len(self._cache),
+                "cache_hit_rate": round(self.cache_hits / lookups, 3) if lookups else 0.0,
+                "batches": self.batches,
+                "encoded": self.encoded,
+                "avg_batch_size": round(self.encoded / self.batches, 2) if self.batches else 0.0,
+            }
+
+    def _ensure_batcher(self):
+        if self._batcher is None:
+            with self._batcher_lock:
+                if self._batcher is None:
+                    self._batcher = threading.Thread(target=self._batch_loop, name="scorer-batcher", daemon=True)
+                    self._batcher.start()
+
+    def _batch_loop(self):
+        while True:
+            pending = [self._requests.get()]
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.batch_window
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=remaining)
+                except Empty:
+                    break
+                pending.append(request)
+                size += len(request[0])
+
+            # One encode call for every text from every waiting caller
+            unique = list(dict.fromkeys(text for texts, _ in pending for text in texts))
+            try:
+                vectors = self.model.encode(unique, batch_size=self.max_batch_size,
+                                            normalize_embeddings=True, convert_to_numpy=True)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.encoded += len(unique)
+            by_text = dict(zip(unique, vectors))
+            for texts, future in pending:
+                future.set_result([by_text[text] for text in texts])
+
+
+_default_scorer = None
+_default_lock = threading.Lock()
+
+
+def get_scorer() -> GroundingScorer:
+    """Shared scorer configured from SCORER_MODEL, SCORER_BACKEND and SCORER_LOCAL_ONLY"""
+    global _default_scorer
+    if _default_scorer is None:
+        with _default_lock:
+            if _default_scorer is None:
+                _default_scorer = GroundingScorer(
+                    model_name=os.getenv("SCORER_MODEL", "all-MiniLM-L6-v2"),
+                    backend=os.getenv("SCORER_BACKEND", "torch"),
+                    local_files_only=os.getenv("SCORER_LOCAL_ONLY", "").lower() in ("1", "true", "yes"),
+                )
+    return _default_scorer
+
+
+def similarity_score(answer: str, context: str) -> float:
+    # Chunked scoring covers the whole record; fall back to a single
+    # whole-text comparison for answers without full sentences
+    report = get_scorer().grounding_report(answer, context)
+    if report["sentences"]:
+        return report["score"]
+    return get_scorer().score(answer, context)
+
+
+def grounding_report(answer: str, context) -> dict:
+    return get_scorer().grounding_report(answer, context)
@@ -0,0 +1,160 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_query(query):
+    """Lowercase, drop punctuation and collapse whitespace, so trivially different phrasings share a key"""
+    return " ".join(re.sub(r"[^a-z0-9\s]", " ", query.lower()).split())
+
+
+class CachedAnswer:
+    def __init__(self, server, patient_id, query, version, answer, seconds, embedding=None):
+        self.server = server
+        self.patient_id = patient_id
+        self.query = query
+        self.version = version
+        self.answer = answer
+        self.seconds = seconds
+        self.embedding = embedding
+        self.stored_at = time.time()
+        self.hits = 0
+
+
+class AnswerCache:
+    """LRU + TTL cache of agent answers, keyed by server, patient, normalized query and data version
+
+    The data version identifies the patient's FHIR data when the
+    answer was produced, so answers stop matching once the record changes.
+    Writes the application knows about (agent write tools) drop the
+    patient's entries straight away through invalidate().
+
+    With a scorer (answer_accuarcy.GroundingScorer) a query that misses
+    exactly may still match an answered query for the same patient and data
+    version whose embedding has cosine similarity >= similarity_threshold.
+    Keep the threshold high: "active" and "inactive conditions" are close.
+    """
+
+    def __init__(self, max_entries=512, ttl=3600, scorer=None, similarity_threshold=0.95):
+        """
+        Args:
+            max_entries: Maximum number of answers kept (least recently used are evicted)
+            ttl: Seconds an answer is served for, whatever the data version
+            scorer: Optional GroundingScorer used to embed queries for near-duplicate matching
+            similarity_threshold: Minimum cosine similarity for a near-duplicate hit
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.scorer = scorer
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def _key(server, patient_id, query, version):
+        return server, patient_id, normalize_query(query), version
+
+    def lookup(self, server, patient_id, query, version):
+        """Return the cached answer text for a query, or None"""
+        key = self._key(server, patient_id, query, version)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.stored_at >= self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return self._hit(entry)
+            candidates = [
+                e for k, e in self._entries.items()
+                if k[:2] == key[:2] and k[3] == version and e.embedding is not None and now - e.stored_at < self.ttl
+            ] if self.scorer is not None else []
+            if not candidates:
+                self.misses += 1
+                return None
+
+        # Embedding runs outside the lock; it may load the model on first use
+        query_embedding = self._embed(key[2])
+        if query_embedding is not None:
+            similarities = np.stack([e.embedding for e in candidates]) @ query_embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                with self._lock:
+                    self.semantic_hits += 1
+                    return self._hit(candidates[best])
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _hit(self, entry):
+        entry.hits += 1
+        self.hits += 1
+        self.seconds_saved += entry.seconds
+        return entry.answer
+
+    def store(self, server, patient_id, query, version, answer, seconds):
+        """Cache an answer that took seconds to produce"""
+        key = self._key(server, patient_id, query, version)
+        embedding = self._embed(key[2]) if self.scorer is not None else None
+        with self._lock:
+            self._entries[key] = CachedAnswer(server, patient_id, query, version, answer, seconds, embedding)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def may_hit(self, server, patient_id):
+        """False when no answer for the patient is cached, so a lookup would miss whatever the data version
+
+        A False is counted as a miss.
+        """
+        with self._lock:
+            if any(key[:2] == (server, patient_id) for key in self._entries):
+                return True
+            self.misses += 1
+            return False
+
+    def invalidate(self, server=None, patient_id=None):
+        """Drop a patient's answers (or every answer on a server when patient_id is None)"""
+        with self._lock:
+            doomed = [
+                key for key in self._entries
+                if (server is None or key[0] == server) and (patient_id is None or key[1] == patient_id)
+            ]
+            for key in doomed:
+                del self._entries[key]
+            self.invalidations += len(doomed)
+        return len(doomed)
+
+    def _embed(self, text):
+        try:
+            return self.scorer.embed([text])[0]
+        except Exception:
+            # Near-duplicate matching is best effort; exact matching still works
+            return None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "semantic": self.scorer is not None,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "seconds_saved": round(self.seconds_saved, 1),
+            }
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+FHIR Bulk Data ($export) client
+
+Kicks off an asynchronous export, polls its status URL until the server
+publishes the manifest, then streams every NDJSON output file into a local
+store line by line. Files download in parallel, and progress is saved after
+every batch so an interrupted export resumes where it stopped.
+
+Run with: python bulk_export.py <base_url> --out <directory> [--type Patient ...]
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class BulkExportError(Exception):
+    """Raised when an export cannot be started, fails on the server, or a file cannot be downloaded"""
+
+
+class NDJSONDirectoryStore:
+    """Local store that appends resources to one <ResourceType>.ndjson file per type"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sizes = {}
+
+    def write(self, resource_type, resources):
+        lines = "".join(json.dumps(resource, separators=(",", ":")) + "\n" for resource in resources)
+        with self._lock:
+            with open(self._path(resource_type), "ab") as f:
+                f.write(lines.encode("utf-8"))
+                self._sizes[resource_type] = f.tell()
+
+    def positions(self):
+        """{resourceType: bytes written} to record alongside the export's progress"""
+        with self._lock:
+            return dict(self._sizes)
+
+    def reset(self, resource_types, positions=None):
+        """Cut each type's file back to a recorded position, or empty it
+
+        Drops whatever a fresh export would otherwise append to, and on a
+        resume whatever was written after the last recorded batch.
+        """
+        positions = positions or {}
+        with self._lock:
+            for resource_type in resource_types:
+                size = positions.get(resource_type, 0)
+                if os.path.exists(self._path(resource_type)):
+                    with open(self._path(resource_type), "r+b") as f:
+                        f.truncate(size)
+                self._sizes[resource_type] = size
+
+    def _path(self, resource_type):
+        return os.path.join(self.directory, f"{resource_type}.ndjson")
+
+    def close(self):
+        pass
+
+
+class BulkExportClient:
+    """Runs a Bulk Data export into a local store with bounded memory
+
+    The store is any object with write(resource_type, resources) and close().
+    A store whose writes append rather than upsert should also have
+    positions() and reset(resource_types, positions), as NDJSONDirectoryStore
+    does, so a fresh export starts from empty files and a resumed one drops
+    any batch written after the last saved progress.
+    At most max_workers files stream at once and each holds at most
+    batch_size parsed resources before they are written, so memory use does
+    not grow with the size of the export.
+    """
+
+    def __init__(self, base_url, store, state_path=None, session=None, max_workers=4, batch_size=500,
+                 poll_interval=2, max_poll_interval=60, timeout=(5, 60), max_attempts=3):
+        """
+        Args:
+            base_url: FHIR server base URL
+            store: Destination for downloaded resources
+            state_path: JSON file recording the status URL, manifest and per-file
+                progress; an export found there is resumed instead of restarted
+            session: requests.Session to use (e.g. FHIRClient.session for shared
+                pooling and auth headers); a new one is created by default
+            max_workers: Output files downloaded in parallel
+            batch_size: Resources parsed before each write to the store
+            poll_interval: Seconds between status polls when the server sends no Retry-After
+            max_poll_interval: Upper bound for the polling back-off
+            timeout: Seconds, or a (connect, read) tuple, for every request
+            max_attempts: Attempts per output file before the export fails
+        """
+        self.base_url = base_url.rstrip("/")
+        self.store = store
+        self.state_path = state_path
+        self.session = session or requests.Session()
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self._state_lock = threading.Lock()
+        # Held from a batch's write until its progress is saved
+        self._flush_lock = threading.Lock()
+        self._state = self._load_state()
+
+    def run(self, resource_types=None, since=None, group_id=None):
+        """Export, wait and download in one call, resuming a saved export if there is one
+
+        Returns download statistics, or {"error": ...} if the export failed.
+        """
+        try:
+            if not self._state.get("status_url"):
+                self._state = {"status_url": self.kick_off(resource_types, since, group_id), "files": {}}
+                self._save_state()
+            if not self._state.get("manifest"):
+                self._state["manifest"] = self.poll(self._state["status_url"])
+                self._save_state()
+            stats = self.download(self._state["manifest"])
+            self._state["complete"] = True
+            self._save_state()
+            return stats
+        except Exception as e:
+            return {"error": str(e)}
+
+    def kick_off(self, resource_types=None, since=None, group_id=None):
+        """Start an export and return its status URL
+
+        Exports every patient (Patient/$export), or the members of group_id
+        (Group/{id}/$export), limited to resource_types and to resources
+        changed after since.
+        """
+        path = f"Group/{group_id}/$export" if group_id else "Patient/$export"
+        params = {"_outputFormat": "application/fhir+ndjson"}
+        if resource_types:
+            params["_type"] = ",".join(resource_types)
+        if since:
+            params["_since"] = since
+
+        response = self.session.get(
+            f"{self.base_url}/{path}",
+            params=params,
+            headers={"Accept": "application/fhir+json", "Prefer": "respond-async"},
+            timeout=self.timeout,
+        )
+        if response.status_code != 202 or not response.headers.get("Content-Location"):
+            raise BulkExportError(f"Export kick-off failed: {response.status_code} {response.text[:500]}")
+        status_url = response.headers["Content-Location"]
+        logger.info("Bulk export started: %s", status_url)
+        return status_url
+
+    def poll(self, status_url, max_wait=None):
+        """Poll the status URL until the export completes and return its manifest
+
+        Honours Retry-After and otherwise backs off from poll_interval up to
+        max_poll_interval. Raises BulkExportError if the export fails or
+        max_wait seconds pass.
+        """
+        started = time.monotonic()
+        interval = self.poll_interval
+        while True:
+            response = self.session.get(status_url, headers={"Accept": "application/json"}, timeout=self.timeout)
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code != 202:
+                raise BulkExportError(f"Export failed: {response.status_code} {response.text[:500]}")
+
+            retry_after = response.headers.get("Retry-After", "")
+            wait = float(retry_after) if retry_after.isdigit() else interval
+            interval = min(interval * 2, self.max_poll_interval)
+            logger.info("Bulk export in progress (%s), next poll in %ss", response.headers.get("X-Progress", "?"), wait)
+            if max_wait is not None and time.monotonic() - started + wait > max_wait:
+                raise BulkExportError(f"Export did not complete within {max_wait}s")
+            time.sleep(wait)
+
+    def download(self, manifest):
+        """Stream every output file in the manifest into the store, in parallel"""
+        started = time.monotonic()
+        outputs = manifest.get("output", [])
+        if hasattr(self.store, "reset"):
+            # Positions are only saved once a batch is written, so a fresh export empties the files
+            self.store.reset({output["type"] for output in outputs}, self._state.get("stored"))
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bulk-download") as executor:
+            # list() re-raises the first failure after every file has had its chance
+            list(executor.map(self._download_file, outputs))
+        self.store.close()
+
+        elapsed = time.monotonic() - started
+        resources = {}
+        downloaded = 0
+        for output in outputs:
+            progress = self._state["files"][output["url"]]
+            resources[output["type"]] = resources.get(output["type"], 0) + progress["lines"]
+            downloaded += progress["bytes"]
+        total = sum(resources.values())
+        return {
+            "transactionTime": manifest.get("transactionTime"),
+            "files": len(outputs),
+            "resources": resources,
+            "bytes": downloaded,
+            "seconds": round(elapsed, 3),
+            "resources_per_second": round(total / elapsed, 1) if elapsed else 0.0,
+            "retries": sum(self._state["files"][output["url"]].get("retries", 0) for output in outputs),
+            "errors": [error["url"] for error in manifest.get("error", [])],
+        }
+
+    def cancel(self, status_url=None):
+        """Ask the server to cancel (or clean up) an export"""
+        status_url = status_url or self._state.get("status_url")
+        if status_url:
+            self.session.delete(status_url, timeout=self.timeout)
+
+    def _download_file(self, output):
+        url = output["url"]
+        with self._state_lock:
+            progress = self._state.setdefault("files", {}).setdefault(
+                url, {"type": output["type"], "lines": 0, "bytes": 0, "done": False}
+            )
+        if progress["done"]:
+            return
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self._stream_file(url, output["type"], progress)
+                break
+            except (requests.RequestException, json.JSONDecodeError) as e:
+                # A line cut short by a dropped connection is retried like the drop itself
+                if attempt == self.max_attempts:
+                    raise BulkExportError(f"Download of {url} failed after {attempt} attempts: {e}") from e
+                progress["retries"] = progress.get("retries", 0) + 1
+                logger.warning("Download of %s interrupted after %s resources, resuming: %s",
+                               url, progress["lines"], e)
+                time.sleep(min(2 ** attempt, self.max_poll_interval))
+
+        with self._state_lock:
+            progress["done"] = True
+        self._save_state()
+
+    def _stream_file(self, url, resource_type, progress):
+        """Stream one NDJSON file, continuing after whatever is already in the store
+
+        A resumed download asks for the remaining bytes with a Range header;
+        when the server ignores it, the lines already stored are skipped.
+        """
+        headers = {"Accept": "application/fhir+ndjson"}
+        if progress["bytes"]:
+            headers["Range"] = f"bytes={progress['bytes']}-"
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            resumed = response.status_code == 206
+            offset = progress["bytes"] if resumed else 0
+            skip = 0 if resumed else progress["lines"]
+            batch = []
+            for line, end in _ndjson_lines(response):
+                offset = end + (progress["bytes"] if resumed else 0)
+                if not line.strip():
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                batch.append(json.loads(line))
+                if len(batch) >= self.batch_size:
+                    self._flush(resource_type, batch, progress, offset)
+                    batch = []
+            self._flush(resource_type, batch, progress, offset)
+
+    def _flush(self, resource_type, batch, progress, offset):
+        """Write a batch and record it, with the store's positions, so a resume never stores it twice
+
+        A batch written but not yet recorded when the export stops is cut
+        off again by store.reset() before resuming, and straight away if the
+        write itself fails.
+        """
+        with self._flush_lock:
+            if batch:
+                try:
+                    self.store.write(resource_type, batch)
+                except Exception:
+                    if hasattr(self.store, "reset"):
+                        self.store.reset([resource_type], self._state.get("stored"))
+                    raise
+            with self._state_lock:
+                progress["lines"] += len(batch)
+                progress["bytes"] = offset
+                if hasattr(self.store, "positions"):
+                    self._state["stored"] = self.store.positions()
+            self._save_state()
+
+    def _load_state(self):
+        if self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if not state.get("complete"):
+                return state
+        return {"files": {}}
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        with self._state_lock:
+            data = json.dumps(self._state)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.state_path)
+
+
+def _ndjson_lines(response, chunk_size=64 * 1024):
+    """Yield (line, byte offset just past it) for each line of a streamed response body
+
+    Offsets count the actual terminator bytes, so resuming a CRLF file
+    starts on a line boundary; iter_lines drops the delimiter. A last line
+    without a newline is only yielded once the body has ended.
+    """
+    offset, pending = 0, b""
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        pending += chunk
+        start = 0
+        while True:
+            end = pending.find(b"\n", start)
+            if end < 0:
+                break
+            offset += end + 1 - start
+            yield pending[start:end], offset
+            start = end + 1
+        pending = pending[start:]
+    if pending:
+        yield pending, offset + len(pending)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a FHIR server's data with Bulk Data $export")
+    parser.add_argument("base_url")
+    parser.add_argument("--out", required=True, help="directory for <ResourceType>.ndjson files")
+    parser.add_argument("--type", dest="types", action="append", help="resource type to export (repeatable)")
+    parser.add_argument("--since", help="only resources changed after this FHIR instant")
+    parser.add_argument("--group", help="export the members of this Group instead of all patients")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    client = BulkExportClient(
+        args.base_url,
+        NDJSONDirectoryStore(args.out),
+        state_path=os.path.join(args.out, "export_state.json"),
+        max_workers=args.workers,
+    )
+    print(json.dumps(client.run(args.types, args.since, args.group), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for a FHIR server's Bulk Data ($export) endpoints
+
+Serves NDJSON fixtures (one <ResourceType>.ndjson file per type) from a
+directory, or synthetic data for a number of patients, through the same
+kick-off / status / download flow a real server uses. It can also cut every
+download short once, to exercise resuming.
+
+Run with: python bulk_stub_server.py [--fixtures DIR | --patients N] [--port 8090]
+"""
+import argparse
+import json
+import os
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def synthetic_fixtures(patients=100, observations_per_patient=20):
+    """Build {resourceType: NDJSON bytes} for a synthetic cohort"""
+    files = {"Patient": [], "Condition": [], "MedicationRequest": [], "Observation": []}
+    for i in range(patients):
+        patient_id = f"bulk-{i}"
+        subject = {"reference": f"Patient/{patient_id}"}
+        files["Patient"].append({
+            "resourceType": "Patient", "id": patient_id,
+            "name": [{"family": f"Family{i}", "given": [f"Given{i}"]}],
+            "gender": "female" if i % 2 else "male", "birthDate": f"{1940 + i % 60}-01-01",
+        })
+        files["Condition"].append({
+            "resourceType": "Condition", "id": f"{patient_id}-c", "subject": subject,
+            "clinicalStatus": {"coding": [{"code": "active"}]},
+            "code": {"coding": [{"system": "http://snomed.info/sct", "code": "44054006",
+                                 "display": "Type 2 diabetes mellitus"}]},
+        })
+        files["MedicationRequest"].append({
+            "resourceType": "MedicationRequest", "id": f"{patient_id}-m", "subject": subject,
+            "status": "active", "intent": "order",
+            "medicationCodeableConcept": {"coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm",
+                                                      "code": "860975", "display": "Metformin 500 MG"}]},
+        })
+        for j in range(observations_per_patient):
+            files["Observation"].append({
+                "resourceType": "Observation", "id": f"{patient_id}-o{j}", "subject": subject,
+                "status": "final",
+                "code": {"coding": [{"system": "http://loinc.org", "code": "2339-0", "display": "Glucose"}]},
+                "effectiveDateTime": f"2024-01-{1 + j % 28:02d}T08:00:00Z",
+                "valueQuantity": {"value": 90 + (i + j) % 80, "unit": "mg/dL"},
+            })
+    return {
+        resource_type: "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in resources).encode()
+        for resource_type, resources in files.items()
+    }
+
+
+def load_fixtures(directory):
+    """Read {resourceType: NDJSON bytes} from <ResourceType>.ndjson files"""
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".ndjson"):
+            with open(os.path.join(directory, name), "rb") as f:
+                files[name[:-len(".ndjson")]] = f.read()
+    return files
+
+
+class BulkDataServer(ThreadingHTTPServer):
+    """HTTP server holding the export fixtures and job state its handlers share"""
+
+    def __init__(self, address, handler, files, polls_before_ready=2, fail_once_after=None, support_range=True):
+        super().__init__(address, handler)
+        self.files = files
+        self.polls_before_ready = polls_before_ready
+        self.fail_once_after = fail_once_after
+        self.support_range = support_range
+        self.jobs = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+
+
+class BulkDataHandler(BaseHTTPRequestHandler):
+    """Kick-off, status and file download requests of the Bulk Data flow"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        segments = [s for s in parts.path.split("/") if s]
+        if segments[-1:] == ["$export"]:
+            return self._kick_off(parse_qs(parts.query))
+        if segments[:2] == ["fhir", "status"] and len(segments) == 3:
+            return self._status(segments[2])
+        if segments[:2] == ["fhir", "files"] and len(segments) == 4:
+            return self._file(segments[2], segments[3])
+        self._send(404, b'{"resourceType":"OperationOutcome"}')
+
+    def do_DELETE(self):
+        job_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.jobs.pop(job_id, None)
+        self._send(202, b"")
+
+    def _base(self):
+        return f"http://{self.headers['Host']}/fhir"
+
+    def _kick_off(self, query):
+        if self.headers.get("Prefer") != "respond-async":
+            return self._send(400, b'{"resourceType":"OperationOutcome"}')
+        files = self.server.files
+        types = query["_type"][0].split(",") if "_type" in query else list(files)
+        job_id = uuid.uuid4().hex
+        with self.server.lock:
+            self.server.jobs[job_id] = {"polls": 0, "types": [t for t in types if t in files]}
+        self._send(202, b"", {"Content-Location": f"{self._base()}/status/{job_id}"})
+
+    def _status(self, job_id):
+        with self.server.lock:
+            job = self.server.jobs.get(job_id)
+            if job is None:
+                return self._send(404, b'{"resourceType":"OperationOutcome"}')
+            job["polls"] += 1
+            ready = job["polls"] > self.server.polls_before_ready
+        if not ready:
+            return self._send(202, b"", {"X-Progress": f"poll {job['polls']}", "Retry-After": "0"})
+        manifest = {
+            "transactionTime": "2024-01-01T00:00:00Z",
+            "request": f"{self._base()}/Patient/$export",
+            "requiresAccessToken": False,
+            "output": [
+                {"type": t, "url": f"{self._base()}/files/{job_id}/{t}.ndjson",
+                 "count": self.server.files[t].count(b"\n")}
+                for t in job["types"]
+            ],
+            "error": [],
+        }
+        self._send(200, json.dumps(manifest).encode(), {"Content-Type": "application/json"})
+
+    def _file(self, job_id, name):
+        resource_type = name[:-len(".ndjson")]
+        if job_id not in self.server.jobs or resource_type not in self.server.files:
+            return self._send(404, b"")
+        body = self.server.files[resource_type]
+        status = 200
+        range_header = self.headers.get("Range", "")
+        if self.server.support_range and range_header.startswith("bytes="):
+            body = body[int(range_header[len("bytes="):].split("-")[0]):]
+            status = 206
+
+        key = (job_id, resource_type)
+        fail_once_after = self.server.fail_once_after
+        with self.server.lock:
+            cut = fail_once_after is not None and key not in self.server.failed and len(body) > fail_once_after
+            if cut:
+                self.server.failed.add(key)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+ndjson")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if cut:
+            # Promise the whole file, send part of it and hang up
+            self.wfile.write(body[:fail_once_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(files, host="127.0.0.1", port=0, polls_before_ready=2, fail_once_after=None, support_range=True):
+    """Create (but do not start) a stand-in Bulk Data server
+
+    Args:
+        files: {resourceType: NDJSON bytes} to export
+        polls_before_ready: Status polls answered with 202 before the manifest
+        fail_once_after: Cut the first download of every file after this many bytes
+        support_range: Honour Range headers with 206 Partial Content
+
+    The base URL is http://host:server.server_port/fhir.
+    """
+    return BulkDataServer((host, port), BulkDataHandler, files, polls_before_ready, fail_once_after, support_range)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in Bulk Data $export server")
+    parser.add_argument("--fixtures", help="directory of <ResourceType>.ndjson files")
+    parser.add_argument("--patients", type=int, default=100, help="synthetic patients when no fixtures are given")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fail-once-after", type=int, help="cut each file's first download after this many bytes")
+    args = parser.parse_args()
+
+    files = load_fixtures(args.fixtures) if args.fixtures else synthetic_fixtures(args.patients)
+    server = make_server(files, port=args.port, fail_once_after=args.fail_once_after)
+    print(f"Serving Bulk Data export at http://127.0.0.1:{server.server_port}/fhir")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
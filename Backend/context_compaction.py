@@ -0,0 +1,383 @@
+import json
+import re
+import threading
+from datetime import date
+from fhir_projection import concept_text, estimate_tokens, project, quantity_text, range_text, value_text
+from tools import DelegatingTool
+from turn_memo import READ_TOOLS
+
+# Lists of resources or records that may be collapsed and trimmed
+RECORD_LISTS = ("records", "entry")
+
+# Coding fields that never help answer a clinical question
+DROPPED_CODING_FIELDS = ("version", "userSelected", "extension")
+
+# Interpretation codes and displays that mark a reading as out of range
+ABNORMAL_FLAGS = {"h", "hh", "hu", "l", "ll", "lu", "a", "aa", "high", "low", "abnormal", "critical high",
+                  "critical low", "critically high", "critically low", "above high normal", "below low normal"}
+
+ACTIVE_STATUSES = {"active", "recurrence", "relapse", "on-hold"}
+
+STOPWORDS = {"the", "and", "for", "are", "was", "were", "what", "which", "when", "how", "does", "did", "has",
+             "have", "had", "any", "all", "this", "that", "with", "from", "about", "patient", "patients", "their",
+             "they", "them", "her", "his", "she", "him", "you", "your", "can", "tell", "show", "list", "give"}
+
+NUMBER = re.compile(r"^\s*([<>]=?)?\s*(-?\d+(?:\.\d+)?)\s*(.*)$")
+
+# Days over which a record's recency weight halves when ranking
+RECENCY_HALF_LIFE = 180
+
+
+def dedupe_codings(value):
+    """Drop repeated codings (same system and code) and displays that repeat the concept text"""
+    if isinstance(value, list):
+        return [dedupe_codings(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    value = {key: dedupe_codings(item) for key, item in value.items()}
+    if isinstance(value.get("coding"), list):
+        text = value.get("text")
+        seen, codings = set(), []
+        for coding in value["coding"]:
+            if not isinstance(coding, dict):
+                codings.append(coding)
+                continue
+            key = (coding.get("system"), coding.get("code"), None if coding.get("code") else coding.get("display"))
+            if key in seen:
+                continue
+            seen.add(key)
+            codings.append({
+                field: item for field, item in coding.items()
+                if field not in DROPPED_CODING_FIELDS and not (field == "display" and item == text)
+            })
+        value["coding"] = codings
+    return value
+
+
+def _number(text):
+    """(value, unit) parsed from a rendered quantity such as "7.2 %", or (None, None)"""
+    match = NUMBER.match(str(text)) if text is not None else None
+    if not match or match.group(1):
+        return None, None
+    return float(match.group(2)), match.group(3).strip() or None
+
+
+def _flag(interpretation, value=None, ranges=None):
+    """True when a reading is flagged out of range by its interpretation or numeric reference range"""
+    if interpretation and str(interpretation).lower() in ABNORMAL_FLAGS:
+        return True
+    if value is None:
+        return False
+    for reference_range in ranges or []:
+        low = (reference_range.get("low") or {}).get("value")
+        high = (reference_range.get("high") or {}).get("value")
+        if low is not None and value < low or high is not None and value > high:
+            return True
+    return False
+
+
+def _reading(item):
+    """A raw or compact Observation as a reading dict, or None for anything else"""
+    if not isinstance(item, dict):
+        return None
+    if item.get("resourceType") == "Observation":
+        quantity = item.get("valueQuantity") or {}
+        interpretation = (item.get("interpretation") or [{}])[0]
+        codings = [c for c in (item.get("code") or {}).get("coding", []) if c.get("code")]
+        return {
+            "name": concept_text(item.get("code")),
+            "code": codings[0]["code"] if codings else None,
+            "date": item.get("effectiveDateTime") or (item.get("effectivePeriod") or {}).get("start")
+            or item.get("issued"),
+            "text": value_text(item),
+            "value": quantity.get("value") if "comparator" not in quantity else None,
+            "unit": quantity.get("unit") or quantity.get("code"),
+            "range": range_text(item.get("referenceRange")),
+            "flagged": _flag(
+                (interpretation.get("coding") or [{}])[0].get("code") or interpretation.get("text"),
+                quantity.get("value"), item.get("referenceRange"),
+            ),
+            "components": [
+                {"name": concept_text(c.get("code")), "text": value_text(c),
+                 "value": (c.get("valueQuantity") or {}).get("value"),
+                 "unit": (c.get("valueQuantity") or {}).get("unit")}
+                for c in item.get("component", [])
+            ],
+        }
+    if "observation" in item and ("value" in item or "components" in item):
+        value, unit = _number(item.get("value"))
+        components = []
+        for component in item.get("components", []):
+            component_value, component_unit = _number(component.get("value"))
+            components.append({"name": component.get("name"), "text": component.get("value"),
+                               "value": component_value, "unit": component_unit})
+        return {
+            "name": item["observation"],
+            "code": None,
+            "date": item.get("date"),
+            "text": item.get("value"),
+            "value": value,
+            "unit": unit,
+            "range": item.get("referenceRange"),
+            "flagged": _flag(item.get("interpretation")),
+            "components": components,
+        }
+    return None
+
+
+def _series(readings, unit):
+    """latest, previous, min and max of numeric readings (oldest first) sharing the latest unit"""
+    summary = {"latest": readings[-1]["text"]}
+    if len(readings) > 1:
+        summary["previous"] = readings[-2]["text"]
+    values = [r["value"] for r in readings if r["value"] is not None and r["unit"] == unit]
+    if len(values) > 1:
+        summary["min"] = quantity_text({"value": min(values), "unit": unit})
+        summary["max"] = quantity_text({"value": max(values), "unit": unit})
+    return summary
+
+
+def _collapse(readings):
+    """One record summarizing repeated readings of the same observation"""
+    readings = sorted(readings, key=lambda r: r["date"] or "")
+    latest = readings[-1]
+    record = {
+        "observation": latest["name"],
+        "code": latest["code"],
+        "readings": len(readings),
+        "first": readings[0]["date"],
+        "last": latest["date"],
+        **_series(readings, latest["unit"]),
+        "referenceRange": latest["range"],
+        "flagged": sum(r["flagged"] for r in readings) or None,
+        "latestFlagged": latest["flagged"] or None,
+    }
+    if latest["components"]:
+        record["components"] = []
+        for position, component in enumerate(latest["components"]):
+            history = [
+                c for r in readings for c in r["components"][position:position + 1] if c["name"] == component["name"]
+            ]
+            record["components"].append({"name": component["name"], **_series(history, component["unit"])})
+    return {key: value for key, value in record.items() if value is not None}
+
+
+def collapse_observations(value, min_repeats=2):
+    """Replace repeated observations of the same code in record lists with one summary record each
+
+    A summary keeps the latest and previous value, the range of numeric
+    values, the first and last date, the latest reference range and how many
+    readings were flagged out of range. Observations seen fewer than
+    min_repeats times are left as they are.
+    """
+    if isinstance(value, list):
+        return [collapse_observations(item, min_repeats) for item in value]
+    if not isinstance(value, dict):
+        return value
+    collapsed = {}
+    for key, item in value.items():
+        if key in RECORD_LISTS and isinstance(item, list):
+            item = _collapse_list(item, min_repeats)
+        collapsed[key] = collapse_observations(item, min_repeats)
+    return collapsed
+
+
+def _collapse_list(items, min_repeats):
+    groups = {}
+    for index, item in enumerate(items):
+        reading = _reading(item)
+        if reading is not None and reading["name"]:
+            groups.setdefault(reading["code"] or reading["name"], []).append((index, reading))
+    replaced, first = set(), {}
+    for members in groups.values():
+        if len(members) >= min_repeats:
+            first[members[0][0]] = _collapse([reading for _, reading in members])
+            replaced.update(index for index, _ in members)
+    return [first[index] if index in first else item
+            for index, item in enumerate(items) if index not in replaced or index in first]
+
+
+def _date(item):
+    for key in ("last", "date", "effectiveDateTime", "onset", "onsetDateTime", "authoredOn", "recorded",
+                "recordedDate", "issued"):
+        if isinstance(item.get(key), str):
+            stamp = item[key]
+            break
+    else:
+        stamp = (item.get("effectivePeriod") or item.get("onsetPeriod") or {}).get("start")
+    try:
+        return date.fromisoformat(stamp[:10]) if stamp else None
+    except ValueError:
+        return None
+
+
+def _active(item):
+    status = item.get("clinicalStatus") or item.get("status")
+    if isinstance(status, dict):
+        status = concept_text(status)
+    return isinstance(status, str) and status.lower() in ACTIVE_STATUSES
+
+
+def query_terms(query):
+    """Content words of a query, cut to five characters so "medications" matches "medication\""""
+    words = re.findall(r"[a-z0-9]+", (query or "").lower())
+    return {word[:5] for word in words if len(word) >= 3 and word not in STOPWORDS}
+
+
+def _record_lists(value, owner=None):
+    """Yield (owning dict or None, record list) for every record list in a structure"""
+    if isinstance(value, list):
+        if owner is None:
+            yield None, value
+        for item in value:
+            yield from _record_lists(item, owner=False)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key in RECORD_LISTS and isinstance(item, list):
+                yield value, item
+                for element in item:
+                    yield from _record_lists(element, owner=False)
+            else:
+                yield from _record_lists(item, owner=False)
+
+
+def fit_budget(value, budget, query=None):
+    """Drop the lowest-ranked records until a structure fits in budget tokens
+
+    Records are ranked by relevance to the query (the share of its content
+    words they mention, weighted double), recency (halving every
+    RECENCY_HALF_LIFE days before the newest record) and whether they are
+    active. Lists that lost records get an "omitted" count. Anything that is
+    not in a record list (demographics, for one) is always kept, so the
+    result can still exceed a very small budget.
+    """
+    tokens = estimate_tokens(json.dumps(value, separators=(",", ":")))
+    if tokens <= budget:
+        return value
+    terms = query_terms(query)
+    candidates = []
+    for owner, records in _record_lists(value):
+        for record in records:
+            if isinstance(record, dict):
+                text = json.dumps(record, separators=(",", ":"))
+                candidates.append((owner, records, record, text, _date(record)))
+    dates = [candidate[4] for candidate in candidates if candidate[4]]
+    newest = max(dates) if dates else None
+
+    def score(candidate):
+        _, _, record, text, when = candidate
+        lowered = text.lower()
+        relevance = sum(term in lowered for term in terms) / len(terms) if terms else 0.0
+        recency = 0.5 ** ((newest - when).days / RECENCY_HALF_LIFE) if when else 0.0
+        return 2 * relevance + recency + (0.5 if _active(record) else 0.0)
+
+    dropped = {}
+    for candidate in sorted(candidates, key=score):
+        if tokens <= budget:
+            break
+        owner, records, record, text, _ = candidate
+        dropped.setdefault(id(records), (owner, records, set()))[2].add(id(record))
+        tokens -= estimate_tokens(text) + 1
+
+    for owner, records, doomed in dropped.values():
+        records[:] = [record for record in records if id(record) not in doomed]
+        if owner is not None:
+            owner["omitted"] = owner.get("omitted", 0) + len(doomed)
+    return value
+
+
+def compact(result, budget=None, query=None):
+    """Compact a tool result for the LLM context
+
+    Narrative, metadata and Bundle wrappers are dropped (the "pruned"
+    projection; compact records pass through), codings are deduplicated,
+    repeated observations are collapsed, and with a budget the lowest-ranked
+    records are dropped until the result fits (fit_budget).
+    """
+    compacted = collapse_observations(dedupe_codings(project(result, "pruned")))
+    if budget:
+        compacted = fit_budget(compacted, budget, query)
+    return compacted
+
+
+def compact_text(text, budget=None, query=None):
+    """Compact a JSON tool result; returns (text, stats). Text that is not JSON is returned unchanged."""
+    try:
+        result = json.loads(text)
+    except ValueError:
+        result = None
+    compacted = text
+    if isinstance(result, (dict, list)) and not (isinstance(result, dict) and "error" in result):
+        compacted = json.dumps(compact(result, budget, query), separators=(",", ":"))
+    stats = {
+        "tokens_in": estimate_tokens(text),
+        "tokens": estimate_tokens(compacted),
+    }
+    stats["saved_tokens"] = stats["tokens_in"] - stats["tokens"]
+    return compacted, stats
+
+
+class CompactionStats:
+    """Running totals of tokens before and after compaction"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.tokens_in = 0
+        self.tokens = 0
+
+    def record(self, stats):
+        with self._lock:
+            self.calls += 1
+            self.tokens_in += stats["tokens_in"]
+            self.tokens += stats["tokens"]
+
+    def summary(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "tokens_in": self.tokens_in,
+                "tokens": self.tokens,
+                "saved_tokens": self.tokens_in - self.tokens,
+                "reduction": round(1 - self.tokens / self.tokens_in, 3) if self.tokens_in else 0.0,
+            }
+
+
+class ContextCompactor:
+    """Compacts the results of FHIR read tools to a token budget before the agent sees them
+
+    The budget applies to each tool result on its own; records are ranked
+    against the query being answered.
+    """
+
+    def __init__(self, budget, query=None, stats=None):
+        self.budget = budget
+        self.query = query
+        self.stats = stats or CompactionStats()
+
+    def wrap(self, tools):
+        """Return the tools with read results compacted through this compactor"""
+        return [CompactedTool(tool, self) if tool.tool_name in READ_TOOLS else tool for tool in tools]
+
+    def compact_result(self, result):
+        if not result or result.get("status") != "success":
+            return result
+        content = []
+        for block in result.get("content", []):
+            if "text" in block:
+                text, stats = compact_text(block["text"], self.budget, self.query)
+                self.stats.record(stats)
+                block = dict(block, text=text)
+            content.append(block)
+        return dict(result, content=content)
+
+
+class CompactedTool(DelegatingTool):
+    """An MCP agent tool whose results go through a ContextCompactor"""
+
+    def __init__(self, tool, compactor):
+        super().__init__(tool)
+        self.compactor = compactor
+
+    async def call(self, tool_use, invocation_state, **kwargs):
+        return self.compactor.compact_result(await super().call(tool_use, invocation_state, **kwargs))
@@ -0,0 +1,207 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from email.utils import format_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class CacheEntry:
+    """One cached GET response plus the validators needed to revalidate it"""
+
+    def __init__(self, url, response, resource_type=None, patient_id=None):
+        self.url = url
+        self.content = response.content
+        self.headers = dict(response.headers)
+        self.resource_type = resource_type
+        self.patient_id = patient_id
+        self.stored_at = time.time()
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+
+        # Fall back to the resource's own version metadata when the server
+        # does not send HTTP validators. Only for single-resource reads: a
+        # Bundle's meta describes the Bundle, not the resources in it.
+        if not self.etag or not self.last_modified:
+            try:
+                body = json.loads(self.content)
+            except ValueError:
+                body = None
+            single = isinstance(body, dict) and body.get("resourceType") not in (None, "Bundle")
+            meta = (body.get("meta") or {}) if single else {}
+            if not self.etag and meta.get("versionId"):
+                self.etag = f'W/"{meta["versionId"]}"'
+            if not self.last_modified and meta.get("lastUpdated"):
+                self.last_modified = _http_date(meta["lastUpdated"])
+
+    def validators(self):
+        """Conditional request headers for revalidating this entry"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_response(self):
+        """Rebuild a requests.Response so callers cannot tell a hit from a fetch"""
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self.content
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.url = self.url
+        response.encoding = "utf-8"
+        return response
+
+
+class ResourceCache:
+    """Bounded LRU + TTL cache of FHIR GET responses
+
+    Entries are keyed by the full request URL (server, path and query) and
+    tagged with the resource type and patient they belong to, so writes can
+    invalidate everything cached for the affected patient. Entries older than
+    ttl seconds are revalidated with If-None-Match / If-Modified-Since
+    instead of being downloaded again.
+    """
+
+    def __init__(self, max_entries=512, ttl=60):
+        """
+        Args:
+            max_entries: Maximum number of cached responses (least recently used are evicted)
+            ttl: Seconds an entry is served without contacting the server
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self, url):
+        """Return (entry, fresh) for url; entry is None on a miss"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(url)
+            fresh = time.time() - entry.stored_at < self.ttl
+            if fresh:
+                self.hits += 1
+            return entry, fresh
+
+    def store(self, url, response, base_url):
+        """Cache a successful GET response"""
+        resource_type, patient_id = tags_for_url(url, base_url)
+        entry = CacheEntry(url, response, resource_type, patient_id)
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def mark_revalidated(self, entry):
+        """Record a 304 Not Modified: the entry is fresh again"""
+        with self._lock:
+            entry.stored_at = time.time()
+            self.revalidated += 1
+
+    def get_entry(self, url):
+        with self._lock:
+            return self._entries.get(url)
+
+    def invalidate(self, patient_id=None, resource_type=None, url=None):
+        """Drop entries for a patient, and searches over resource_type that are not tied to one
+
+        Entries that carry no patient tag (e.g. opaque paging links) are always dropped.
+        """
+        with self._lock:
+            doomed = []
+            for key, entry in self._entries.items():
+                if key == url:
+                    doomed.append(key)
+                elif entry.patient_id is None:
+                    if patient_id is None or entry.resource_type in (None, resource_type):
+                        doomed.append(key)
+                elif patient_id is not None and entry.patient_id == patient_id:
+                    doomed.append(key)
+                elif patient_id is None and entry.resource_type == resource_type:
+                    doomed.append(key)
+            for key in doomed:
+                del self._entries[key]
+            self.invalidations += len(doomed)
+            return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+def tags_for_url(url, base_url):
+    """Work out (resource_type, patient_id) for a FHIR request URL"""
+    parts = urlsplit(url)
+    base_path = urlsplit(base_url).path.rstrip("/")
+    path = parts.path[len(base_path):] if parts.path.startswith(base_path) else parts.path
+    segments = [s for s in path.split("/") if s]
+    query = parse_qs(parts.query)
+
+    resource_type = segments[0] if segments and segments[0][:1].isupper() else None
+    patient_id = None
+    if resource_type == "Patient":
+        if len(segments) > 1:
+            patient_id = segments[1]
+        elif query.get("_id"):
+            patient_id = query["_id"][0]
+    else:
+        for param in ("patient", "subject"):
+            if query.get(param):
+                patient_id = query[param][0].split("/")[-1]
+                break
+    if patient_id is not None and "," in patient_id:
+        # A multi-patient search; untagged entries are dropped by any write to their type
+        patient_id = None
+    return resource_type, patient_id
+
+
+def patient_id_for_resource(resource):
+    """Return the patient a resource belongs to, if it says"""
+    if not isinstance(resource, dict):
+        return None
+    if resource.get("resourceType") == "Patient":
+        return resource.get("id")
+    for field in ("subject", "patient"):
+        reference = (resource.get(field) or {}).get("reference", "")
+        if reference.startswith("Patient/"):
+            return reference.split("/", 1)[1]
+    return None
+
+
+def _http_date(instant):
+    """Convert a FHIR instant to an HTTP-date for If-Modified-Since"""
+    try:
+        return format_datetime(datetime.fromisoformat(instant.replace("Z", "+00:00")).astimezone(timezone.utc), usegmt=True)
+    except ValueError:
+        return None
@@ -1,16 +1,56 @@
 #!/usr/bin/env python3
 
 import json
+import logging
+import os
+import sys
 from mcp.server.fastmcp import FastMCP
-from FHIRClient import FHIRClient
+from fhir_projection import COMPACT_ELEMENTS, ProjectionStats, render
+from fhir_sync import SyncWorker
+from server_registry import registry_from_env
 
-# Initialize FHIR client and MCP server
-fhir_client = FHIRClient()
+# stdout carries the MCP protocol, so diagnostics go to stderr
+logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+logger = logging.getLogger("fhir_mcp_server")
+
+# Initialize FHIR clients and MCP server
+# Every named server gets its own client (connection pool, cache and optional
+# local store) for the whole server process. Tools take a server argument,
+# filled in per request by the host application, and reads are routed by the
+# registry's health and latency probes when FHIR_MIRROR is set. The registry
+# comes from the environment inherited from the host, so both agree on names.
+registry = registry_from_env()
+projection_stats = ProjectionStats()
+# Change sync (FHIR_SYNC_INTERVAL): the API process syncs its own clients, so
+# this process polls for the response caches and $everything snapshots it
+# holds in memory. Its high-water marks stay in memory too (everything cached
+# here was read after it started), leaving FHIR_SYNC_STATE to the API process.
+sync_interval = float(os.getenv("FHIR_SYNC_INTERVAL", "0"))
+sync_workers = {
+    name: SyncWorker(endpoint.client, interval=sync_interval)
+    for name, endpoint in registry.endpoints.items()
+} if sync_interval > 0 else {}
 mcp = FastMCP("FHIR Medical Assistant")
 
+def _client(server, read=True):
+    """Async client for the server a tool call should use (writes never leave the named server)"""
+    return registry.route(server or None, read=read).async_client
+
+def _elements(resource_type, verbosity):
+    """Server-side _elements filter matching a compact projection"""
+    return COMPACT_ELEMENTS[resource_type] if verbosity == "compact" else None
+
+def _render(tool_name, result, verbosity):
+    """Project a client result for the agent and report the bytes and tokens saved"""
+    text, stats = render(result, verbosity)
+    projection_stats.record(stats)
+    logger.info("%s: %s bytes -> %s bytes (%s tokens saved, verbosity=%s)",
+                tool_name, stats["raw_bytes"], stats["bytes"], stats["saved_tokens"], stats["verbosity"])
+    return text
+
 # PATIENT TOOLS
 @mcp.tool()
-def create_patient(given_name: str, family_name: str, gender: str, birth_date: str) -> str:
+async def create_patient(given_name: str, family_name: str, gender: str, birth_date: str, server: str = "") -> str:
     """Create a new patient record in the FHIR server with basic demographic information
     
     Args:
@@ -19,44 +59,46 @@ def create_patient(given_name: str, family_name: str, gender: str, birth_date: s
         gender: Patient's gender (male/female/other)
         birth_date: Patient's birth date in YYYY-MM-DD format
     """
-    result = fhir_client.create_patient(given_name, family_name, gender, birth_date)
+    result = await _client(server, read=False).create_patient(given_name, family_name, gender, birth_date)
     return json.dumps(result, indent=2)
 
 @mcp.tool()
-def list_patients(count: int = 10) -> str:
+async def list_patients(count: int = 10, verbosity: str = "compact", server: str = "") -> str:
     """Retrieve a list of patients from the FHIR server with their basic information
     
     Args:
         count: Maximum number of patients to return (default: 10, must be positive)
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
     """
     if count <= 0:
         return json.dumps({"error": "Count must be a positive integer"}, indent=2)
-    result = fhir_client.list_patients(count)
-    return json.dumps(result, indent=2)
+    result = await _client(server).list_patients(count, elements=_elements("Patient", verbosity))
+    return _render("list_patients", result, verbosity)
 
 @mcp.tool()
-def get_patient(patient_id: str) -> str:
+async def get_patient(patient_id: str, verbosity: str = "compact", server: str = "") -> str:
     """Retrieve detailed information for a specific patient using their unique ID
     
     Args:
         patient_id: Unique FHIR patient identifier
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
     """
-    result = fhir_client.get_patient(patient_id)
-    return json.dumps(result, indent=2)
+    result = await _client(server).get_patient(patient_id, elements=_elements("Patient", verbosity))
+    return _render("get_patient", result, verbosity)
 
 @mcp.tool()
-def delete_patient(patient_id: str) -> str:
+async def delete_patient(patient_id: str, server: str = "") -> str:
     """Remove a patient record from the FHIR server using their unique ID
     
     Args:
         patient_id: Unique FHIR patient identifier to delete
     """
-    result = fhir_client.delete_patient(patient_id)
+    result = await _client(server, read=False).delete_patient(patient_id)
     return json.dumps(result, indent=2)
 
 # CONDITION TOOLS
 @mcp.tool()
-def create_condition(condition_json: str) -> str:
+async def create_condition(condition_json: str, server: str = "") -> str:
     """Create a new medical condition using complete FHIR R4 JSON structure
     
     Args:
@@ -79,23 +121,42 @@ def create_condition(condition_json: str) -> str:
     """
     try:
         condition_data = json.loads(condition_json)
-        result = fhir_client.create_condition(condition_data)
+        result = await _client(server, read=False).create_condition(condition_data)
         return json.dumps(result, indent=2)
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON format"}, indent=2)
 
 @mcp.tool()
-def get_patient_conditions(patient_id: str) -> str:
+async def get_patient_conditions(patient_id: str, max_resources: int = 200, verbosity: str = "compact",
+                                 status: str = "", code: str = "", category: str = "", date_from: str = "",
+                                 date_to: str = "", sort: str = "", count: int | None = None, summary_count: bool = False,
+                                 server: str = "") -> str:
     """Retrieve all medical conditions and diagnoses associated with a specific patient
     
+    Filters are applied by the FHIR server, so narrow the search instead of fetching everything.
+    
     Args:
         patient_id: Unique FHIR patient identifier
+        max_resources: Maximum number of records to return across all result pages (default: 200)
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
+        status: Only conditions with this clinical status, e.g. "active" or "resolved" (comma-separated for several)
+        code: Only this code, "code" or "system|code" (e.g. "http://snomed.info/sct|44054006"; comma-separated for several)
+        category: Only this category, e.g. "problem-list-item" or "encounter-diagnosis"
+        date_from: Earliest onset date, YYYY-MM-DD (inclusive)
+        date_to: Latest onset date, YYYY-MM-DD (inclusive)
+        sort: Sort order, e.g. "-onset-date" for most recent first
+        count: Return only this many records, e.g. 5 with sort for the 5 most recent
+        summary_count: Return only how many records match, without the records
     """
-    result = fhir_client.get_patient_conditions(patient_id)
-    return json.dumps(result, indent=2)
+    result = await _client(server).get_patient_conditions(
+        patient_id, max_resources=max_resources, elements=_elements("Condition", verbosity), status=status or None,
+        code=code or None, category=category or None, date_from=date_from or None, date_to=date_to or None,
+        sort=sort or None, count=count, summary_count=summary_count
+    )
+    return _render("get_patient_conditions", result, verbosity)
 
 @mcp.tool()
-def update_condition(condition_id: str, condition_json: str) -> str:
+async def update_condition(condition_id: str, condition_json: str, server: str = "") -> str:
     """Update an existing medical condition using complete FHIR R4 JSON structure
     
     Args:
@@ -106,24 +167,24 @@ def update_condition(condition_id: str, condition_json: str) -> str:
     """
     try:
         condition_data = json.loads(condition_json)
-        result = fhir_client.update_condition(condition_id, condition_data)
+        result = await _client(server, read=False).update_condition(condition_id, condition_data)
         return json.dumps(result, indent=2)
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON format"}, indent=2)
 
 @mcp.tool()
-def delete_condition(condition_id: str) -> str:
+async def delete_condition(condition_id: str, server: str = "") -> str:
     """Remove a specific medical condition from the FHIR server using its unique ID
     
     Args:
         condition_id: Unique FHIR condition identifier to delete
     """
-    result = fhir_client.delete_condition(condition_id)
+    result = await _client(server, read=False).delete_condition(condition_id)
     return json.dumps(result, indent=2)
 
 # MEDICATION TOOLS
 @mcp.tool()
-def create_medication(medication_json: str) -> str:
+async def create_medication(medication_json: str, server: str = "") -> str:
     """Create a new medication request using complete FHIR R4 JSON structure
     
     Args:
@@ -148,23 +209,42 @@ def create_medication(medication_json: str) -> str:
     """
     try:
         medication_data = json.loads(medication_json)
-        result = fhir_client.create_medication(medication_data)
+        result = await _client(server, read=False).create_medication(medication_data)
         return json.dumps(result, indent=2)
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON format"}, indent=2)
 
 @mcp.tool()
-def get_patient_medications(patient_id: str) -> str:
+async def get_patient_medications(patient_id: str, max_resources: int = 200, verbosity: str = "compact",
+                                  status: str = "", code: str = "", category: str = "", date_from: str = "",
+                                  date_to: str = "", sort: str = "", count: int | None = None, summary_count: bool = False,
+                                  server: str = "") -> str:
     """Retrieve all medication prescriptions and requests for a specific patient
     
+    Filters are applied by the FHIR server, so narrow the search instead of fetching everything.
+    
     Args:
         patient_id: Unique FHIR patient identifier
+        max_resources: Maximum number of records to return across all result pages (default: 200)
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
+        status: Only requests with this status, e.g. "active" for current medications, or "stopped", "completed" (comma-separated for several)
+        code: Only this medication code, "code" or "system|code" (e.g. RxNorm; comma-separated for several)
+        category: Only this category, e.g. "outpatient" or "inpatient"
+        date_from: Earliest authored date, YYYY-MM-DD (inclusive)
+        date_to: Latest authored date, YYYY-MM-DD (inclusive)
+        sort: Sort order, e.g. "-authoredon" for most recent first
+        count: Return only this many records, e.g. 5 with sort for the 5 most recent
+        summary_count: Return only how many records match, without the records
     """
-    result = fhir_client.get_patient_medications(patient_id)
-    return json.dumps(result, indent=2)
+    result = await _client(server).get_patient_medications(
+        patient_id, max_resources=max_resources, elements=_elements("MedicationRequest", verbosity), status=status or None,
+        code=code or None, category=category or None, date_from=date_from or None, date_to=date_to or None,
+        sort=sort or None, count=count, summary_count=summary_count
+    )
+    return _render("get_patient_medications", result, verbosity)
 
 @mcp.tool()
-def update_medication(medication_id: str, medication_json: str) -> str:
+async def update_medication(medication_id: str, medication_json: str, server: str = "") -> str:
     """Update an existing medication request using complete FHIR R4 JSON structure
     
     Args:
@@ -175,24 +255,24 @@ def update_medication(medication_id: str, medication_json: str) -> str:
     """
     try:
         medication_data = json.loads(medication_json)
-        result = fhir_client.update_medication(medication_id, medication_data)
+        result = await _client(server, read=False).update_medication(medication_id, medication_data)
         return json.dumps(result, indent=2)
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON format"}, indent=2)
 
 @mcp.tool()
-def delete_medication(medication_id: str) -> str:
+async def delete_medication(medication_id: str, server: str = "") -> str:
     """Remove a specific medication prescription from the FHIR server using its unique ID
     
     Args:
         medication_id: Unique FHIR medication request identifier to delete
     """
-    result = fhir_client.delete_medication(medication_id)
+    result = await _client(server, read=False).delete_medication(medication_id)
     return json.dumps(result, indent=2)
 
 # OBSERVATION TOOLS
 @mcp.tool()
-def create_observation(observation_json: str) -> str:
+async def create_observation(observation_json: str, server: str = "") -> str:
     """Create a new clinical observation using complete FHIR R4 JSON structure
     
     Args:
@@ -220,23 +300,42 @@ def create_observation(observation_json: str) -> str:
     """
     try:
         observation_data = json.loads(observation_json)
-        result = fhir_client.create_observation(observation_data)
+        result = await _client(server, read=False).create_observation(observation_data)
         return json.dumps(result, indent=2)
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON format"}, indent=2)
 
 @mcp.tool()
-def get_patient_observations(patient_id: str) -> str:
+async def get_patient_observations(patient_id: str, max_resources: int = 200, verbosity: str = "compact",
+                                   status: str = "", code: str = "", category: str = "", date_from: str = "",
+                                   date_to: str = "", sort: str = "", count: int | None = None, summary_count: bool = False,
+                                   server: str = "") -> str:
     """Retrieve all clinical observations and measurements for a specific patient
     
+    Filters are applied by the FHIR server, so narrow the search instead of fetching everything.
+    
     Args:
         patient_id: Unique FHIR patient identifier
+        max_resources: Maximum number of records to return across all result pages (default: 200)
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
+        status: Only observations with this status, e.g. "final" (comma-separated for several)
+        code: Only this code, "code" or "system|code" (e.g. "http://loinc.org|4548-4" for HbA1c; comma-separated for several)
+        category: Only this category, e.g. "laboratory", "vital-signs" or "social-history"
+        date_from: Earliest effective date, YYYY-MM-DD (inclusive)
+        date_to: Latest effective date, YYYY-MM-DD (inclusive)
+        sort: Sort order, e.g. "-date" for most recent first
+        count: Return only this many records, e.g. 5 with sort for the 5 most recent
+        summary_count: Return only how many records match, without the records
     """
-    result = fhir_client.get_patient_observations(patient_id)
-    return json.dumps(result, indent=2)
+    result = await _client(server).get_patient_observations(
+        patient_id, max_resources=max_resources, elements=_elements("Observation", verbosity), status=status or None,
+        code=code or None, category=category or None, date_from=date_from or None, date_to=date_to or None,
+        sort=sort or None, count=count, summary_count=summary_count
+    )
+    return _render("get_patient_observations", result, verbosity)
 
 @mcp.tool()
-def update_observation(observation_id: str, observation_json: str) -> str:
+async def update_observation(observation_id: str, observation_json: str, server: str = "") -> str:
     """Update an existing clinical observation using complete FHIR R4 JSON structure
     
     Args:
@@ -254,33 +353,147 @@ def update_observation(observation_id: str, observation_json: str) -> str:
     """
     try:
         observation_data = json.loads(observation_json)
-        result = fhir_client.update_observation(observation_id, observation_data)
+        result = await _client(server, read=False).update_observation(observation_id, observation_data)
         return json.dumps(result, indent=2)
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON format"}, indent=2)
 
 @mcp.tool()
-def delete_observation(observation_id: str) -> str:
+async def delete_observation(observation_id: str, server: str = "") -> str:
     """Remove a specific clinical observation from the FHIR server using its unique ID
     
     Args:
         observation_id: Unique FHIR observation identifier to delete
     """
-    result = fhir_client.delete_observation(observation_id)
+    result = await _client(server, read=False).delete_observation(observation_id)
     return json.dumps(result, indent=2)
 
 # SUMMARY TOOL
 @mcp.tool()
-def get_patient_summary(patient_id: str) -> str:
+async def get_patient_summary(patient_id: str, verbosity: str = "compact", server: str = "") -> str:
     """Generate a comprehensive patient summary including demographics, conditions, medications, and observations
     
     Args:
         patient_id: Unique FHIR patient identifier
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
+    """
+    result = await _client(server).get_patient_summary(
+        patient_id, elements=COMPACT_ELEMENTS if verbosity == "compact" else None
+    )
+    return _render("get_patient_summary", result, verbosity)
+
+@mcp.tool()
+async def get_patient_summaries(patient_ids: str, verbosity: str = "compact", server: str = "") -> str:
+    """Generate summaries for several patients at once, e.g. everyone on a care team's list
+    
+    Much cheaper than calling get_patient_summary per patient. Patients whose data could not be
+    fetched are listed under "failed" while the others are still returned.
+    
+    Args:
+        patient_ids: Comma-separated FHIR patient identifiers
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
+    """
+    ids = [patient_id.strip() for patient_id in patient_ids.split(",") if patient_id.strip()]
+    if not ids:
+        return json.dumps({"error": "patient_ids must list at least one patient id"}, indent=2)
+    result = await _client(server).get_patient_summaries(
+        ids, elements=COMPACT_ELEMENTS if verbosity == "compact" else None
+    )
+    return _render("get_patient_summaries", result, verbosity)
+
+@mcp.tool()
+async def get_patient_everything(patient_id: str, only_changes: bool = False, verbosity: str = "compact", server: str = "") -> str:
+    """Fetch every resource on record for a patient in one operation, grouped by resource type
+    
+    Uses the FHIR Patient/$everything operation (or parallel per-type searches on
+    servers without it). Calling it again for the same patient only downloads
+    what changed since the previous call and merges it into the earlier result.
+    
+    Args:
+        patient_id: Unique FHIR patient identifier
+        only_changes: Return just the resources that changed since the previous call
+            instead of the full merged record
+        verbosity: "compact" (slim records, default), "pruned" (FHIR JSON without narrative/metadata) or "full" (raw server JSON)
+    """
+    result = await _client(server).get_patient_everything(patient_id, changes_only=only_changes)
+    return _render("get_patient_everything", result, verbosity)
+
+# TRANSACTION TOOL
+@mcp.tool()
+async def create_patient_record(record_json: str, server: str = "") -> str:
+    """Create a new patient together with their conditions, medications and observations in a single call
+    
+    Prefer this over create_patient followed by one create_* call per resource:
+    everything is submitted as one FHIR transaction Bundle and the new patient
+    is linked automatically.
+    
+    Args:
+        record_json: JSON string of the form
+        {
+            "given_name": "Jane",
+            "family_name": "Doe",
+            "gender": "female",
+            "birth_date": "1980-04-12",
+            "conditions": ["Type 2 diabetes", { ...FHIR R4 Condition... }],
+            "medications": ["Metformin 500 mg twice daily", { ...FHIR R4 MedicationRequest... }],
+            "observations": ["Glucose 140 mg/dL", { ...FHIR R4 Observation... }]
+        }
+        List items may be plain text or full FHIR resources; subject is filled in for you.
+        A full FHIR R4 Patient resource may be passed as "patient" instead of the name fields.
+    
+    Returns the new Patient ID and the ID of every created resource.
     """
-    result = fhir_client.get_patient_summary(patient_id)
-    return json.dumps(result, indent=2) 
+    try:
+        record = json.loads(record_json)
+    except json.JSONDecodeError:
+        return json.dumps({"error": "Invalid JSON format"}, indent=2)
+
+    patient = record.get("patient")
+    if patient is None:
+        if not record.get("given_name") or not record.get("family_name"):
+            return json.dumps({"error": "given_name and family_name are required"}, indent=2)
+        patient = {
+            "resourceType": "Patient",
+            "name": [{"family": record["family_name"], "given": [record["given_name"]]}]
+        }
+        if record.get("gender"):
+            patient["gender"] = record["gender"].lower()
+        if record.get("birth_date"):
+            patient["birthDate"] = record["birth_date"]
+
+    result = await _client(server, read=False).create_patient_record(
+        patient,
+        conditions=record.get("conditions"),
+        medications=record.get("medications"),
+        observations=record.get("observations"),
+    )
+    return json.dumps(result, indent=2)
+
+# DIAGNOSTICS
+@mcp.tool()
+def get_client_stats() -> str:
+    """Report FHIR client diagnostics such as server health, connection pool reuse per host and cache hit rate"""
+    result = {
+        "registry": registry.stats(),
+        "servers": {
+            name: {
+                "base_url": endpoint.base_url,
+                "pool": endpoint.client.pool_stats(),
+                "cache": endpoint.client.cache.stats() if endpoint.client.cache else None,
+                "store": endpoint.client.store.stats() if endpoint.client.store else None,
+                "capabilities": endpoint.client.capabilities(),
+            }
+            for name, endpoint in registry.endpoints.items()
+        },
+        "projection": projection_stats.summary(),
+        "sync": {name: worker.stats() for name, worker in sync_workers.items()},
+    }
+    return json.dumps(result, indent=2)
 
 if __name__ == "__main__":
     # Initialize and run the server
-    print("starting server")
+    logger.info("starting server")
+    registry.start()
+    for worker in sync_workers.values():
+        worker.start()
     mcp.run(transport='stdio')
\ No newline at end of file
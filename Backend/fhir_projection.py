@@ -0,0 +1,263 @@
+import json
+import threading
+
+VERBOSITY_LEVELS = ("compact", "pruned", "full")
+
+# Elements requested with _elements when a compact projection will be made;
+# servers that ignore _elements still work because projection is local too
+COMPACT_ELEMENTS = {
+    "Patient": ["id", "name", "gender", "birthDate", "deceasedBoolean", "deceasedDateTime", "address"],
+    "Condition": ["id", "code", "clinicalStatus", "verificationStatus", "category", "onsetDateTime",
+                  "onsetPeriod", "abatementDateTime", "recordedDate", "subject"],
+    "MedicationRequest": ["id", "status", "intent", "medicationCodeableConcept", "medicationReference",
+                          "authoredOn", "dosageInstruction", "subject"],
+    "Observation": ["id", "status", "category", "code", "effectiveDateTime", "effectivePeriod", "issued",
+                    "valueQuantity", "valueCodeableConcept", "valueString", "valueBoolean", "valueInteger",
+                    "component", "interpretation", "referenceRange", "subject"],
+}
+
+# Fields that never help answer a clinical question
+PRUNED_FIELDS = ("text", "meta", "link", "implicitRules", "language", "contained", "extension",
+                 "modifierExtension", "identifier")
+
+
+def concept_text(concept):
+    """Collapse a CodeableConcept to a single display string"""
+    if not concept:
+        return None
+    if concept.get("text"):
+        return concept["text"]
+    for coding in concept.get("coding", []):
+        if coding.get("display") or coding.get("code"):
+            return coding.get("display") or coding.get("code")
+    return None
+
+
+def quantity_text(quantity):
+    if not quantity or quantity.get("value") is None:
+        return None
+    unit = quantity.get("unit") or quantity.get("code") or ""
+    comparator = quantity.get("comparator", "")
+    return f"{comparator}{quantity['value']} {unit}".strip()
+
+
+def value_text(element):
+    """Render the value[x] of an Observation or component as text"""
+    if "valueQuantity" in element:
+        return quantity_text(element["valueQuantity"])
+    if "valueCodeableConcept" in element:
+        return concept_text(element["valueCodeableConcept"])
+    for key in ("valueString", "valueBoolean", "valueInteger", "valueDateTime", "valueTime"):
+        if key in element:
+            return element[key]
+    return None
+
+
+def range_text(ranges):
+    for reference_range in ranges or []:
+        if reference_range.get("text"):
+            return reference_range["text"]
+        low = quantity_text(reference_range.get("low"))
+        high = quantity_text(reference_range.get("high"))
+        if low or high:
+            return f"{low or ''} - {high or ''}".strip(" -")
+    return None
+
+
+def _compact_patient(resource):
+    names = resource.get("name") or [{}]
+    name = names[0]
+    full_name = name.get("text") or " ".join(name.get("given", []) + [name.get("family", "")]).strip()
+    address = (resource.get("address") or [{}])[0]
+    return {
+        "id": resource.get("id"),
+        "name": full_name or None,
+        "gender": resource.get("gender"),
+        "birthDate": resource.get("birthDate"),
+        "deceased": resource.get("deceasedDateTime") or resource.get("deceasedBoolean"),
+        "city": address.get("city"),
+        "state": address.get("state"),
+    }
+
+
+def _compact_condition(resource):
+    onset = resource.get("onsetDateTime") or (resource.get("onsetPeriod") or {}).get("start")
+    return {
+        "id": resource.get("id"),
+        "condition": concept_text(resource.get("code")),
+        "clinicalStatus": concept_text(resource.get("clinicalStatus")),
+        "verificationStatus": concept_text(resource.get("verificationStatus")),
+        "onset": onset,
+        "abatement": resource.get("abatementDateTime"),
+        "recorded": resource.get("recordedDate"),
+    }
+
+
+def _compact_medication(resource):
+    medication = concept_text(resource.get("medicationCodeableConcept"))
+    if medication is None:
+        medication = (resource.get("medicationReference") or {}).get("display")
+    dosage = [d.get("text") for d in resource.get("dosageInstruction", []) if d.get("text")]
+    return {
+        "id": resource.get("id"),
+        "medication": medication,
+        "status": resource.get("status"),
+        "intent": resource.get("intent"),
+        "authoredOn": resource.get("authoredOn"),
+        "dosage": "; ".join(dosage) or None,
+    }
+
+
+def _compact_observation(resource):
+    effective = resource.get("effectiveDateTime") or (resource.get("effectivePeriod") or {}).get("start") \
+        or resource.get("issued")
+    record = {
+        "id": resource.get("id"),
+        "observation": concept_text(resource.get("code")),
+        "value": value_text(resource),
+        "date": effective,
+        "status": resource.get("status"),
+        "category": concept_text((resource.get("category") or [None])[0]),
+        "interpretation": concept_text((resource.get("interpretation") or [None])[0]),
+        "referenceRange": range_text(resource.get("referenceRange")),
+    }
+    components = [
+        {"name": concept_text(c.get("code")), "value": value_text(c)}
+        for c in resource.get("component", [])
+    ]
+    if components:
+        record["components"] = components
+    return record
+
+
+COMPACT_PROJECTIONS = {
+    "Patient": _compact_patient,
+    "Condition": _compact_condition,
+    "MedicationRequest": _compact_medication,
+    "Observation": _compact_observation,
+}
+
+
+def prune(value):
+    """Drop narrative, metadata and empty values from a FHIR structure"""
+    if isinstance(value, dict):
+        pruned = {}
+        for key, item in value.items():
+            if key in PRUNED_FIELDS:
+                continue
+            item = prune(item)
+            if item not in (None, "", [], {}):
+                pruned[key] = item
+        return pruned
+    if isinstance(value, list):
+        return [prune(item) for item in value]
+    return value
+
+
+def project_resource(resource, verbosity="compact"):
+    """Project a single FHIR resource to the requested verbosity"""
+    if verbosity == "full" or not isinstance(resource, dict):
+        return resource
+    if verbosity == "compact" and resource.get("resourceType") in COMPACT_PROJECTIONS:
+        record = COMPACT_PROJECTIONS[resource["resourceType"]](resource)
+        return {key: value for key, value in record.items() if value not in (None, "", [])}
+    return prune(resource)
+
+
+def project(result, verbosity="compact"):
+    """Project a client result: a resource, a Bundle, an error, or a dict of those"""
+    if verbosity == "full" or not isinstance(result, dict):
+        return result
+    if "error" in result:
+        return result
+    if result.get("resourceType") == "Bundle":
+        records = [
+            project_resource(entry["resource"], verbosity)
+            for entry in result.get("entry", []) if "resource" in entry
+        ]
+        projected = {"total": result.get("total", len(records)), "count": len(records)}
+        if verbosity == "pruned":
+            projected["entry"] = records
+        else:
+            projected["records"] = records
+        return projected
+    if "resourceType" in result:
+        return project_resource(result, verbosity)
+    return {key: project(value, verbosity) for key, value in result.items()}
+
+
+def to_rows(bundle):
+    """Flatten a search Bundle into table rows of compact records
+
+    Nested values (Observation components) are joined into a single string
+    so every row is flat.
+    """
+    rows = []
+    for entry in bundle.get("entry", []):
+        if "resource" not in entry:
+            continue
+        record = project_resource(entry["resource"], "compact")
+        if "components" in record:
+            record["components"] = "; ".join(
+                f"{c['name']}: {c['value']}" for c in record["components"] if c.get("name")
+            )
+        rows.append(record)
+    return rows
+
+
+def estimate_tokens(text):
+    """Rough token count for LLM context budgeting (about four characters per token)"""
+    return (len(text) + 3) // 4
+
+
+def render(result, verbosity="compact"):
+    """Serialize a client result for an MCP tool response
+
+    Returns (text, stats) where stats compares the output against the raw
+    indented JSON the tools used to return.
+    """
+    if verbosity not in VERBOSITY_LEVELS:
+        verbosity = "compact"
+    raw = json.dumps(result, indent=2)
+    if verbosity == "full":
+        text = raw
+    else:
+        text = json.dumps(project(result, verbosity), separators=(",", ":"))
+
+    stats = {
+        "verbosity": verbosity,
+        "raw_bytes": len(raw),
+        "bytes": len(text),
+        "saved_bytes": len(raw) - len(text),
+        "saved_tokens": estimate_tokens(raw) - estimate_tokens(text),
+    }
+    return text, stats
+
+
+class ProjectionStats:
+    """Running totals of bytes and tokens saved by projection"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.raw_bytes = 0
+        self.bytes = 0
+        self.saved_tokens = 0
+
+    def record(self, stats):
+        with self._lock:
+            self.calls += 1
+            self.raw_bytes += stats["raw_bytes"]
+            self.bytes += stats["bytes"]
+            self.saved_tokens += stats["saved_tokens"]
+
+    def summary(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "raw_bytes": self.raw_bytes,
+                "bytes": self.bytes,
+                "saved_bytes": self.raw_bytes - self.bytes,
+                "saved_tokens": self.saved_tokens,
+                "reduction": round(1 - self.bytes / self.raw_bytes, 3) if self.raw_bytes else 0.0,
+            }
@@ -0,0 +1,264 @@
+import json
+import sqlite3
+import threading
+import time
+from fhir_cache import patient_id_for_resource
+
+# Resource types mirrored locally
+STORED_TYPES = ("Patient", "Condition", "MedicationRequest", "Observation")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    resource_type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    patient_id TEXT,
+    status TEXT,
+    effective TEXT,
+    last_updated TEXT,
+    stored_at REAL NOT NULL,
+    json TEXT NOT NULL,
+    PRIMARY KEY (resource_type, id)
+);
+CREATE INDEX IF NOT EXISTS idx_resources_patient ON resources (resource_type, patient_id);
+CREATE INDEX IF NOT EXISTS idx_resources_status ON resources (resource_type, status);
+CREATE INDEX IF NOT EXISTS idx_resources_effective ON resources (resource_type, effective);
+
+CREATE TABLE IF NOT EXISTS codes (
+    resource_type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    system TEXT,
+    code TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_codes_code ON codes (resource_type, code);
+CREATE INDEX IF NOT EXISTS idx_codes_resource ON codes (resource_type, id);
+
+-- When the complete set of a patient's resources of a type was last read from the server
+CREATE TABLE IF NOT EXISTS patient_fetches (
+    resource_type TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (resource_type, patient_id)
+);
+"""
+
+
+def resource_status(resource):
+    """The status a resource is searched by (clinicalStatus for Conditions)"""
+    if resource.get("resourceType") == "Condition":
+        for coding in (resource.get("clinicalStatus") or {}).get("coding", []):
+            if coding.get("code"):
+                return coding["code"]
+        return None
+    if resource.get("resourceType") == "Patient":
+        active = resource.get("active")
+        return None if active is None else ("active" if active else "inactive")
+    return resource.get("status")
+
+
+def resource_date(resource):
+    """The clinically relevant date of a resource, as a FHIR dateTime string"""
+    resource_type = resource.get("resourceType")
+    if resource_type == "Observation":
+        return resource.get("effectiveDateTime") or (resource.get("effectivePeriod") or {}).get("start") \
+            or resource.get("effectiveInstant") or resource.get("issued")
+    if resource_type == "Condition":
+        return resource.get("onsetDateTime") or (resource.get("onsetPeriod") or {}).get("start") \
+            or resource.get("recordedDate")
+    if resource_type == "MedicationRequest":
+        return resource.get("authoredOn")
+    if resource_type == "Patient":
+        return resource.get("birthDate")
+    return None
+
+
+def resource_codings(resource):
+    """Every (system, code) the resource is coded with"""
+    concept = resource.get("code") or resource.get("medicationCodeableConcept") or {}
+    return [(c.get("system"), c["code"]) for c in concept.get("coding", []) if c.get("code")]
+
+
+class ResourceStore:
+    """Embedded SQLite mirror of a FHIR server's Patient, Condition, MedicationRequest and Observation resources
+
+    Resources are stored whole (as JSON) next to indexed columns for the
+    patient they belong to, their codes, status and effective date. The store
+    also remembers when each patient's full set of a resource type was last
+    read from the server, which is what lets FHIRClient answer searches
+    locally while that read is younger than max_age.
+
+    write()/close() make it usable as a bulk_export store as well.
+    """
+
+    def __init__(self, path=":memory:", max_age=300, busy_timeout=30):
+        """
+        Args:
+            path: SQLite database file (":memory:" for a process-local store)
+            max_age: Seconds stored data is served without going back to the server
+            busy_timeout: Seconds a write waits for another process's write to finish
+        """
+        self.path = path
+        self.max_age = max_age
+        # The API and the MCP server process open the same file; WAL lets readers
+        # run alongside the one writer and busy_timeout makes writers queue
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    # WRITES
+    def upsert(self, resources):
+        """Insert or replace resources (any that are not a stored type are ignored)"""
+        now = time.time()
+        rows, codes, keys = [], [], []
+        for resource in resources:
+            resource_type, resource_id = resource.get("resourceType"), resource.get("id")
+            if resource_type not in STORED_TYPES or not resource_id:
+                continue
+            keys.append((resource_type, resource_id))
+            rows.append((
+                resource_type, resource_id, patient_id_for_resource(resource), resource_status(resource),
+                resource_date(resource), (resource.get("meta") or {}).get("lastUpdated"), now,
+                json.dumps(resource, separators=(",", ":")),
+            ))
+            codes.extend((resource_type, resource_id, system, code) for system, code in resource_codings(resource))
+        if not rows:
+            return 0
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM codes WHERE resource_type = ? AND id = ?", keys)
+            self._conn.executemany("INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.executemany("INSERT INTO codes VALUES (?, ?, ?, ?)", codes)
+        return len(rows)
+
+    def write(self, resource_type, resources):
+        self.upsert(resources)
+
+    def delete(self, resource_type, resource_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM codes WHERE resource_type = ? AND id = ?", (resource_type, resource_id))
+            cursor = self._conn.execute(
+                "DELETE FROM resources WHERE resource_type = ? AND id = ?", (resource_type, resource_id)
+            )
+            return cursor.rowcount
+
+    def replace_patient_resources(self, resource_type, patient_id, resources):
+        """Record the complete current set of a patient's resources of one type
+
+        Stored resources the server no longer returned are removed, and the
+        set is marked fresh.
+        """
+        self.upsert(resources)
+        keep = {resource.get("id") for resource in resources}
+        with self._lock, self._conn:
+            column = "id" if resource_type == "Patient" else "patient_id"
+            stored = [row[0] for row in self._conn.execute(
+                f"SELECT id FROM resources WHERE resource_type = ? AND {column} = ?", (resource_type, patient_id)
+            )]
+            gone = [(resource_type, resource_id) for resource_id in stored if resource_id not in keep]
+            self._conn.executemany("DELETE FROM codes WHERE resource_type = ? AND id = ?", gone)
+            self._conn.executemany("DELETE FROM resources WHERE resource_type = ? AND id = ?", gone)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO patient_fetches VALUES (?, ?, ?)", (resource_type, patient_id, time.time())
+            )
+
+    def invalidate_patient(self, patient_id, resource_type=None):
+        """Mark a patient's stored sets stale so the next read goes to the server"""
+        with self._lock, self._conn:
+            if resource_type:
+                self._conn.execute(
+                    "DELETE FROM patient_fetches WHERE patient_id = ? AND resource_type = ?", (patient_id, resource_type)
+                )
+            else:
+                self._conn.execute("DELETE FROM patient_fetches WHERE patient_id = ?", (patient_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+
+    # READS
+    def is_fresh(self, resource_type, patient_id, max_age=None):
+        """True if the patient's full set of resource_type was read from the server within max_age seconds"""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fetched_at FROM patient_fetches WHERE resource_type = ? AND patient_id = ?",
+                (resource_type, patient_id),
+            ).fetchone()
+        fresh = row is not None and time.time() - row[0] < max_age
+        self._count(fresh)
+        return fresh
+
+    def get(self, resource_type, resource_id, max_age=None):
+        """Return a stored resource if it was stored within max_age seconds, else None"""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT json, stored_at FROM resources WHERE resource_type = ? AND id = ?", (resource_type, resource_id)
+            ).fetchone()
+        fresh = row is not None and time.time() - row[1] < max_age
+        self._count(fresh)
+        return json.loads(row[0]) if fresh else None
+
+    def search(self, resource_type, patient_id=None, code=None, status=None, date_from=None, date_to=None,
+               limit=None):
+        """Query stored resources through the indexes, newest first
+
+        Args:
+            code: "code" or "system|code", or a list of accepted codes
+            status: Status, or a list of accepted statuses
+            date_from / date_to: Inclusive bounds on the effective date (FHIR date or dateTime prefixes)
+        """
+        sql = "SELECT r.json FROM resources r WHERE r.resource_type = ?"
+        args = [resource_type]
+        if patient_id is not None:
+            sql += " AND r.patient_id = ?"
+            args.append(patient_id)
+        if status:
+            statuses = [status] if isinstance(status, str) else list(status)
+            sql += f" AND r.status IN ({','.join('?' * len(statuses))})"
+            args.extend(statuses)
+        if date_from:
+            sql += " AND r.effective >= ?"
+            args.append(date_from)
+        if date_to:
+            # "2024-01-31" must include "2024-01-31T23:00:00Z"
+            sql += " AND r.effective <= ?"
+            args.append(date_to + "\uffff")
+        if code:
+            matches = []
+            for token in [code] if isinstance(code, str) else code:
+                system, _, value = token.rpartition("|")
+                matches.append("(c.code = ?" + (" AND c.system = ?" if system else "") + ")")
+                args.extend([value, system] if system else [value])
+            sql += " AND EXISTS (SELECT 1 FROM codes c WHERE c.resource_type = r.resource_type AND c.id = r.id" \
+                   f" AND ({' OR '.join(matches)}))"
+        sql += " ORDER BY r.effective DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with self._lock:
+            return [json.loads(row[0]) for row in self._conn.execute(sql, args)]
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT resource_type, COUNT(*) FROM resources GROUP BY resource_type"))
+            lookups = self.hits + self.misses
+            return {
+                "path": self.path,
+                "max_age": self.max_age,
+                "resources": counts,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,309 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from fhir_cache import patient_id_for_resource
+from fhir_store import STORED_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Statuses servers answer an unsupported interaction with
+UNSUPPORTED_STATUSES = (400, 404, 405, 501)
+
+# Serializes read-modify-write of a state file shared by several workers
+_state_file_lock = threading.Lock()
+
+
+class SyncWorker:
+    """Background poller that keeps a FHIRClient's cache, store and snapshots in step with its server
+
+    Each resource type is polled with a type-level _history query, which
+    also reports deletes, or with a _lastUpdated-filtered search on servers
+    without history (which cannot see deletes). Changes go to
+    FHIRClient.apply_remote_changes. The newest lastUpdated seen per type is
+    the high-water mark; it is persisted per server in state_path, so a
+    restart resumes from it instead of resyncing.
+
+    While every type is polled on schedule, patient_version() stands in for
+    FHIRClient.patient_data_version: it counts the changes applied to each
+    patient, so versioning a patient's data costs no requests.
+    """
+
+    def __init__(self, client, resource_types=STORED_TYPES, interval=30, state_path=None, page_size=200):
+        """
+        Args:
+            client: FHIRClient whose caches should follow the server
+            resource_types: Types to poll
+            interval: Seconds between polls
+            state_path: JSON file holding high-water marks for every server
+            page_size: _count requested per page of changes
+        """
+        self.client = client
+        self.resource_types = tuple(resource_types)
+        self.interval = interval
+        self.state_path = state_path
+        self.page_size = page_size
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._high_water = self._load_high_water()
+        # Resources already applied at the high-water mark (_since is inclusive)
+        self._seen_at_mark = {}
+        self._history_supported = {}
+        # Changes applied per patient, and deletes whose patient is unknown (they touch every version)
+        self._patient_changes = {}
+        self._unattributed_changes = 0
+        self.started_at = None
+        self.metrics = {
+            resource_type: {
+                "polls": 0,
+                "errors": 0,
+                "changes": 0,
+                "deletes": 0,
+                "last_poll": None,
+                "last_success": None,
+                "last_poll_seconds": None,
+                "last_changes": 0,
+                "last_error": None,
+            }
+            for resource_type in self.resource_types
+        }
+
+    def start(self):
+        """Start polling on a background thread"""
+        if self._thread is None:
+            self.started_at = time.time()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="fhir-sync", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+
+    def sync_once(self):
+        """Poll every type once and return the number of changes applied"""
+        applied = 0
+        for resource_type in self.resource_types:
+            if self._stop_event.is_set():
+                break
+            applied += self._poll_type(resource_type)
+        return applied
+
+    def patient_version(self, patient_id):
+        """Version of a patient's data from the changes synced since start, or None unless sync is current
+
+        Sync is current while every type's last successful poll is no older
+        than two intervals plus that poll's duration; changes reach the
+        version up to one interval after they are made.
+        """
+        now = time.time()
+        with self._lock:
+            if self._thread is None:
+                return None
+            for metrics in self.metrics.values():
+                if metrics["last_success"] is None or \
+                        now - metrics["last_success"] > 2 * self.interval + metrics["last_poll_seconds"]:
+                    return None
+            return f"sync:{self.started_at}:{self._patient_changes.get(patient_id, 0)}:{self._unattributed_changes}"
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            types = {}
+            for resource_type, metrics in self.metrics.items():
+                last_success = metrics["last_success"]
+                types[resource_type] = dict(
+                    metrics,
+                    high_water=self._high_water.get(resource_type),
+                    mode="history" if self._history_supported.get(resource_type, True) else "search",
+                    # Anything changed after the last successful poll began is not applied yet
+                    lag_seconds=round(now - last_success, 1) if last_success else None,
+                    changes_per_second=round(metrics["last_changes"] / metrics["last_poll_seconds"], 1)
+                    if metrics["last_poll_seconds"] else 0.0,
+                )
+            total = sum(m["changes"] + m["deletes"] for m in self.metrics.values())
+            uptime = now - self.started_at if self.started_at else 0
+            return {
+                "server": self.client.base_url,
+                "interval": self.interval,
+                "running": self._thread is not None,
+                "changes_applied": total,
+                "average_changes_per_second": round(total / uptime, 3) if uptime else 0.0,
+                "types": types,
+            }
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.sync_once()
+            self._stop_event.wait(self.interval)
+
+    def _poll_type(self, resource_type):
+        started = time.time()
+        metrics = self.metrics[resource_type]
+        try:
+            since = self._high_water.get(resource_type)
+            if since is None:
+                # First run for this server: start from now rather than replaying all history
+                mark, changed, deleted = self._server_now(resource_type), [], []
+            else:
+                changed, deleted, mark = self._fetch_changes(resource_type, since)
+            self.client.apply_remote_changes(changed, deleted)
+        except Exception as e:
+            with self._lock:
+                metrics["polls"] += 1
+                metrics["errors"] += 1
+                metrics["last_poll"] = started
+                metrics["last_error"] = str(e)
+            logger.warning("Sync of %s from %s failed: %s", resource_type, self.client.base_url, e)
+            return 0
+
+        elapsed = time.time() - started
+        with self._lock:
+            metrics["polls"] += 1
+            metrics["changes"] += len(changed)
+            metrics["deletes"] += len(deleted)
+            metrics["last_poll"] = started
+            metrics["last_success"] = started
+            metrics["last_poll_seconds"] = round(elapsed, 3)
+            metrics["last_changes"] = len(changed) + len(deleted)
+            metrics["last_error"] = None
+            for resource in changed:
+                patient_id = patient_id_for_resource(resource)
+                self._patient_changes[patient_id] = self._patient_changes.get(patient_id, 0) + 1
+            self._unattributed_changes += len(deleted)
+            moved = mark is not None and mark != since
+            if moved:
+                self._high_water[resource_type] = mark
+        if moved:
+            self._save_high_water()
+        if changed or deleted:
+            logger.info("Synced %s %s changes and %s deletes from %s",
+                        len(changed), resource_type, len(deleted), self.client.base_url)
+        return len(changed) + len(deleted)
+
+    def _fetch_changes(self, resource_type, since):
+        """Return (changed resources, deleted (type, id) pairs, new high-water mark)"""
+        if self._history_supported.get(resource_type, True):
+            try:
+                entries = self._history_entries(resource_type, since)
+                self._history_supported[resource_type] = True
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in UNSUPPORTED_STATUSES:
+                    raise
+                logger.info("%s has no %s/_history, falling back to _lastUpdated searches",
+                            self.client.base_url, resource_type)
+                self._history_supported[resource_type] = False
+        if not self._history_supported[resource_type]:
+            entries = self._search_entries(resource_type, since)
+
+        # Oldest first, so the latest version of a resource changed twice wins
+        latest = {}
+        for stamp, resource_id, resource in sorted(entries, key=lambda e: _instant_key(e[0])):
+            latest[resource_id] = (stamp, resource)
+
+        seen = self._seen_at_mark.get(resource_type, set())
+        changed, deleted = [], []
+        mark, at_mark = since, set()
+        for resource_id, (stamp, resource) in sorted(latest.items(), key=lambda item: _instant_key(item[1][0])):
+            if _instant_key(stamp) == _instant_key(since) and resource_id in seen:
+                continue
+            if resource is None:
+                deleted.append((resource_type, resource_id))
+            else:
+                changed.append(resource)
+            if stamp and _instant_key(stamp) > _instant_key(mark):
+                mark, at_mark = stamp, set()
+            if _instant_key(stamp) == _instant_key(mark):
+                at_mark.add(resource_id)
+        self._seen_at_mark[resource_type] = at_mark if mark != since else seen | at_mark
+        return changed, deleted, mark
+
+    def _history_entries(self, resource_type, since):
+        """(lastUpdated, id, resource or None if deleted) for every history entry since the mark"""
+        entries = []
+        for bundle in self._pages(f"{resource_type}/_history", {"_since": since, "_count": self.page_size}):
+            for entry in bundle.get("entry", []):
+                resource = entry.get("resource")
+                request = entry.get("request", {})
+                if request.get("method") == "DELETE" or resource is None:
+                    url = request.get("url") or entry.get("fullUrl", "")
+                    segments = [s for s in url.split("/_history")[0].split("/") if s]
+                    if len(segments) < 2:
+                        continue
+                    entries.append((entry.get("response", {}).get("lastModified"), segments[-1], None))
+                else:
+                    entries.append(((resource.get("meta") or {}).get("lastUpdated"), resource.get("id"), resource))
+        return entries
+
+    def _search_entries(self, resource_type, since):
+        params = {"_lastUpdated": f"ge{since}", "_sort": "_lastUpdated", "_count": self.page_size}
+        return [
+            ((entry["resource"].get("meta") or {}).get("lastUpdated"), entry["resource"].get("id"), entry["resource"])
+            for bundle in self._pages(resource_type, params)
+            for entry in bundle.get("entry", []) if "resource" in entry
+        ]
+
+    def _pages(self, path, params):
+        """Follow a search or history Bundle's next links, bypassing the client's response cache"""
+        url = f"{self.client.base_url}/{path}"
+        while url:
+            response = self.client.session.get(url, params=params, timeout=self.client.timeout)
+            response.raise_for_status()
+            bundle = response.json()
+            yield bundle
+            url, params = self.client._next_link(bundle), None
+
+    def _server_now(self, resource_type):
+        """The server's current time as a FHIR instant, from the Date header of a cheap query"""
+        response = self.client.session.get(
+            f"{self.client.base_url}/{resource_type}", params={"_summary": "count"}, timeout=self.client.timeout
+        )
+        response.raise_for_status()
+        date = response.headers.get("Date")
+        now = parsedate_to_datetime(date) if date else datetime.now(timezone.utc)
+        return now.astimezone(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+    def _load_high_water(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, encoding="utf-8") as f:
+            return json.load(f).get(self.client.base_url, {})
+
+    def _save_high_water(self):
+        if not self.state_path:
+            return
+        with _state_file_lock:
+            state = {}
+            if os.path.exists(self.state_path):
+                with open(self.state_path, encoding="utf-8") as f:
+                    state = json.load(f)
+            with self._lock:
+                state[self.client.base_url] = dict(self._high_water)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+
+def _instant_key(instant):
+    """Sortable UTC datetime for a FHIR instant (None sorts first)"""
+    if not instant:
+        return datetime.min.replace(tzinfo=timezone.utc)
+    value = instant.replace("Z", "+00:00")
+    if "." in value:
+        # fromisoformat before Python 3.11 only takes 3 or 6 fractional digits
+        head, _, rest = value.partition(".")
+        digits = "".join(c for c in rest if c.isdigit())
+        value = f"{head}.{digits[:6].ljust(6, '0')}{rest[len(digits):]}"
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.min.replace(tzinfo=timezone.utc)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
@@ -1,14 +1,58 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
+import asyncio
+import json
 import sys
 import os
 from HealthcareAssistant import HealthcareAssistant
+from answer_cache import AnswerCache
+from answer_accuarcy import get_scorer
+from fhir_sync import SyncWorker
+from server_registry import registry_from_env
+from fhir_projection import COMPACT_ELEMENTS, project_resource, to_rows
+import observation_series
+from sessions import SessionStore
+from MCPSessionManager import MCPSessionManager
+from worker_pool import AgentWorkerPool, PoolSaturated, QueueTimeout
 import uvicorn
 
 sys.path.append(os.path.dirname(__file__))
-app = FastAPI(title="AI Medical Assistant Chatbot API")
+
+mcp_session = MCPSessionManager(
+    health_interval=float(os.getenv("MCP_HEALTH_INTERVAL", "30")),
+    health_timeout=float(os.getenv("MCP_HEALTH_TIMEOUT", "10")),
+    drain_timeout=float(os.getenv("MCP_DRAIN_TIMEOUT", "30")),
+)
+
+worker_pool = AgentWorkerPool(
+    max_workers=int(os.getenv("ASK_MAX_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("ASK_MAX_QUEUE", "16")),
+    queue_timeout=float(os.getenv("ASK_QUEUE_TIMEOUT", "30")),
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Spawn the MCP server once; requests share it until shutdown
+    try:
+        await asyncio.to_thread(mcp_session.start)
+    except Exception as e:
+        print(f"MCP server failed to start, will retry on first query: {e}")
+    registry.start()
+    for worker in sync_workers.values():
+        worker.start()
+    yield
+    for worker in sync_workers.values():
+        worker.stop()
+    registry.stop()
+    worker_pool.shutdown(wait=False)
+    sessions.shutdown()
+    await asyncio.to_thread(mcp_session.stop)
+
+app = FastAPI(title="AI Medical Assistant Chatbot API", lifespan=lifespan)
 
 # Add CORS middleware to allow requests from Streamlit Cloud
 app.add_middleware(
@@ -19,92 +63,389 @@
     allow_headers=["*"],
 )
 
-assistant = HealthcareAssistant()
+# Direct FHIR access for the structured data endpoints (no LLM involved).
+# Named FHIR servers, each with its own pool, health probe and circuit breaker;
+# FHIR_MIRROR=1 lets reads go to the healthiest, fastest server. The MCP server
+# process builds the same registry from the environment it inherits.
+registry = registry_from_env()
+
+def patient_data_version(server: str, patient_id: str) -> Optional[str]:
+    """Version of a patient's FHIR data, so cached answers stop matching when it changes
+
+    Comes from the changes a current sync worker has applied when there is one,
+    otherwise from a few one-resource probes of the named server, which is
+    what the MCP tools write to (a mirror may not have the latest data yet).
+    """
+    worker = sync_workers.get(server)
+    version = worker.patient_version(patient_id) if worker is not None else None
+    if version is not None:
+        return version
+    return registry.endpoint(server).client.patient_data_version(patient_id)
+
+# Answers to repeated questions about unchanged patient data; ANSWER_CACHE_SIZE=0 disables it and
+# ANSWER_CACHE_SEMANTIC=1 also matches near-duplicate questions by embedding similarity
+answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+answer_cache = AnswerCache(
+    max_entries=answer_cache_size,
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    scorer=get_scorer() if os.getenv("ANSWER_CACHE_SEMANTIC", "0") == "1" else None,
+    similarity_threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+) if answer_cache_size > 0 else None
+
+def refresh_after_write(server: str, patient_id: Optional[str]) -> None:
+    """Follow a write the assistant's tools made in the MCP server process: drop this process's
+    copies of the patient's data and refetch the snapshots of sessions on that patient"""
+    # Under FHIR_MIRROR a snapshot may be read from any of the servers
+    for endpoint in registry.endpoints.values():
+        endpoint.client.invalidate_patient(patient_id)
+    sessions.refresh(server, patient_id)
+
+# FHIR tool results are compacted to this many tokens each before the model sees them (0 disables)
+assistant = HealthcareAssistant(mcp_session, worker_pool, servers=registry.names, default_server=registry.default,
+                                answer_cache=answer_cache, data_version=patient_data_version,
+                                context_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000")),
+                                on_write=refresh_after_write)
+
+# Poll each server for changes so the caches and local stores above stay current.
+# The MCP server process runs its own workers for its in-memory caches; only
+# this one keeps high-water marks in the sync state file.
+sync_interval = float(os.getenv("FHIR_SYNC_INTERVAL", "0"))
+sync_workers = {
+    name: SyncWorker(
+        endpoint.client,
+        interval=sync_interval,
+        state_path=os.getenv("FHIR_SYNC_STATE", "fhir_sync_state.json"),
+    )
+    for name, endpoint in registry.endpoints.items()
+} if sync_interval > 0 else {}
+
+def fetch_snapshot(patient_id: str, server: str) -> dict:
+    """Fetch the patient data kept warm in a session"""
+    summary = registry.route(server).client.get_patient_summary(patient_id, elements=COMPACT_ELEMENTS)
+    if "error" in summary["patient"]:
+        return summary["patient"]
+    return summary
+
+# Per-client patient contexts, keyed by the token returned from POST /patient
+sessions = SessionStore(
+    fetch_snapshot,
+    max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", "1000")),
+    max_snapshot_bytes=int(os.getenv("SESSION_MAX_SNAPSHOT_BYTES", "200000000")),
+    idle_ttl=float(os.getenv("SESSION_IDLE_TTL", "3600")),
+    max_snapshot_age=float(os.getenv("SESSION_SNAPSHOT_MAX_AGE", "300")),
+)
+SNAPSHOT_WAIT = float(os.getenv("SESSION_SNAPSHOT_WAIT", "10"))
+
+PATIENT_RESOURCES = {
+    "conditions": ("Condition", "get_patient_conditions"),
+    "medications": ("MedicationRequest", "get_patient_medications"),
+    "observations": ("Observation", "get_patient_observations"),
+}
 
 class QueryRequest(BaseModel):
     query: str
 
 class PatientRequest(BaseModel):
     patient_id: str
+    server: Optional[str] = None
 
 class ServerRequest(BaseModel):
     server: str
 
-patient_id: Optional[str] = None
+class SummariesRequest(BaseModel):
+    patient_ids: List[str]
+    server: Optional[str] = None
 
 """
     "/query": "POST - Ask a medical question",
-    "/patient": "POST - Set patient ID",
+    "/ask/stream": "POST - Ask a medical question, streaming the answer as Server-Sent Events",
+    "/patient": "POST - Set patient ID (returns the session token)",
     "/patient": "GET - Get current patient ID",
     "/patient": "DELETE - Clear patient ID",
-    "/server": "POST - Set FHIR server (hapi or smart)",
-    "/server": "GET - Get current FHIR server"
+    Send the session token back in the X-Session-Token header to use that patient.
+    "/server": "POST - Set FHIR server (a registry name such as hapi or smart)",
+    "/server": "GET - Get current FHIR server",
+    "/health": "GET - MCP server session, worker pool, patient session, FHIR server, sync, answer cache and context compaction status",
+    "/patients/{id}/conditions|medications|observations": "GET - Patient records as table rows",
+    "/patients/{id}/summary": "GET - Patient demographics and all record tables",
+    "/patients/summaries": "POST - Demographics and record tables for many patients",
+    "/patients/{id}/observations/series": "GET - Lab time series with normalized units and range flags"
 """
 
+async def _query_context(session_token: Optional[str]):
+    """Patient id, server and prefetched snapshot for the caller's session"""
+    session = sessions.get(session_token) if session_token else None
+    if session is None:
+        return None, assistant.server, None
+    snapshot = await asyncio.to_thread(session.get_snapshot, SNAPSHOT_WAIT)
+    return session.patient_id, session.server, snapshot
+
 @app.post("/ask")
-async def ask(request: QueryRequest):
+async def ask(request: QueryRequest, x_session_token: Optional[str] = Header(default=None)):
     """Ask the healthcare assistant a question"""
 
     try:
-        result = await assistant.answer_medical_query(request.query, patient_id)
+        patient_id, server, snapshot = await _query_context(x_session_token)
+        result = await assistant.answer_medical_query(request.query, patient_id, context=snapshot, server=server)
         return {
             "query": request.query,
             "patient_id": patient_id,
             **result,
-            "server": assistant.server
+            "server": server
         }
+    except PoolSaturated as e:
+        return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "5"})
+    except QueueTimeout as e:
+        return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": "10"})
     except Exception as e:
         return {"error": str(e)}
 
+@app.post("/ask/stream")
+async def ask_stream(request: QueryRequest, x_session_token: Optional[str] = Header(default=None)):
+    """Ask the healthcare assistant a question and stream the answer as Server-Sent Events
+
+    Emits "token" events with answer chunks, "tool" events when the agent calls
+    a FHIR tool, then a final "done" (or "error") event.
+    """
+
+    if worker_pool.is_saturated():
+        return JSONResponse(status_code=429, content={"error": "Assistant is busy"}, headers={"Retry-After": "5"})
+
+    patient_id, server, snapshot = await _query_context(x_session_token)
+
+    async def events():
+        async for event in assistant.stream_medical_query(request.query, patient_id, context=snapshot, server=server):
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/patient")
-async def set_patient(request: PatientRequest):
-    """Set the patient ID for queries"""
-    
-    global patient_id
-    patient_id = request.patient_id
+async def set_patient(request: PatientRequest, x_session_token: Optional[str] = Header(default=None)):
+    """Set the patient ID for queries and start prefetching their data
+
+    Returns a session token; send it as X-Session-Token on later requests.
+    Passing an existing token switches that session to the new patient.
+    """
+
+    server = (request.server or assistant.server).lower()
+    if server not in registry:
+        raise HTTPException(status_code=400, detail=f"Unknown server '{server}'")
+    session = sessions.create(request.patient_id, server, token=x_session_token)
 
     return {
-        "message": f"Patient ID set to {patient_id}",
-        "patient_id": patient_id
+        "message": f"Patient ID set to {session.patient_id}",
+        "patient_id": session.patient_id,
+        "session_token": session.token,
+        "server": session.server
     }
 
 @app.get("/patient")
-async def get_patient():
+async def get_patient(x_session_token: Optional[str] = Header(default=None)):
     """Get the current patient ID"""
 
-    return {
-        "patient_id": patient_id
-    }
+    session = sessions.get(x_session_token) if x_session_token else None
+    if session is None:
+        return {"patient_id": None}
+    return session.info()
 
 @app.delete("/patient")
-async def clear_patient():
+async def clear_patient(x_session_token: Optional[str] = Header(default=None)):
     """Clear the current patient ID"""
 
-    global patient_id
-    patient_id = None
+    if x_session_token:
+        sessions.delete(x_session_token)
 
     return {
         "message": "Patient ID cleared",
-        "patient_id": patient_id
+        "patient_id": None
     }
 
 @app.post("/server")
-async def set_server(request: ServerRequest):
-    """Set the FHIR server (hapi or smart)"""
+async def set_server(request: ServerRequest, x_session_token: Optional[str] = Header(default=None)):
+    """Set the FHIR server (hapi or smart) for this session, or the default for new sessions"""
 
-    result = assistant.set_server(request.server)
+    session = sessions.get(x_session_token) if x_session_token else None
+    if session is None:
+        result = assistant.set_server(request.server)
+        return {
+            "message": result,
+            "current_server": assistant.server
+        }
+
+    server = request.server.lower()
+    if server not in registry:
+        return {"message": "Invalid server.", "current_server": session.server}
+    sessions.set_server(x_session_token, server)
 
     return {
-        "message": result,
-        "current_server": assistant.server
+        "message": f"Server set to {server.upper()}",
+        "current_server": session.server
     }
 
 @app.get("/server")
-async def get_server():
+async def get_server(x_session_token: Optional[str] = Header(default=None)):
     """Get the current FHIR server"""
-    
+
+    session = sessions.get(x_session_token) if x_session_token else None
+
+    return {
+        "current_server": session.server if session else assistant.server
+    }
+
+def _resolve_server(server: Optional[str], session_token: Optional[str]) -> str:
+    session = sessions.get(session_token) if session_token else None
+    name = (server or (session.server if session else assistant.server)).lower()
+    if name not in registry:
+        raise HTTPException(status_code=400, detail=f"Unknown server '{name}'")
+    return name
+
+def _warm_snapshot(patient_id: str, server: str, session_token: Optional[str]) -> Optional[dict]:
+    """The session's prefetched data, if it is ready and for this patient and server"""
+    session = sessions.get(session_token) if session_token else None
+    if session is None or (session.patient_id, session.server) != (patient_id, server):
+        return None
+    return session.snapshot
+
+def _table(bundle: dict, max_resources: Optional[int] = None) -> dict:
+    if "error" in bundle:
+        raise HTTPException(status_code=502, detail=bundle["error"])
+    rows = to_rows(bundle)[:max_resources]
+    return {"total": bundle.get("total", len(rows)), "count": len(rows), "rows": rows}
+
+MAX_BATCH_PATIENTS = int(os.getenv("MAX_BATCH_PATIENTS", "200"))
+
+@app.post("/patients/summaries")
+async def get_patient_summaries_table(request: SummariesRequest, x_session_token: Optional[str] = Header(default=None)):
+    """Get demographics and record tables for many patients at once; failures are reported per patient"""
+
+    if not request.patient_ids:
+        raise HTTPException(status_code=400, detail="patient_ids must not be empty")
+    if len(request.patient_ids) > MAX_BATCH_PATIENTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_PATIENTS} patients per request")
+    endpoint = registry.route(_resolve_server(request.server, x_session_token))
+    result = await endpoint.async_client.get_patient_summaries(request.patient_ids, elements=COMPACT_ELEMENTS)
+
+    patients = {}
+    for patient_id, summary in result["summaries"].items():
+        patient = summary["patient"]
+        patients[patient_id] = {
+            "patient": patient if "error" in patient else project_resource(patient),
+            **{
+                key: summary[key] if "error" in summary[key] else _table(summary[key])
+                for key in PATIENT_RESOURCES
+            }
+        }
+    return {
+        "server": endpoint.name,
+        "requested": result["requested"],
+        "succeeded": result["succeeded"],
+        "failed": result["failed"],
+        "patients": patients
+    }
+
+@app.get("/patients/{patient_id}/summary")
+async def get_patient_summary_table(patient_id: str, server: Optional[str] = None,
+                                    x_session_token: Optional[str] = Header(default=None)):
+    """Get a patient's demographics plus condition, medication and observation tables"""
+
+    server = _resolve_server(server, x_session_token)
+    summary = _warm_snapshot(patient_id, server, x_session_token)
+    if summary is None:
+        endpoint = registry.route(server)
+        server = endpoint.name
+        summary = await endpoint.async_client.get_patient_summary(patient_id, elements=COMPACT_ELEMENTS)
+    if "error" in summary["patient"]:
+        raise HTTPException(status_code=502, detail=summary["patient"]["error"])
+
+    return {
+        "patient_id": patient_id,
+        "server": server,
+        "patient": project_resource(summary["patient"]),
+        **{key: _table(summary[key]) for key in PATIENT_RESOURCES}
+    }
+
+@app.get("/patients/{patient_id}/{resource}")
+async def get_patient_records(patient_id: str, resource: str, server: Optional[str] = None, max_resources: int = 500,
+                              x_session_token: Optional[str] = Header(default=None)):
+    """Get a patient's conditions, medications or observations as normalized table rows"""
+
+    if resource not in PATIENT_RESOURCES:
+        raise HTTPException(status_code=404, detail=f"Unknown resource '{resource}'")
+    resource_type, method = PATIENT_RESOURCES[resource]
+    server = _resolve_server(server, x_session_token)
+    snapshot = _warm_snapshot(patient_id, server, x_session_token)
+    if snapshot is not None:
+        bundle = snapshot[resource]
+    else:
+        endpoint = registry.route(server)
+        server = endpoint.name
+        bundle = await getattr(endpoint.async_client, method)(
+            patient_id, max_resources=max_resources, elements=COMPACT_ELEMENTS[resource_type]
+        )
+
+    return {
+        "patient_id": patient_id,
+        "server": server,
+        **_table(bundle, max_resources)
+    }
+
+SERIES_AGGREGATIONS = ("mean", "median", "min", "max", "last")
+
+@app.get("/patients/{patient_id}/observations/series")
+async def get_observation_series(patient_id: str, server: Optional[str] = None, code: Optional[str] = None,
+                                 date_from: Optional[str] = None, date_to: Optional[str] = None,
+                                 resample: Optional[str] = None, how: str = "mean", max_points: int = 1000,
+                                 x_session_token: Optional[str] = Header(default=None)):
+    """Get a patient's numeric observations as per-code time series with normalized units and range flags"""
+
+    if how not in SERIES_AGGREGATIONS:
+        raise HTTPException(status_code=400, detail=f"how must be one of {', '.join(SERIES_AGGREGATIONS)}")
+    server = _resolve_server(server, x_session_token)
+    snapshot = _warm_snapshot(patient_id, server, x_session_token)
+    if snapshot is not None:
+        bundle = snapshot["observations"]
+    else:
+        endpoint = registry.route(server)
+        server = endpoint.name
+        # Let the server (or local store) narrow the search; extract() applies the same bounds to a snapshot
+        bundle = await endpoint.async_client.get_patient_observations(
+            patient_id, elements=COMPACT_ELEMENTS["Observation"], code=code, date_from=date_from, date_to=date_to
+        )
+    if "error" in bundle:
+        raise HTTPException(status_code=502, detail=bundle["error"])
+
+    try:
+        series = await asyncio.to_thread(
+            observation_series.extract, bundle, codes=code.split(",") if code else None, date_from=date_from,
+            date_to=date_to, rule=resample, how=how, max_points=max_points
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "patient_id": patient_id,
+        "server": server,
+        "resample": resample,
+        "series": series
+    }
+
+@app.get("/health")
+async def health():
+    """Report the state of the shared MCP server session, the agent worker pool, FHIR servers, change sync,
+    the answer cache and context compaction"""
+
     return {
-        "current_server": assistant.server
+        "mcp": mcp_session.status(),
+        "workers": worker_pool.stats(),
+        "sessions": sessions.stats(),
+        "servers": registry.stats(),
+        "sync": {name: worker.stats() for name, worker in sync_workers.items()},
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "compaction": assistant.compaction_stats.summary()
     }
 
 if __name__ == "__main__":
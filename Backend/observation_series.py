@@ -0,0 +1,297 @@
+import numpy as np
+import pandas as pd
+from fhir_projection import concept_text
+
+UCUM_SYSTEM = "http://unitsofmeasure.org"
+
+COLUMNS = ["time", "code", "system", "display", "value", "unit", "ref_low", "ref_high", "interpretation"]
+
+# One series per code and unit, so units normalize_units cannot convert stay apart
+SERIES_KEYS = ["code", "unit"]
+
+# Spellings of the same unit, lowercased, mapped to UCUM
+UNIT_ALIASES = {
+    "mg/dl": "mg/dL",
+    "mmol/l": "mmol/L",
+    "umol/l": "umol/L",
+    "µmol/l": "umol/L",
+    "g/dl": "g/dL",
+    "g/l": "g/L",
+    "kg": "kg",
+    "lb": "[lb_av]",
+    "lbs": "[lb_av]",
+    "[lb_av]": "[lb_av]",
+    "in": "[in_i]",
+    "[in_i]": "[in_i]",
+    "cm": "cm",
+    "degf": "[degF]",
+    "[degf]": "[degF]",
+    "°f": "[degF]",
+    "cel": "Cel",
+    "degc": "Cel",
+    "°c": "Cel",
+    "mm[hg]": "mm[Hg]",
+    "mmhg": "mm[Hg]",
+    "mmol/mol": "mmol/mol",
+    "%": "%",
+}
+
+# (LOINC code or None for any code, unit) -> (target unit, scale, offset): target = value * scale + offset
+UNIT_CONVERSIONS = {
+    ("2339-0", "mmol/L"): ("mg/dL", 18.016, 0.0),      # Glucose
+    ("2345-7", "mmol/L"): ("mg/dL", 18.016, 0.0),      # Glucose, serum/plasma
+    ("2093-3", "mmol/L"): ("mg/dL", 38.67, 0.0),       # Total cholesterol
+    ("2085-9", "mmol/L"): ("mg/dL", 38.67, 0.0),       # HDL cholesterol
+    ("18262-6", "mmol/L"): ("mg/dL", 38.67, 0.0),      # LDL cholesterol
+    ("13457-7", "mmol/L"): ("mg/dL", 38.67, 0.0),      # LDL cholesterol (calculated)
+    ("2571-8", "mmol/L"): ("mg/dL", 88.57, 0.0),       # Triglycerides
+    ("2160-0", "umol/L"): ("mg/dL", 1 / 88.42, 0.0),   # Creatinine
+    ("4548-4", "mmol/mol"): ("%", 0.09148, 2.152),     # Hemoglobin A1c (IFCC to NGSP)
+    (None, "g/L"): ("g/dL", 0.1, 0.0),
+    (None, "[lb_av]"): ("kg", 0.45359237, 0.0),
+    (None, "[in_i]"): ("cm", 2.54, 0.0),
+    (None, "[degF]"): ("Cel", 5 / 9, -160 / 9),
+}
+
+
+def _effective(resource):
+    return resource.get("effectiveDateTime") or (resource.get("effectivePeriod") or {}).get("start") \
+        or resource.get("effectiveInstant") or resource.get("issued")
+
+
+def _quantity_unit(quantity):
+    if quantity.get("system") == UCUM_SYSTEM and quantity.get("code"):
+        return quantity["code"]
+    return quantity.get("unit") or quantity.get("code")
+
+
+def _range_bound(ranges, bound):
+    for reference_range in ranges or []:
+        value = (reference_range.get(bound) or {}).get("value")
+        if value is not None:
+            return value
+    return None
+
+
+def _coding(concept):
+    for coding in (concept or {}).get("coding", []):
+        if coding.get("code"):
+            return coding.get("system"), coding["code"]
+    return None, None
+
+
+def to_frame(observations):
+    """Flatten Observations (and their components) with numeric values into one row per measurement
+
+    Accepts a search Bundle or a list of resources. The only per-resource
+    Python work is pulling fields out of the JSON; everything after that is
+    done on whole columns.
+    """
+    if isinstance(observations, dict):
+        observations = [entry["resource"] for entry in observations.get("entry", []) if "resource" in entry]
+    columns = {name: [] for name in COLUMNS}
+
+    def add(element, time, parent_ranges, parent_interpretation):
+        quantity = element.get("valueQuantity")
+        if not quantity or quantity.get("value") is None:
+            return
+        system, code = _coding(element.get("code"))
+        ranges = element.get("referenceRange") or parent_ranges
+        columns["time"].append(time)
+        columns["code"].append(code)
+        columns["system"].append(system)
+        columns["display"].append(concept_text(element.get("code")))
+        columns["value"].append(quantity["value"])
+        columns["unit"].append(_quantity_unit(quantity))
+        columns["ref_low"].append(_range_bound(ranges, "low"))
+        columns["ref_high"].append(_range_bound(ranges, "high"))
+        _, interpretation = _coding(((element.get("interpretation") or [None])[0]) or parent_interpretation)
+        columns["interpretation"].append(interpretation)
+
+    for resource in observations:
+        if resource.get("status") in ("entered-in-error", "cancelled"):
+            continue
+        time = _effective(resource)
+        if not time:
+            continue
+        interpretation = (resource.get("interpretation") or [None])[0]
+        add(resource, time, None, interpretation)
+        for component in resource.get("component", []):
+            # Component ranges are their own; the parent's belong to the panel value
+            add(component, time, None, None)
+
+    frame = pd.DataFrame(columns)
+    frame["time"] = pd.to_datetime(frame["time"], utc=True, errors="coerce", format="ISO8601")
+    for column in ("value", "ref_low", "ref_high"):
+        frame[column] = pd.to_numeric(frame[column], errors="coerce").astype("float64")
+    frame = frame.dropna(subset=["time", "code", "value"])
+    return frame.sort_values(["code", "time"], kind="stable").reset_index(drop=True)
+
+
+def normalize_units(frame):
+    """Convert values and reference ranges to one unit per code (UNIT_CONVERSIONS)"""
+    frame = frame.copy()
+    units = frame["unit"].fillna("").astype(str)
+    frame["unit"] = units.str.lower().map(UNIT_ALIASES).fillna(units).replace("", None)
+
+    scale = np.ones(len(frame))
+    offset = np.zeros(len(frame))
+    target = frame["unit"].to_numpy(dtype=object, copy=True)
+    codes = frame["code"].to_numpy(dtype=object)
+    unit_values = frame["unit"].to_numpy(dtype=object)
+    converted = np.zeros(len(frame), dtype=bool)
+    # Code-specific conversions first, then ones that apply to any code
+    for (code, unit), (to_unit, factor, shift) in sorted(UNIT_CONVERSIONS.items(), key=lambda c: c[0][0] is None):
+        mask = (unit_values == unit) & ~converted
+        if code is not None:
+            mask &= codes == code
+        scale[mask], offset[mask], target[mask] = factor, shift, to_unit
+        converted |= mask
+
+    for column in ("value", "ref_low", "ref_high"):
+        frame[column] = frame[column].to_numpy() * scale + offset
+    frame["unit"] = target
+    return frame
+
+
+def flag_out_of_range(frame):
+    """Add a flag column: "low" or "high" against the reference range, "normal", or None when there is no range
+
+    A measurement without a numeric range falls back to its interpretation code (L, H, LL, HH, N).
+    """
+    frame = frame.copy()
+    value = frame["value"].to_numpy()
+    low = frame["ref_low"].to_numpy()
+    high = frame["ref_high"].to_numpy()
+    has_range = ~np.isnan(low) | ~np.isnan(high)
+    interpretation = frame["interpretation"].fillna("").astype(str).str.upper().to_numpy()
+    frame["flag"] = np.select(
+        [value < low, value > high, has_range,
+         np.isin(interpretation, ["L", "LL", "LU"]), np.isin(interpretation, ["H", "HH", "HU"]),
+         interpretation == "N"],
+        ["low", "high", "normal", "low", "high", "normal"],
+        default=None,
+    )
+    return frame
+
+
+def resample(frame, rule="D", how="mean"):
+    """Aggregate each code's measurements into fixed time bins (pandas offset alias, e.g. "D", "W", "MS")
+
+    Empty bins are dropped. The reference range kept for a bin is the last
+    one reported in it, and the flag is recomputed against the aggregate.
+    """
+    if frame.empty:
+        return frame
+    grouped = frame.set_index("time").groupby(SERIES_KEYS, dropna=False)
+    binned = grouped.resample(rule).agg({
+        "value": how, "system": "last", "display": "last", "ref_low": "last", "ref_high": "last",
+        "interpretation": "last",
+    })
+    binned = binned.dropna(subset=["value"]).reset_index()
+    binned["interpretation"] = None
+    return flag_out_of_range(binned[COLUMNS])
+
+
+def downsample(frame, max_points):
+    """Keep at most about max_points rows per series, preserving each bucket's extremes
+
+    Each series' time span is split into max_points // 2 equal buckets and
+    the lowest and highest value in each bucket are kept (min/max
+    decimation), so spikes and out-of-range readings survive.
+    """
+    if frame.empty or not max_points:
+        return frame
+    series = frame.groupby(SERIES_KEYS, dropna=False)
+    counts = series["value"].transform("size").to_numpy()
+    if (counts <= max_points).all():
+        return frame
+    buckets = max(max_points // 2, 1)
+    nanos = frame["time"].astype("int64").to_numpy()
+    start = series["time"].transform("min").astype("int64").to_numpy()
+    end = series["time"].transform("max").astype("int64").to_numpy()
+    span = np.maximum(end - start, 1)
+    bucket = np.minimum(((nanos - start) / span * buckets).astype(np.int64), buckets - 1)
+    # Series already under the limit keep every row
+    bucket = np.where(counts <= max_points, np.arange(len(frame)), bucket)
+
+    keys = [frame["code"], frame["unit"], pd.Series(bucket, index=frame.index)]
+    values = frame["value"]
+    keep = np.union1d(values.groupby(keys, dropna=False).idxmin().to_numpy(),
+                      values.groupby(keys, dropna=False).idxmax().to_numpy())
+    return frame.loc[keep].sort_values(["code", "time"], kind="stable")
+
+
+def _scalar(value):
+    """A JSON-safe Python value (None for NaN)"""
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def series_counts(frame):
+    """Number of rows per (code, unit) series, with None for a missing unit"""
+    counts = frame.groupby(SERIES_KEYS, dropna=False)["value"].size()
+    return {(code, _scalar(unit)): int(count) for (code, unit), count in counts.items()}
+
+
+def to_columns(frame, total=None):
+    """Group a frame into per-(code, unit) columnar arrays for JSON responses
+
+    Returns {key: {"code", "display", "system", "unit", "count", "ref_low",
+    "ref_high", "time": [...], "value": [...], "flag": [...]}}, where
+    ref_low/ref_high are the most recent reported range. The key is the code,
+    or "code [unit]" when a code is reported in units that could not be
+    converted to one another. total maps (code, unit) to a count from
+    series_counts.
+    """
+    series = {}
+    times = frame["time"].dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    groups = frame.groupby(SERIES_KEYS, dropna=False, sort=True).groups
+    units_per_code = pd.Series([code for code, _ in groups]).value_counts()
+    for (code, unit), rows in groups.items():
+        rows = frame.loc[rows]
+        latest = rows.iloc[-1]
+        unit = _scalar(unit)
+        key = code if units_per_code[code] == 1 else f"{code} [{unit or ''}]"
+        series[key] = {
+            "code": code,
+            "display": _scalar(latest["display"]),
+            "system": _scalar(latest["system"]),
+            "unit": unit,
+            "count": total[(code, unit)] if total is not None else len(rows),
+            "ref_low": _scalar(latest["ref_low"]),
+            "ref_high": _scalar(latest["ref_high"]),
+            "time": times.loc[rows.index].tolist(),
+            "value": rows["value"].round(4).tolist(),
+            "flag": rows["flag"].tolist(),
+        }
+    return series
+
+
+def extract(observations, codes=None, date_from=None, date_to=None, rule=None, how="mean", max_points=None):
+    """Observations -> normalized, flagged, optionally resampled and downsampled series per code and unit
+
+    Args:
+        observations: Search Bundle or list of Observation resources
+        codes: Only these LOINC codes
+        date_from / date_to: Inclusive bounds (FHIR date or dateTime)
+        rule: Resample to this pandas offset alias before downsampling
+        how: Aggregation used when resampling ("mean", "min", "max", "median", "last")
+        max_points: Downsample each series to about this many points
+    """
+    frame = to_frame(observations)
+    if codes:
+        frame = frame[frame["code"].isin(codes)]
+    if date_from:
+        frame = frame[frame["time"] >= pd.Timestamp(date_from, tz="UTC")]
+    if date_to:
+        end = pd.Timestamp(date_to, tz="UTC")
+        # A year, month or bare date includes the whole of it
+        period = {4: pd.DateOffset(years=1), 7: pd.DateOffset(months=1), 10: pd.DateOffset(days=1)}.get(len(date_to))
+        frame = frame[frame["time"] < end + period] if period else frame[frame["time"] <= end]
+    frame = flag_out_of_range(normalize_units(frame))
+    total = series_counts(frame)
+    if rule:
+        frame = resample(frame, rule, how)
+    return to_columns(downsample(frame, max_points), total)
@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import threading
+import time
+from FHIRClient import FHIR_SERVERS, FHIRClient
+from AsyncFHIRClient import AsyncFHIRClient
+from fhir_cache import ResourceCache
+from fhir_store import ResourceStore
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+def load_servers():
+    """Named FHIR endpoints: FHIR_SERVERS, any {"name": "url"} JSON in FHIR_SERVER_URLS and FHIR_BASE_URL as custom
+
+    Names are lowercased, as lookups are.
+    """
+    servers = dict(FHIR_SERVERS)
+    servers.update({name.lower(): url for name, url in json.loads(os.getenv("FHIR_SERVER_URLS", "{}")).items()})
+    if os.getenv("FHIR_BASE_URL"):
+        servers["custom"] = os.getenv("FHIR_BASE_URL")
+    return servers
+
+
+def client_from_env(name, base_url):
+    """FHIRClient for a named server configured from FHIR_POOL_SIZE, FHIR_TIMEOUT, FHIR_CACHE_* and FHIR_STORE_*
+
+    FHIR_STORE_DIR keeps a local SQLite mirror per server (<dir>/<name>.sqlite3).
+    """
+    cache_ttl = float(os.getenv("FHIR_CACHE_TTL", "60"))
+    store_dir = os.getenv("FHIR_STORE_DIR")
+    if store_dir:
+        os.makedirs(store_dir, exist_ok=True)
+    return FHIRClient(
+        base_url=base_url,
+        pool_maxsize=int(os.getenv("FHIR_POOL_SIZE", "10")),
+        timeout=float(os.getenv("FHIR_TIMEOUT", "30")),
+        cache=ResourceCache(
+            max_entries=int(os.getenv("FHIR_CACHE_SIZE", "512")),
+            ttl=cache_ttl,
+        ) if cache_ttl > 0 else None,
+        store=ResourceStore(
+            os.path.join(store_dir, f"{name}.sqlite3"),
+            max_age=float(os.getenv("FHIR_STORE_MAX_AGE", "300")),
+        ) if store_dir else None,
+    )
+
+
+def registry_from_env():
+    """The ServerRegistry described by the environment
+
+    The API and the MCP server process (which inherits the API's
+    environment) both build their registry here, so they agree on the
+    server names and settings.
+    """
+    return ServerRegistry(
+        load_servers(),
+        client_factory=client_from_env,
+        default=(os.getenv("FHIR_SERVER") or ("custom" if os.getenv("FHIR_BASE_URL") else "")).lower() or None,
+        mirror=os.getenv("FHIR_MIRROR", "0") == "1",
+        probe_interval=float(os.getenv("FHIR_PROBE_INTERVAL", "30")),
+        max_concurrency=int(os.getenv("FHIR_MAX_CONCURRENCY", "8")),
+    )
+
+
+class ServerEndpoint:
+    """One named FHIR server with its own client (and connection pool) and circuit breaker
+
+    failure_threshold consecutive failed probes open the circuit. After
+    reset_timeout seconds it is half open: traffic may try it again, and the
+    next probe closes it or opens it for another reset_timeout.
+    """
+
+    def __init__(self, name, client, failure_threshold=3, reset_timeout=30, max_concurrency=8):
+        self.name = name
+        self.client = client
+        self.async_client = AsyncFHIRClient(client, max_concurrency=max_concurrency)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.latency = None
+        self.last_probe = None
+        self.last_error = None
+        self.routed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return self.client.base_url
+
+    def available(self):
+        """True unless the circuit is open and its reset timeout has not passed"""
+        with self._lock:
+            if self.state == CIRCUIT_OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = CIRCUIT_HALF_OPEN
+            return self.state != CIRCUIT_OPEN
+
+    def probe(self, timeout=5):
+        """Time a lightweight request to the server and update the circuit"""
+        started = time.monotonic()
+        try:
+            # Straight through the session: a cached response says nothing about the server
+            response = self.client.session.get(
+                f"{self.base_url}/metadata", params={"_summary": "true"}, timeout=timeout
+            )
+            response.raise_for_status()
+        except Exception as e:
+            self.record_failure(str(e))
+            return False
+        self.record_success(time.monotonic() - started)
+        return True
+
+    def record_success(self, latency):
+        with self._lock:
+            # Exponentially weighted, so one slow probe does not flip routing
+            self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+            self.failures = 0
+            self.last_probe = time.time()
+            self.last_error = None
+            if self.state != CIRCUIT_CLOSED:
+                logger.info("FHIR server %s recovered, closing circuit", self.name)
+            self.state = CIRCUIT_CLOSED
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_probe = time.time()
+            self.last_error = error
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CIRCUIT_OPEN:
+                    logger.warning("FHIR server %s failing (%s), opening circuit", self.name, error)
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.time()
+
+    def info(self):
+        with self._lock:
+            return {
+                "base_url": self.base_url,
+                "state": self.state,
+                "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+                "failures": self.failures,
+                "last_probe": self.last_probe,
+                "last_error": self.last_error,
+                "routed": self.routed,
+            }
+
+
+class ServerRegistry:
+    """Named FHIR endpoints with health probes, circuit breakers and latency-aware routing
+
+    Requests name the server they want. When mirror is set (the servers hold
+    the same data) reads may go elsewhere: to the requested server while it is
+    healthy and within latency_slack of the fastest healthy server, otherwise
+    to the fastest healthy one. Writes always go to the requested server.
+    """
+
+    def __init__(self, servers=None, client_factory=None, default=None, mirror=False, probe_interval=30,
+                 probe_timeout=5, failure_threshold=3, reset_timeout=30, latency_slack=1.5, max_concurrency=8):
+        """
+        Args:
+            servers: {name: base_url} (defaults to load_servers())
+            client_factory: Callable(name, base_url) returning a FHIRClient; each
+                endpoint gets its own, and so its own connection pool
+            default: Server used when a request names none (defaults to "smart" or the first)
+            mirror: Route reads across servers by health and latency
+            probe_interval: Seconds between background probes (0 disables them)
+            probe_timeout: Seconds a probe may take
+            failure_threshold: Consecutive failed probes that open a circuit
+            reset_timeout: Seconds an open circuit waits before allowing a retry
+            latency_slack: How much slower than the fastest server the requested one may be
+            max_concurrency: Concurrent calls per endpoint through its async client
+        """
+        servers = servers or load_servers()
+        client_factory = client_factory or (lambda name, url: FHIRClient(url))
+        self.endpoints = {
+            name: ServerEndpoint(name, client_factory(name, url), failure_threshold, reset_timeout, max_concurrency)
+            for name, url in servers.items()
+        }
+        self.default = default or ("smart" if "smart" in self.endpoints else next(iter(self.endpoints)))
+        self.mirror = mirror
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.latency_slack = latency_slack
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __contains__(self, name):
+        return name in self.endpoints
+
+    @property
+    def names(self):
+        return list(self.endpoints)
+
+    def endpoint(self, name=None):
+        name = (name or self.default).lower()
+        if name not in self.endpoints:
+            raise KeyError(f"Unknown FHIR server '{name}'")
+        return self.endpoints[name]
+
+    def route(self, name=None, read=True):
+        """Pick the endpoint that should serve a request for server name"""
+        requested = self.endpoint(name)
+        chosen = requested
+        if self.mirror and read:
+            healthy = [e for e in self.endpoints.values() if e.available()]
+            if healthy:
+                fastest = min(healthy, key=lambda e: e.latency if e.latency is not None else float("inf"))
+                if requested not in healthy or (
+                        requested.latency is not None and fastest.latency is not None
+                        and requested.latency > fastest.latency * self.latency_slack):
+                    chosen = fastest
+        with chosen._lock:
+            chosen.routed += 1
+        return chosen
+
+    def probe_all(self):
+        for endpoint in self.endpoints.values():
+            endpoint.probe(self.probe_timeout)
+
+    def start(self):
+        """Probe every server now and then every probe_interval seconds in the background"""
+        if self._thread is None and self.probe_interval:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._probe_loop, name="fhir-probe", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.probe_timeout * len(self.endpoints))
+            self._thread = None
+
+    def stats(self):
+        return {
+            "default": self.default,
+            "mirror": self.mirror,
+            "servers": {name: endpoint.info() for name, endpoint in self.endpoints.items()},
+        }
+
+    def _probe_loop(self):
+        while not self._stop_event.is_set():
+            self.probe_all()
+            self._stop_event.wait(self.probe_interval)
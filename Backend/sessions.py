@@ -0,0 +1,187 @@
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class PatientSession:
+    """One client's patient context: the selected patient and server plus a prefetched data snapshot"""
+
+    def __init__(self, token, patient_id, server):
+        self.token = token
+        self.patient_id = patient_id
+        self.server = server
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.snapshot = None
+        self.snapshot_bytes = 0
+        self.snapshot_error = None
+        self.fetched_at = None
+        self._future = None
+        # Bumped by every prefetch so only the latest one may set the snapshot
+        self._generation = 0
+
+    def get_snapshot(self, timeout=None):
+        """Return the prefetched snapshot, waiting up to timeout seconds for it to arrive"""
+        future = self._future
+        if self.snapshot is None and future is not None:
+            try:
+                future.result(timeout=timeout)
+            except TimeoutError:
+                return None
+            except Exception:
+                pass
+        return self.snapshot
+
+    def info(self):
+        return {
+            "session_token": self.token,
+            "patient_id": self.patient_id,
+            "server": self.server,
+            "snapshot_ready": self.snapshot is not None,
+            "snapshot_error": self.snapshot_error,
+            "fetched_at": self.fetched_at,
+        }
+
+
+class SessionStore:
+    """Per-client patient sessions keyed by an opaque token
+
+    Setting a patient starts fetching that patient's data on a background
+    thread so the first question finds it warm. A snapshot older than
+    max_snapshot_age is refetched when its session is next used, and
+    refresh() refetches the snapshots a write has made stale. Sessions idle
+    for longer than idle_ttl are dropped, and the least recently used
+    sessions are evicted when there are more than max_sessions or their
+    snapshots exceed max_snapshot_bytes in total.
+    """
+
+    def __init__(self, fetch_snapshot, max_sessions=1000, max_snapshot_bytes=200_000_000, idle_ttl=3600,
+                 prefetch_workers=4, max_snapshot_age=300):
+        """
+        Args:
+            fetch_snapshot: Callable(patient_id, server) returning the patient's data
+            max_sessions: Maximum number of live sessions
+            max_snapshot_bytes: Memory cap for all snapshots (measured as JSON size)
+            idle_ttl: Seconds after the last access before a session is dropped
+            prefetch_workers: Threads used for background snapshot fetches
+            max_snapshot_age: Seconds a snapshot is used before it is refetched
+        """
+        self.fetch_snapshot = fetch_snapshot
+        self.max_sessions = max_sessions
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.idle_ttl = idle_ttl
+        self.max_snapshot_age = max_snapshot_age
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="session-prefetch")
+        self.evictions = 0
+
+    def create(self, patient_id, server, token=None):
+        """Start a session (or replace the one under token) and begin prefetching"""
+        session = PatientSession(token or secrets.token_urlsafe(24), patient_id, server)
+        with self._lock:
+            self._sessions[session.token] = session
+            self._sessions.move_to_end(session.token)
+            self._evict_locked(keep=session.token)
+        self.prefetch(session)
+        return session
+
+    def get(self, token):
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if time.time() - session.last_access > self.idle_ttl:
+                del self._sessions[token]
+                self.evictions += 1
+                return None
+            session.last_access = time.time()
+            self._sessions.move_to_end(token)
+        if session.snapshot is not None and time.time() - session.fetched_at > self.max_snapshot_age:
+            self.prefetch(session)
+        return session
+
+    def delete(self, token):
+        with self._lock:
+            return self._sessions.pop(token, None) is not None
+
+    def set_server(self, token, server):
+        """Point a session at another server and refetch its snapshot"""
+        session = self.get(token)
+        if session is None:
+            return None
+        session.server = server
+        self.prefetch(session)
+        return session
+
+    def refresh(self, server, patient_id=None):
+        """Refetch the snapshots of sessions on server for patient_id (any patient when None) after a write
+
+        Returns the number of sessions refreshed.
+        """
+        with self._lock:
+            stale = [s for s in self._sessions.values()
+                     if s.server == server and patient_id in (None, s.patient_id)]
+        for session in stale:
+            self.prefetch(session)
+        return len(stale)
+
+    def prefetch(self, session):
+        """Fetch the session's snapshot in the background, dropping the current one"""
+        with self._lock:
+            session._generation += 1
+            generation = session._generation
+            session.snapshot = None
+            session.snapshot_bytes = 0
+            session.snapshot_error = None
+        patient_id, server = session.patient_id, session.server
+
+        def fetch():
+            snapshot = self.fetch_snapshot(patient_id, server)
+            failed = isinstance(snapshot, dict) and "error" in snapshot
+            size = 0 if failed else len(json.dumps(snapshot))
+            with self._lock:
+                # Ignore results a later prefetch (for another patient or server, or after a write) superseded
+                if session._generation != generation:
+                    return
+                if failed:
+                    session.snapshot_error = snapshot["error"]
+                    return
+                session.snapshot = snapshot
+                session.snapshot_bytes = size
+                session.fetched_at = time.time()
+                self._evict_locked(keep=session.token)
+
+        session._future = self._executor.submit(fetch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "snapshot_bytes": sum(s.snapshot_bytes for s in self._sessions.values()),
+                "max_snapshot_bytes": self.max_snapshot_bytes,
+                "evictions": self.evictions,
+            }
+
+    def shutdown(self, wait=False):
+        """Stop prefetching; with wait, let fetches already running finish first"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _evict_locked(self, keep=None):
+        now = time.time()
+        for token in [t for t, s in self._sessions.items() if now - s.last_access > self.idle_ttl and t != keep]:
+            del self._sessions[token]
+            self.evictions += 1
+
+        total_bytes = sum(s.snapshot_bytes for s in self._sessions.values())
+        for token in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions and total_bytes <= self.max_snapshot_bytes:
+                break
+            if token == keep:
+                continue
+            total_bytes -= self._sessions.pop(token).snapshot_bytes
+            self.evictions += 1
@@ -1,9 +1,97 @@
+import os
 from mcp import stdio_client, StdioServerParameters
 from strands.tools.mcp import MCPClient
+from strands.types.tools import AgentTool
 
-stdio_mcp_client = MCPClient(lambda: stdio_client(
-    StdioServerParameters(
-        command="uv",
-        args=["run", "Backend/fhir_mcp_server.py"]
-    )
-))
\ No newline at end of file
+
+def create_stdio_mcp_client():
+    """Build a new MCP client that spawns the FHIR MCP server over stdio"""
+    return MCPClient(lambda: stdio_client(
+        StdioServerParameters(
+            command="uv",
+            args=["run", "Backend/fhir_mcp_server.py"],
+            # The FHIR_* settings must reach the server so its registry matches the API's
+            env={**os.environ},
+        )
+    ))
+
+
+async def run_tool(tool, tool_use, invocation_state, **kwargs):
+    """Run an agent tool and return its final ToolResult
+
+    A tool's stream ends with its result: the ToolResult itself, or for the
+    SDK's own tools an event holding it under "tool_result".
+    """
+    result = None
+    async for event in tool.stream(tool_use, invocation_state, **kwargs):
+        result = event
+    if isinstance(result, dict) and "tool_result" in result:
+        return result["tool_result"]
+    return result
+
+
+class DelegatingTool(AgentTool):
+    """An agent tool standing in for another, with its name, spec and type
+
+    Subclasses change what a call does by overriding call(); stream() yields
+    the ToolResult it returns as the tool's last event, which is how the agent
+    reads the result of a tool it did not build.
+    """
+
+    def __init__(self, tool):
+        super().__init__()
+        self.tool = tool
+
+    @property
+    def tool_name(self):
+        return self.tool.tool_name
+
+    @property
+    def tool_spec(self):
+        return self.tool.tool_spec
+
+    @property
+    def tool_type(self):
+        return self.tool.tool_type
+
+    async def call(self, tool_use, invocation_state, **kwargs):
+        """Run the call and return its ToolResult; by default the wrapped tool runs it"""
+        return await run_tool(self.tool, tool_use, invocation_state, **kwargs)
+
+    async def stream(self, tool_use, invocation_state, **kwargs):
+        yield await self.call(tool_use, invocation_state, **kwargs)
+
+
+class ServerBoundTool(DelegatingTool):
+    """An MCP tool whose server argument is fixed by the application instead of the model
+
+    The argument is hidden from the tool spec the model sees and filled in on
+    every call, so each request's tools talk to that request's FHIR server.
+    """
+
+    def __init__(self, tool, server):
+        super().__init__(tool)
+        self.server = server
+
+    @property
+    def tool_spec(self):
+        spec = dict(self.tool.tool_spec)
+        schema = dict(spec["inputSchema"]["json"])
+        properties = dict(schema.get("properties", {}))
+        if "server" not in properties:
+            return spec
+        del properties["server"]
+        schema["properties"] = properties
+        schema["required"] = [name for name in schema.get("required", []) if name != "server"]
+        spec["inputSchema"] = {"json": schema}
+        return spec
+
+    async def call(self, tool_use, invocation_state, **kwargs):
+        if "server" in self.tool.tool_spec["inputSchema"]["json"].get("properties", {}):
+            tool_use = dict(tool_use, input=dict(tool_use.get("input") or {}, server=self.server))
+        return await super().call(tool_use, invocation_state, **kwargs)
+
+
+def bind_server(tools, server):
+    """Point every MCP tool that takes a server argument at server"""
+    return [ServerBoundTool(tool, server) for tool in tools]
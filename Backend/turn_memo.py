@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+from tools import DelegatingTool, run_tool
+
+logger = logging.getLogger(__name__)
+
+# Read tools whose results can be reused within a turn
+READ_TOOLS = {
+    "list_patients",
+    "get_patient",
+    "get_patient_conditions",
+    "get_patient_medications",
+    "get_patient_observations",
+    "get_patient_summary",
+    "get_patient_summaries",
+    "get_patient_everything",
+}
+
+# get_patient_summary sections and the tools that return the same data on their own
+SUMMARY_SECTIONS = {
+    "patient": "get_patient",
+    "conditions": "get_patient_conditions",
+    "medications": "get_patient_medications",
+    "observations": "get_patient_observations",
+}
+
+# Search filters of the per-type tools; a filtered result is not a summary section
+FILTER_ARGS = ("status", "code", "category", "date_from", "date_to", "sort", "count", "summary_count")
+
+# Read tools that include a patient's records of every type
+PATIENT_WIDE_TOOLS = {"get_patient_summary", "get_patient_summaries", "get_patient_everything"}
+
+# Read tools made stale by a write tool, for writes whose patient is not known
+WRITE_INVALIDATES = {
+    "create_patient": {"list_patients"},
+    "delete_patient": READ_TOOLS,
+    "create_condition": {"get_patient_conditions"} | PATIENT_WIDE_TOOLS,
+    "update_condition": {"get_patient_conditions"} | PATIENT_WIDE_TOOLS,
+    "delete_condition": {"get_patient_conditions"} | PATIENT_WIDE_TOOLS,
+    "create_medication": {"get_patient_medications"} | PATIENT_WIDE_TOOLS,
+    "update_medication": {"get_patient_medications"} | PATIENT_WIDE_TOOLS,
+    "delete_medication": {"get_patient_medications"} | PATIENT_WIDE_TOOLS,
+    "create_observation": {"get_patient_observations"} | PATIENT_WIDE_TOOLS,
+    "update_observation": {"get_patient_observations"} | PATIENT_WIDE_TOOLS,
+    "delete_observation": {"get_patient_observations"} | PATIENT_WIDE_TOOLS,
+    "create_patient_record": {"list_patients"},
+}
+
+
+class TurnMemo:
+    """Memoizes FHIR MCP read tools for the duration of one agent turn
+
+    Identical read calls share one result, including calls still in flight.
+    get_patient_summary is assembled from get_patient and the per-type tools
+    when those were already called with the same verbosity (and were not
+    truncated by max_resources), and the per-type tools are answered from an
+    earlier summary. A write tool drops the entries for the patient it
+    touched, or every entry it could affect when its patient is not known.
+    on_write(tool_name, patient_id or None) is called after each successful
+    write, so caches outside the turn can follow. failures counts tool calls
+    that raised or came back with an error status, which is how a broken MCP
+    connection shows; FHIR errors the tools report inside a result do not count.
+    """
+
+    def __init__(self, name="turn", on_write=None):
+        self.name = name
+        self.on_write = on_write
+        self._results = {}
+        self._args = {}
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.composed = 0
+        self.invalidated = 0
+        self.failures = 0
+
+    def wrap(self, tools):
+        """Return the tools with reads memoized and writes invalidating through this memo"""
+        return [MemoizedTool(tool, self) for tool in tools]
+
+    async def call(self, tool, tool_use, invocation_state, **kwargs):
+        name = tool.tool_name
+        args = _with_defaults(tool, tool_use.get("input") or {})
+        if name not in READ_TOOLS:
+            result = await self._run(tool, tool_use, invocation_state, **kwargs)
+            if name in WRITE_INVALIDATES and result.get("status") == "success":
+                self.writes += 1
+                self._invalidate(name, args)
+                if self.on_write is not None:
+                    self.on_write(name, args.get("patient_id") or _patient_in_json(args))
+            return result
+
+        key = _key(name, args)
+        if key in self._results:
+            self.hits += 1
+            return _for_tool_use(await asyncio.shield(self._results[key]), tool_use)
+
+        text = await self._reuse(name, args)
+        if text is not None:
+            self.composed += 1
+            return {"toolUseId": tool_use["toolUseId"], "status": "success", "content": [{"text": text}]}
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._results[key] = future
+        self._args[key] = args
+        try:
+            result = await self._run(tool, tool_use, invocation_state, **kwargs)
+        except Exception as e:
+            self._forget(key)
+            future.set_exception(e)
+            # Mark the exception retrieved when no other call was waiting on it
+            future.exception()
+            raise
+        future.set_result(result)
+        if not _is_success(result):
+            self._forget(key)
+        return result
+
+    async def _run(self, tool, tool_use, invocation_state, **kwargs):
+        try:
+            result = await run_tool(tool, tool_use, invocation_state, **kwargs)
+        except Exception:
+            self.failures += 1
+            raise
+        if (result or {}).get("status") == "error":
+            self.failures += 1
+        return result
+
+    def stats(self):
+        calls = self.hits + self.misses + self.composed
+        return {
+            "calls": calls,
+            "hits": self.hits,
+            "composed": self.composed,
+            "misses": self.misses,
+            "invalidated": self.invalidated,
+            "hit_rate": round((self.hits + self.composed) / calls, 3) if calls else 0.0,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        if stats["calls"]:
+            logger.info("%s tool memo: %s read calls, %s hits, %s composed, %s misses, %s invalidated",
+                        self.name, stats["calls"], stats["hits"], stats["composed"], stats["misses"],
+                        stats["invalidated"])
+
+    async def _reuse(self, name, args):
+        """Answer a read from overlapping results already fetched this turn, if possible"""
+        verbosity = args.get("verbosity", "compact")
+        if verbosity == "full" or "patient_id" not in args or _filtered(args):
+            return None
+        patient_id = args["patient_id"]
+
+        if name == "get_patient_summary":
+            sections = {}
+            for section, section_tool in SUMMARY_SECTIONS.items():
+                data = await self._fetched(section_tool, patient_id, verbosity)
+                if data is None or _truncated(data):
+                    return None
+                sections[section] = data
+            return json.dumps(sections, separators=(",", ":"))
+
+        section = next((s for s, t in SUMMARY_SECTIONS.items() if t == name), None)
+        if section is None:
+            return None
+        summary = await self._fetched("get_patient_summary", patient_id, verbosity)
+        if summary is None or section not in summary or "error" in summary[section]:
+            return None
+        data = summary[section]
+        limit = args.get("max_resources")
+        if isinstance(data, dict) and limit is not None:
+            records_key = "records" if "records" in data else "entry"
+            if len(data.get(records_key, [])) > limit:
+                data = dict(data, **{records_key: data[records_key][:limit], "count": limit})
+        return json.dumps(data, separators=(",", ":"))
+
+    async def _fetched(self, name, patient_id, verbosity):
+        """The parsed result of an earlier (or in-flight) call for a patient at a verbosity"""
+        for key, future in list(self._results.items()):
+            key_name, key_args = key[0], self._args[key]
+            if key_name != name or key_args.get("patient_id") != patient_id \
+                    or key_args.get("verbosity", "compact") != verbosity or _filtered(key_args):
+                continue
+            try:
+                result = await asyncio.shield(future)
+            except Exception:
+                return None
+            if not _is_success(result):
+                return None
+            try:
+                return json.loads(result["content"][0]["text"])
+            except (KeyError, IndexError, ValueError):
+                return None
+        return None
+
+    def _forget(self, key):
+        self._results.pop(key, None)
+        self._args.pop(key, None)
+
+    def _invalidate(self, name, args):
+        patient_id = args.get("patient_id") or _patient_in_json(args)
+        doomed = []
+        for key in self._results:
+            key_name, key_args = key[0], self._args[key]
+            if key_name == "list_patients" and name in ("create_patient", "create_patient_record", "delete_patient"):
+                doomed.append(key)
+            elif patient_id is not None:
+                if key_args.get("patient_id") == patient_id or patient_id in _patient_ids(key_args):
+                    doomed.append(key)
+            elif key_name in WRITE_INVALIDATES[name]:
+                doomed.append(key)
+        for key in doomed:
+            self._forget(key)
+        self.invalidated += len(doomed)
+
+
+class MemoizedTool(DelegatingTool):
+    """An MCP agent tool whose calls go through a TurnMemo"""
+
+    def __init__(self, tool, memo):
+        super().__init__(tool)
+        self.memo = memo
+
+    async def call(self, tool_use, invocation_state, **kwargs):
+        return await self.memo.call(self.tool, tool_use, invocation_state, **kwargs)
+
+
+def _with_defaults(tool, args):
+    """Fill in schema defaults so calls that spell out a default share a key with calls that omit it"""
+    properties = tool.tool_spec.get("inputSchema", {}).get("json", {}).get("properties", {})
+    defaults = {name: schema["default"] for name, schema in properties.items() if "default" in schema}
+    return dict(defaults, **args)
+
+
+def _key(name, args):
+    return name, tuple(sorted((k, json.dumps(v, sort_keys=True)) for k, v in args.items()))
+
+
+def _for_tool_use(result, tool_use):
+    return dict(result, toolUseId=tool_use["toolUseId"])
+
+
+def _is_success(result):
+    if not result or result.get("status") != "success":
+        return False
+    text = "".join(block.get("text", "") for block in result.get("content", []))
+    # Tools report FHIR failures as {"error": ...} in a successful result
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return True
+    return not (isinstance(data, dict) and "error" in data)
+
+
+def _patient_ids(args):
+    return [patient_id.strip() for patient_id in str(args.get("patient_ids") or "").split(",")]
+
+
+def _filtered(args):
+    # count=0 is a filter too; empty strings and False are the tools' "no filter" defaults
+    return any(args.get(name) not in (None, "") and args.get(name) is not False for name in FILTER_ARGS)
+
+
+def _truncated(data):
+    """True when a projected Bundle holds fewer records than the server matched"""
+    return isinstance(data, dict) and "total" in data and "count" in data and data["count"] < data["total"]
+
+
+def _patient_in_json(args):
+    """Patient id from the subject of a *_json argument, if there is one"""
+    for name, value in args.items():
+        if name.endswith("_json") and isinstance(value, str):
+            try:
+                reference = (json.loads(value).get("subject") or {}).get("reference", "")
+            except (ValueError, AttributeError):
+                continue
+            if reference.startswith("Patient/"):
+                return reference.split("/", 1)[1]
+    return None
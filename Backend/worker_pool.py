@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PoolSaturated(Exception):
+    """Raised when every worker is busy and the wait queue is full"""
+
+
+class QueueTimeout(Exception):
+    """Raised when a job waited in the queue longer than the pool allows"""
+
+
+class AgentWorkerPool:
+    """Runs blocking agent calls off the event loop with bounded concurrency
+
+    At most max_workers jobs run at once and at most max_queue more wait for
+    a worker. Further submissions are rejected immediately with
+    PoolSaturated, and queued jobs that do not start within queue_timeout
+    seconds fail with QueueTimeout, so callers can answer 429/503 quickly
+    instead of piling up behind a slow agent loop.
+    """
+
+    def __init__(self, max_workers=4, max_queue=16, queue_timeout=30):
+        """
+        Args:
+            max_workers: Maximum number of agent calls running at once
+            max_queue: Maximum number of calls waiting for a worker
+            queue_timeout: Seconds a call may wait for a worker (0 waits forever)
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-worker")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._queued = 0
+        self._running = 0
+        self._waits = deque(maxlen=500)
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on a worker thread and await its result
+
+        Raises PoolSaturated when the pool is full, and QueueTimeout when no
+        worker picks the call up within queue_timeout seconds; a timed-out
+        call is withdrawn from the queue and never runs. Only the wait for a
+        worker is timed, not the call itself.
+        """
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PoolSaturated(
+                    f"All {self.max_workers} workers are busy and {self.max_queue} requests are queued"
+                )
+            self._pending += 1
+            self._queued += 1
+        loop = asyncio.get_running_loop()
+        started = asyncio.Event()
+        enqueued_at = time.monotonic()
+
+        def job():
+            with self._lock:
+                self._queued -= 1
+                self._waits.append(time.monotonic() - enqueued_at)
+                self._running += 1
+            try:
+                loop.call_soon_threadsafe(started.set)
+            except RuntimeError:
+                # The caller's loop has closed; the call still runs to completion
+                pass
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self._running -= 1
+            with self._lock:
+                self.completed += 1
+            return result
+
+        def release(_):
+            # A job counts against the pool until it finishes or is withdrawn,
+            # whether or not its caller is still waiting
+            with self._lock:
+                self._pending -= 1
+
+        future = self._executor.submit(job)
+        future.add_done_callback(release)
+        try:
+            if self.queue_timeout:
+                try:
+                    await asyncio.wait_for(started.wait(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    if self._withdraw(future):
+                        with self._lock:
+                            self.timed_out += 1
+                            self._waits.append(time.monotonic() - enqueued_at)
+                        raise QueueTimeout(f"Request waited {self.queue_timeout:.1f}s for a worker")
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The caller went away: drop the call if no worker has picked it up
+            self._withdraw(future)
+            raise
+
+    def _withdraw(self, future):
+        """Cancel a call that has not started; True if it was still queued"""
+        if future.cancel():
+            with self._lock:
+                self._queued -= 1
+            return True
+        return False
+
+    def is_saturated(self):
+        """True when a new submission would be rejected"""
+        with self._lock:
+            return self._pending >= self.max_workers + self.max_queue
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "wait_avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "wait_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                "wait_max": round(waits[-1], 3) if waits else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
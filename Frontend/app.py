@@ -1,7 +1,9 @@
 import streamlit as st
 import requests
+import plotly.graph_objects as go
 import time
 import datetime
+import json
 import os
 
 # page config
@@ -29,6 +31,8 @@
 
 if "patient_id" not in st.session_state:
     st.session_state.patient_id = None
+if "session_token" not in st.session_state:
+    st.session_state.session_token = None
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 
@@ -37,9 +41,16 @@
         "conditions": None,
         "meds": None,
         "labs": None,
+        "lab_series": None,
         "summary": None
     }
 
+def api_headers():
+    """Session header that ties backend requests to this user's patient"""
+    if st.session_state.session_token:
+        return {"X-Session-Token": st.session_state.session_token}
+    return {}
+
 st.markdown("""
 <div class="main-header">
     <h1>🩺 Health Buddy</h1>
@@ -76,6 +87,7 @@
                                     st.session_state.tab_data = {k: None for k in st.session_state.tab_data}
                                     st.session_state.chat_history = []
                                     st.session_state.patient_id = p_id_input
+                                    st.session_state.session_token = r.json().get("session_token")
                                     st.success(f"Logged in as {p_id_input}")
                                     time.sleep(0.5)
                                     st.rerun()
@@ -116,17 +128,18 @@
                         st.error("Name is required.")
                     else:
                         prompt = (
-                            f"Perform the following steps sequentially:\n"
-                            f"1. Create a new patient in the FHIR server. Name: {given_name} {family_name}, Gender: {gender}, DOB: {birth_date}.\n"
+                            f"Create this patient record with a single call to the create_patient_record tool "
+                            f"(do not create the resources one by one).\n"
+                            f"Patient - Name: {given_name} {family_name}, Gender: {gender}, DOB: {birth_date}.\n"
                         )
                         if conditions_input.strip():
-                            prompt += f"2. Create active Conditions: {conditions_input}.\n"
+                            prompt += f"Active Conditions: {conditions_input}.\n"
                         if meds_input.strip():
-                            prompt += f"3. Create active MedicationRequests: {meds_input}.\n"
+                            prompt += f"Active MedicationRequests: {meds_input}.\n"
                         if labs_input.strip():
-                            prompt += f"4. Create Observations (Labs): {labs_input}.\n"
+                            prompt += f"Observations (Labs): {labs_input}.\n"
 
-                        prompt += "5. IMPORTANT: Final response must include the new Patient ID."
+                        prompt += "IMPORTANT: Final response must include the new Patient ID."
 
                         with st.spinner("AI is working right now..."):
                             try:
@@ -152,15 +165,105 @@ def fetch_tab_data(key, query_text, force_refresh=False):
     if force_refresh or st.session_state.tab_data[key] is None:
         with st.spinner(f"AI is retrieving {key}..."):
             try:
-                r = requests.post(f"{API_BASE}/ask", json={"query": query_text}, timeout=60)
+                r = requests.post(f"{API_BASE}/ask", json={"query": query_text}, headers=api_headers(), timeout=60)
                 if r.status_code == 200:
                     st.session_state.tab_data[key] = r.json().get("answer", "No info found.")
                 else:
                     st.session_state.tab_data[key] = "Error fetching data."
             except:
-                st.session_state.tab_data[key] = "onnection Error."
+                st.session_state.tab_data[key] = "Connection Error."
+    return st.session_state.tab_data[key]
+
+def fetch_table(key, resource):
+    """Load patient records straight from the FHIR data endpoints (no LLM)"""
+    if st.session_state.tab_data[key] is None:
+        with st.spinner(f"Loading {key}..."):
+            try:
+                r = requests.get(
+                    f"{API_BASE}/patients/{st.session_state.patient_id}/{resource}",
+                    headers=api_headers(),
+                    timeout=30
+                )
+                if r.status_code == 200:
+                    st.session_state.tab_data[key] = r.json().get("rows", [])
+                else:
+                    st.session_state.tab_data[key] = f"Error fetching data ({r.status_code})."
+            except requests.exceptions.RequestException:
+                st.session_state.tab_data[key] = "Connection Error."
     return st.session_state.tab_data[key]
 
+def fetch_lab_series(max_points=500):
+    """Load numeric lab time series (normalized units, range flags) for the trend charts"""
+    if st.session_state.tab_data["lab_series"] is None:
+        with st.spinner("Loading lab trends..."):
+            try:
+                r = requests.get(
+                    f"{API_BASE}/patients/{st.session_state.patient_id}/observations/series",
+                    params={"max_points": max_points},
+                    headers=api_headers(),
+                    timeout=30
+                )
+                if r.status_code == 200:
+                    st.session_state.tab_data["lab_series"] = r.json().get("series", {})
+                else:
+                    st.session_state.tab_data["lab_series"] = f"Error fetching lab trends ({r.status_code})."
+            except requests.exceptions.RequestException:
+                st.session_state.tab_data["lab_series"] = "Connection Error."
+    return st.session_state.tab_data["lab_series"]
+
+FLAG_COLORS = {"low": "#1f77b4", "high": "#d62728", "normal": "#2ca02c"}
+
+def lab_chart(series):
+    """Line chart of one lab's values, with its reference range shaded and out-of-range points colored"""
+    fig = go.Figure()
+    low, high = series.get("ref_low"), series.get("ref_high")
+    if low is not None and high is not None:
+        fig.add_hrect(y0=low, y1=high, fillcolor="#2ca02c", opacity=0.1, line_width=0)
+    fig.add_trace(go.Scattergl(
+        x=series["time"],
+        y=series["value"],
+        mode="lines+markers",
+        line={"color": "#888", "width": 1},
+        marker={"color": [FLAG_COLORS.get(flag, "#888") for flag in series["flag"]], "size": 6},
+        hovertemplate="%{x}<br>%{y} " + (series.get("unit") or "") + "<extra></extra>"
+    ))
+    fig.update_layout(
+        title=series.get("display"),
+        yaxis_title=series.get("unit"),
+        height=320,
+        margin={"l": 40, "r": 20, "t": 40, "b": 30},
+        showlegend=False
+    )
+    return fig
+
+def show_lab_trends(data):
+    if isinstance(data, str):
+        st.error(data)
+        return
+    trends = {code: s for code, s in data.items() if len(s["time"]) > 1}
+    if not trends:
+        st.info("Not enough numeric lab results to chart trends.")
+        return
+    labels = {f"{s.get('display') or code} ({code})": code for code, s in trends.items()}
+    chosen = st.multiselect("Labs", list(labels), default=list(labels)[:3], key="lab_trend_codes")
+    for label in chosen:
+        series = trends[labels[label]]
+        st.plotly_chart(lab_chart(series), use_container_width=True)
+        flagged = sum(flag in ("low", "high") for flag in series["flag"])
+        shown = len(series["time"])
+        caption = f"{series['count']} results, {flagged} of {shown} shown out of range"
+        if shown < series["count"]:
+            caption += " (downsampled, extremes kept)"
+        st.caption(caption)
+
+def show_table(data, empty_message):
+    if isinstance(data, str):
+        st.error(data)
+    elif not data:
+        st.info(empty_message)
+    else:
+        st.dataframe(data, use_container_width=True, hide_index=True)
+
 tab1, tab2, tab3, tab4, tab5 = st.tabs([
     "🩺 Conditions",
     "💊 Meds",
@@ -171,33 +274,24 @@ def fetch_tab_data(key, query_text, force_refresh=False):
 
 with tab1:
     st.subheader("Medical Conditions")
-    if st.session_state.tab_data["conditions"] is None:
-        if st.button("Load Conditions", key="load_conditions"):
-            fetch_tab_data("conditions", "List my active medical conditions in a clean bulleted list.", force_refresh=True)
-            st.rerun()
-        st.info("Click to load your conditions")
-    else:
-        st.markdown(st.session_state.tab_data["conditions"])
+    if st.button("🔄 Refresh", key="refresh_conditions"):
+        st.session_state.tab_data["conditions"] = None
+    show_table(fetch_table("conditions", "conditions"), "No conditions recorded.")
 
 with tab2:
     st.subheader("Medications")
-    if st.session_state.tab_data["meds"] is None:
-        if st.button("Load Medications", key="load_meds"):
-            fetch_tab_data("meds", "What medications am I currently taking? List them with dosage.", force_refresh=True)
-            st.rerun()
-        st.info("Click to load your medications")
-    else:
-        st.markdown(st.session_state.tab_data["meds"])
+    if st.button("🔄 Refresh", key="refresh_meds"):
+        st.session_state.tab_data["meds"] = None
+    show_table(fetch_table("meds", "medications"), "No medications recorded.")
 
 with tab3:
     st.subheader("Lab Results")
-    if st.session_state.tab_data["labs"] is None:
-        if st.button("Load Lab Results", key="load_labs"):
-            fetch_tab_data("labs", "Summarize my recent lab results and observations.", force_refresh=True)
-            st.rerun()
-        st.info("Click to load your lab results")
-    else:
-        st.markdown(st.session_state.tab_data["labs"])
+    if st.button("🔄 Refresh", key="refresh_labs"):
+        st.session_state.tab_data["labs"] = None
+        st.session_state.tab_data["lab_series"] = None
+    show_table(fetch_table("labs", "observations"), "No lab results recorded.")
+    st.subheader("Trends")
+    show_lab_trends(fetch_lab_series())
 
 with tab4:
     st.subheader("Health Summary")
@@ -261,7 +355,7 @@ def fetch_tab_data(key, query_text, force_refresh=False):
 
             with st.spinner("AI is reading and updating your records..."):
                 try:
-                    r = requests.post(f"{API_BASE}/ask", json={"query": prompt}, timeout=60)
+                    r = requests.post(f"{API_BASE}/ask", json={"query": prompt}, headers=api_headers(), timeout=60)
                     if r.status_code == 200:
                         st.success("Update Successful!")
                         st.markdown(r.json().get("answer", ""))
@@ -282,35 +376,57 @@ def fetch_tab_data(key, query_text, force_refresh=False):
 
 user_input = st.chat_input("Type your question here.")
 
+def stream_answer(query, placeholder, status):
+    """Stream an answer from /ask/stream, rendering tokens as they arrive"""
+    answer = ""
+    event_type = None
+    with requests.post(
+        f"{API_BASE}/ask/stream",
+        json={"query": query},
+        headers=api_headers(),
+        stream=True,
+        timeout=(5, 120)
+    ) as response:
+        if response.status_code in (429, 503):
+            return "The assistant is busy right now. Please try again in a few seconds."
+        if response.status_code != 200:
+            return f"Server returned error {response.status_code}"
+
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event_type = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                event = json.loads(line[len("data:"):])
+                if event_type == "token":
+                    answer += event["text"]
+                    placeholder.markdown(answer + "▌")
+                elif event_type == "tool":
+                    status.caption(f"🔎 Looking up: {event['name']}")
+                elif event_type == "done":
+                    answer = event.get("answer") or answer
+                elif event_type == "error":
+                    return f"Backend error: {event['error']}"
+    return answer or "No response from server"
+
 if user_input:
     st.session_state.chat_history.append({"role": "user", "content": user_input})
+    with st.chat_message("user"):
+        st.markdown(user_input)
 
-    with st.spinner("🤔Thinking..."):
+    with st.chat_message("assistant"):
+        status = st.empty()
+        placeholder = st.empty()
+        placeholder.markdown("🤔Thinking...")
         try:
-            response = requests.post(
-                f"{API_BASE}/ask",
-                json={"query": user_input},
-                timeout=60
-            )
-
-            data = response.json()
-
-            if response.status_code != 200:
-                answer = f"Server returned error {response.status_code}"
-            elif "error" in data:
-                answer = f"Backend error: {data['error']}"
-            else:
-                answer = data.get("answer", "No response from server")
-                accuracy = data.get("accuracy_score")
-                if accuracy is not None:
-                    answer += f"\n\n*(Answer confidence: {accuracy})*"
-
+            answer = stream_answer(user_input, placeholder, status)
         except requests.exceptions.ConnectionError:
             answer = "Cannot reach backend API."
         except requests.exceptions.Timeout:
-            answer = "Request timed out after 60 seconds."
+            answer = "Request timed out waiting for the assistant."
         except Exception as e:
             answer = f"Error: {str(e)}"
+        status.empty()
+        placeholder.markdown(answer, unsafe_allow_html=True)
 
     st.session_state.chat_history.append({"role": "assistant", "content": answer})
     st.rerun()
@@ -319,10 +435,11 @@ def fetch_tab_data(key, query_text, force_refresh=False):
     st.write(f"Logged in as: **{st.session_state.patient_id}**")
     if st.button("🚪 Logout", type="primary"):
         try:
-            requests.delete(f"{API_BASE}/patient")
+            requests.delete(f"{API_BASE}/patient", headers=api_headers())
         except:
             pass
         st.session_state.patient_id = None
+        st.session_state.session_token = None
         st.session_state.chat_history = []
         st.session_state.tab_data = {k: None for k in st.session_state.tab_data}
 
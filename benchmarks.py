@@ -0,0 +1,379 @@
+"""
+Local performance benchmarks
+Run with: uv run python benchmarks.py <name> [options]
+
+  scorer   Answer-grounding scorer throughput per backend
+  bulk     Bulk Data $export ingestion against the local stand-in server
+  batch    Multi-patient summaries by batch size against the local stand-in server
+  compaction  Token reduction of context compaction on a Synthea-style patient record
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'Backend'))
+# The batch benchmark serves searches from the tests' stub FHIR server
+sys.path.append(os.path.join(os.path.dirname(__file__), 'tests'))
+
+
+def bench_scorer(args):
+    from answer_accuarcy import GroundingScorer
+
+    answers = [f"Your glucose reading of {100 + i} mg/dL is above the normal range." for i in range(args.requests)]
+    context = "Observation Glucose 140 mg/dL final laboratory. Condition Type 2 diabetes active. " * 20
+
+    for backend in args.backends:
+        print(f"\nBackend: {backend}")
+        scorer = GroundingScorer(backend=backend, local_files_only=args.local_only)
+
+        start = time.perf_counter()
+        scorer.score("warm up", "warm up")
+        print(f"   Model load:          {time.perf_counter() - start:.2f}s")
+
+        # Cold, one caller at a time: one encode call per request
+        start = time.perf_counter()
+        for answer in answers:
+            scorer.score(answer, context)
+        elapsed = time.perf_counter() - start
+        print(f"   Sequential:          {len(answers) / elapsed:8.1f} scores/s")
+
+        # Cold, concurrent callers: micro-batched into shared encode calls
+        scorer = GroundingScorer(backend=backend, local_files_only=args.local_only)
+        scorer.score("warm up", "warm up")
+        fresh = [answer + " (concurrent)" for answer in answers]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(lambda answer: scorer.score(answer, context), fresh))
+        elapsed = time.perf_counter() - start
+        print(f"   Concurrent x{args.concurrency:<3}      {len(answers) / elapsed:8.1f} scores/s")
+
+        # Warm: every embedding already cached
+        start = time.perf_counter()
+        for answer in fresh:
+            scorer.score(answer, context)
+        elapsed = time.perf_counter() - start
+        print(f"   Cached:              {len(answers) / elapsed:8.1f} scores/s")
+        print(f"   Stats: {scorer.stats()}")
+
+
+def bench_bulk(args):
+    from bulk_export import BulkExportClient, NDJSONDirectoryStore
+    from bulk_stub_server import make_server, synthetic_fixtures
+
+    files = synthetic_fixtures(args.patients)
+    resources = sum(f.count(b"\n") for f in files.values())
+    print(f"Fixtures: {args.patients} patients, {resources} resources, "
+          f"{sum(len(f) for f in files.values()) / 1e6:.1f} MB")
+
+    for label, fail_once_after in (("Clean", None), ("Interrupted", 100_000)):
+        server = make_server(files, polls_before_ready=1, fail_once_after=fail_once_after)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with tempfile.TemporaryDirectory() as out:
+            client = BulkExportClient(
+                f"http://127.0.0.1:{server.server_port}/fhir",
+                NDJSONDirectoryStore(out),
+                state_path=os.path.join(out, "export_state.json"),
+                max_workers=args.workers,
+                poll_interval=0.1,
+            )
+            stats = client.run()
+        server.shutdown()
+        if "error" in stats:
+            print(f"   {label}: {stats['error']}")
+            continue
+        print(f"   {label + ':':<14} {stats['resources_per_second']:10.1f} resources/s  "
+              f"({stats['seconds']}s, {stats['retries']} resumed downloads)")
+
+
+def bench_batch(args):
+    from FHIRClient import FHIRClient
+    from bulk_stub_server import synthetic_fixtures
+    from fhir_stub import make_server
+
+    server = make_server(synthetic_fixtures(args.patients), latency=args.latency / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/fhir"
+    patient_ids = [f"bulk-{i}" for i in range(args.patients)]
+    print(f"{args.patients} patients, {args.latency:.0f} ms added per request, {args.workers} workers")
+
+    def report(label, elapsed, client, failed):
+        sent = sum(pool["requests"] for pool in client.pool_stats())
+        print(f"   {label:<24} {elapsed * 1000 / len(patient_ids):7.2f} ms/patient  "
+              f"{sent:5d} requests  {elapsed:6.2f}s  {failed} failed")
+
+    # Baseline: one get_patient_summary per patient, as many at once as the batches get
+    client = FHIRClient(base_url, pool_maxsize=args.workers)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        summaries = list(pool.map(client.get_patient_summary, patient_ids))
+    failed = sum(any("error" in section for section in summary.values()) for summary in summaries)
+    report("get_patient_summary", time.perf_counter() - start, client, failed)
+
+    for batch_size in args.batch_sizes:
+        client = FHIRClient(base_url, pool_maxsize=args.workers)
+        start = time.perf_counter()
+        result = client.get_patient_summaries(patient_ids, batch_size=batch_size, max_workers=args.workers)
+        report(f"batch_size={batch_size}", time.perf_counter() - start, client, len(result["failed"]))
+    server.shutdown()
+
+
+VITALS = [
+    ("8302-2", "Body Height", "cm", 160, 185, None),
+    ("29463-7", "Body Weight", "kg", 70, 110, None),
+    ("39156-5", "Body mass index (BMI) [Ratio]", "kg/m2", 22, 36, (18.5, 25)),
+    ("8867-4", "Heart rate", "/min", 58, 105, (60, 100)),
+    ("9279-1", "Respiratory rate", "/min", 12, 20, (12, 20)),
+    ("8310-5", "Body temperature", "Cel", 36.4, 37.6, None),
+]
+LABS = [
+    ("2339-0", "Glucose [Mass/volume] in Blood", "mg/dL", 75, 180, (70, 99)),
+    ("4548-4", "Hemoglobin A1c/Hemoglobin.total in Blood", "%", 5.2, 9.4, (4.0, 5.6)),
+    ("2093-3", "Cholesterol [Mass/volume] in Serum or Plasma", "mg/dL", 150, 260, (0, 200)),
+    ("2571-8", "Triglycerides", "mg/dL", 90, 280, (0, 150)),
+    ("18262-6", "Low Density Lipoprotein Cholesterol", "mg/dL", 70, 190, (0, 100)),
+    ("2085-9", "High Density Lipoprotein Cholesterol", "mg/dL", 30, 75, (40, 200)),
+    ("38483-4", "Creatinine", "mg/dL", 0.6, 1.6, (0.7, 1.3)),
+]
+CONDITIONS = [
+    ("44054006", "Diabetes mellitus type 2 (disorder)", "E11.9"), ("59621000", "Essential hypertension (disorder)", "I10"),
+    ("55822004", "Hyperlipidemia (disorder)", "E78.5"), ("162864005", "Body mass index 30+ - obesity (finding)", "E66.9"),
+    ("195662009", "Acute viral pharyngitis (disorder)", "J02.9"), ("10509002", "Acute bronchitis (disorder)", "J20.9"),
+    ("444814009", "Viral sinusitis (disorder)", "J01.90"), ("40055000", "Chronic sinusitis (disorder)", "J32.9"),
+    ("267036007", "Dyspnea (finding)", "R06.00"), ("68496003", "Polyp of colon (disorder)", "K63.5"),
+    ("431855005", "Chronic kidney disease stage 1 (disorder)", "N18.1"), ("38341003", "Hypertensive disorder (disorder)", "I10"),
+]
+MEDICATIONS = [
+    ("860975", "24 HR Metformin hydrochloride 500 MG Extended Release Oral Tablet", "active"),
+    ("314076", "lisinopril 10 MG Oral Tablet", "active"), ("259255", "atorvastatin 80 MG Oral Tablet", "active"),
+    ("308136", "amLODIPine 2.5 MG Oral Tablet", "stopped"), ("313782", "Acetaminophen 325 MG Oral Tablet", "stopped"),
+    ("849574", "Naproxen sodium 220 MG Oral Tablet", "stopped"), ("562251", "Amoxicillin 250 MG Oral Capsule", "completed"),
+    ("897122", "3 ML liraglutide 6 MG/ML Pen Injector", "active"),
+]
+
+
+def _narrative(text):
+    return {"status": "generated", "div": f'<div xmlns="http://www.w3.org/1999/xhtml">{text}</div>'}
+
+
+def _meta(profile):
+    return {"versionId": "1", "lastUpdated": "2024-06-01T12:00:00.000+00:00", "source": "#synthea",
+            "profile": [f"http://hl7.org/fhir/us/core/StructureDefinition/{profile}"]}
+
+
+def synthea_patient(years=5, visits_per_year=4, seed=7):
+    """A Synthea-shaped patient record as get_patient_summary returns it (raw resources in search Bundles)"""
+    rng = random.Random(seed)
+    patient_id = "synthea-1"
+    subject = {"reference": f"Patient/{patient_id}", "display": "Mrs. Jane Doe"}
+    patient = {
+        "resourceType": "Patient", "id": patient_id, "meta": _meta("us-core-patient"),
+        "text": _narrative("Generated by Synthea. Version identifier: v3.0.0 . Person seed: 1234567890"),
+        "extension": [
+            {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race", "extension": [
+                {"url": "ombCategory", "valueCoding": {"system": "urn:oid:2.16.840.1.113883.6.238",
+                                                       "code": "2106-3", "display": "White"}},
+                {"url": "text", "valueString": "White"}]},
+            {"url": "http://hl7.org/fhir/StructureDefinition/patient-mothersMaidenName", "valueString": "Smith"},
+            {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex", "valueCode": "F"},
+        ],
+        "identifier": [
+            {"system": "https://github.com/synthetichealth/synthea", "value": "b1e3c0a4-9c7e-4a1f-8f0e-3d1f2c4b5a6e"},
+            {"type": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v2-0203", "code": "MR",
+                                  "display": "Medical Record Number"}], "text": "Medical Record Number"},
+             "system": "http://hospital.smarthealthit.org", "value": "b1e3c0a4-9c7e-4a1f-8f0e-3d1f2c4b5a6e"},
+            {"type": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v2-0203", "code": "SS",
+                                  "display": "Social Security Number"}], "text": "Social Security Number"},
+             "system": "http://hl7.org/fhir/sid/us-ssn", "value": "999-12-3456"},
+        ],
+        "name": [{"use": "official", "family": "Doe", "given": ["Jane"], "prefix": ["Mrs."]}],
+        "telecom": [{"system": "phone", "value": "555-123-4567", "use": "home"}],
+        "gender": "female", "birthDate": "1961-04-12",
+        "address": [{"line": ["123 Main St"], "city": "Boston", "state": "MA", "postalCode": "02118", "country": "US"}],
+        "maritalStatus": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/v3-MaritalStatus",
+                                      "code": "M", "display": "Married"}], "text": "Married"},
+        "communication": [{"language": {"coding": [{"system": "urn:ietf:bcp:47", "code": "en-US",
+                                                    "display": "English (United States)"}]}}],
+    }
+
+    def bundle(resources):
+        return {"resourceType": "Bundle", "type": "searchset", "total": len(resources),
+                "link": [{"relation": "self", "url": f"http://example.org/fhir/{resources[0]['resourceType']}"}],
+                "entry": [{"fullUrl": f"http://example.org/fhir/{r['resourceType']}/{r['id']}", "resource": r,
+                           "search": {"mode": "match"}} for r in resources]}
+
+    def concept(system, code, display):
+        return {"coding": [{"system": system, "code": code, "display": display}], "text": display}
+
+    start = 2024 - years
+    conditions = []
+    for i, (code, display, icd) in enumerate(CONDITIONS):
+        resolved = i >= 4 and i % 3 != 2
+        onset = f"{start + i % years}-{1 + i % 12:02d}-15T09:00:00Z"
+        conditions.append({
+            "resourceType": "Condition", "id": f"cond-{i}", "meta": _meta("us-core-condition"),
+            "text": _narrative(display),
+            "clinicalStatus": concept("http://terminology.hl7.org/CodeSystem/condition-clinical",
+                                      "resolved" if resolved else "active", "Resolved" if resolved else "Active"),
+            "verificationStatus": concept("http://terminology.hl7.org/CodeSystem/condition-ver-status",
+                                          "confirmed", "Confirmed"),
+            "category": [concept("http://terminology.hl7.org/CodeSystem/condition-category",
+                                 "encounter-diagnosis", "Encounter Diagnosis")],
+            "code": {"coding": [{"system": "http://snomed.info/sct", "code": code, "display": display},
+                                {"system": "http://snomed.info/sct", "code": code, "display": display},
+                                {"system": "http://hl7.org/fhir/sid/icd-10-cm", "code": icd, "display": display}],
+                     "text": display},
+            "subject": subject, "encounter": {"reference": f"Encounter/enc-{i}"},
+            "onsetDateTime": onset, "recordedDate": onset,
+            **({"abatementDateTime": f"{start + i % years}-{1 + i % 12:02d}-29T09:00:00Z"} if resolved else {}),
+        })
+
+    medications = []
+    for i, (code, display, status) in enumerate(MEDICATIONS):
+        medications.append({
+            "resourceType": "MedicationRequest", "id": f"med-{i}", "meta": _meta("us-core-medicationrequest"),
+            "text": _narrative(display), "status": status, "intent": "order",
+            "medicationCodeableConcept": concept("http://www.nlm.nih.gov/research/umls/rxnorm", code, display),
+            "subject": subject, "encounter": {"reference": f"Encounter/enc-{i}"},
+            "authoredOn": f"{start + i % years}-{1 + (3 * i) % 12:02d}-10T10:00:00Z",
+            "requester": {"reference": "Practitioner/prac-1", "display": "Dr. Alan Grant"},
+            "reasonReference": [{"reference": f"Condition/cond-{i % len(CONDITIONS)}"}],
+            "dosageInstruction": [{"sequence": 1, "text": "Take 1 tablet by mouth daily",
+                                   "timing": {"repeat": {"frequency": 1, "period": 1, "periodUnit": "d"}},
+                                   "asNeededBoolean": False,
+                                   "doseAndRate": [{"type": concept("http://terminology.hl7.org/CodeSystem/dose-rate-type",
+                                                                    "ordered", "Ordered"),
+                                                    "doseQuantity": {"value": 1}}]}],
+        })
+
+    observations = []
+
+    def observation(when, category, code, display, value, unit, reference=None, components=None):
+        resource = {
+            "resourceType": "Observation", "id": f"obs-{len(observations)}",
+            "meta": _meta("vitalsigns" if category == "vital-signs" else "us-core-observation-lab"),
+            "text": _narrative(f"{when[:10]}: {display} = {value} {unit}"),
+            "status": "final",
+            "category": [concept("http://terminology.hl7.org/CodeSystem/observation-category", category,
+                                 "Vital signs" if category == "vital-signs" else "Laboratory")],
+            "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display},
+                                {"system": "http://loinc.org", "code": code, "display": display}],
+                     "text": display},
+            "subject": subject, "encounter": {"reference": f"Encounter/enc-{when[:10]}"},
+            "effectiveDateTime": when, "issued": when.replace("Z", ".000+00:00"),
+        }
+        if components:
+            resource["component"] = components
+        else:
+            resource["valueQuantity"] = {"value": value, "unit": unit, "system": "http://unitsofmeasure.org",
+                                         "code": unit}
+        if reference:
+            low, high = reference
+            resource["referenceRange"] = [{"low": {"value": low, "unit": unit}, "high": {"value": high, "unit": unit}}]
+            if value is not None and not low <= value <= high:
+                resource["interpretation"] = [concept(
+                    "http://terminology.hl7.org/CodeSystem/v3-ObservationInterpretation",
+                    "H" if value > high else "L", "High" if value > high else "Low")]
+        observations.append(resource)
+
+    def quantity(low, high):
+        return round(rng.uniform(low, high), 1)
+
+    for year in range(start, 2024):
+        for visit in range(visits_per_year):
+            when = f"{year}-{1 + visit * 12 // visits_per_year:02d}-{rng.randint(1, 28):02d}T09:30:00Z"
+            for code, display, unit, low, high, reference in VITALS:
+                observation(when, "vital-signs", code, display, quantity(low, high), unit, reference)
+            components = [
+                {"code": concept("http://loinc.org", code, display),
+                 "valueQuantity": {"value": quantity(low, high), "unit": "mm[Hg]",
+                                   "system": "http://unitsofmeasure.org", "code": "mm[Hg]"}}
+                for code, display, low, high in (("8480-6", "Systolic Blood Pressure", 110, 165),
+                                                 ("8462-4", "Diastolic Blood Pressure", 65, 100))
+            ]
+            observation(when, "vital-signs", "85354-9", "Blood pressure panel with all children optional", None,
+                        "mm[Hg]", components=components)
+            if visit == 0:
+                for code, display, unit, low, high, reference in LABS:
+                    observation(when, "laboratory", code, display, quantity(low, high), unit, reference)
+
+    return {"patient": patient, "conditions": bundle(conditions), "medications": bundle(medications),
+            "observations": bundle(observations)}
+
+
+def bench_compaction(args):
+    from context_compaction import compact_text
+    from fhir_projection import estimate_tokens, render
+
+    summary = synthea_patient(years=args.years, visits_per_year=args.visits)
+    counts = {section: len(data.get("entry", [])) for section, data in summary.items() if "entry" in data}
+    print(f"Synthea-style patient, {args.years} years: {counts['conditions']} conditions, "
+          f"{counts['medications']} medications, {counts['observations']} observations")
+
+    latest_a1c = [e["resource"] for e in summary["observations"]["entry"]
+                  if e["resource"]["code"]["coding"][0]["code"] == "4548-4"][-1]["valueQuantity"]["value"]
+    # (query, text that must survive compaction for the query to be answerable)
+    queries = [
+        ("What was the latest hemoglobin A1c?", f"{latest_a1c} %"),
+        ("How has the blood pressure changed?", "Blood pressure"),
+        ("Which medications is she taking?", "liraglutide"),
+    ]
+    for verbosity in ("full", "compact"):
+        text, _ = render(summary, verbosity)
+        tokens = estimate_tokens(text)
+        print(f"\nget_patient_summary, verbosity={verbosity}: {tokens} tokens")
+        for budget in [None] + args.budgets:
+            for query, marker in queries if budget else queries[:1]:
+                start = time.perf_counter()
+                compacted, stats = compact_text(text, budget, query)
+                elapsed = time.perf_counter() - start
+                label = f"budget={budget}" if budget else "no budget"
+                print(f"   {label:<13} {stats['tokens']:7d} tokens  {1 - stats['tokens'] / tokens:6.1%} smaller  "
+                      f"{elapsed * 1000:6.1f} ms  "
+                      + (f"{'kept' if marker in compacted else 'LOST'} for: {query}" if budget else ""))
+    if args.dump:
+        compacted, _ = compact_text(render(summary, "compact")[0], args.budgets[-1], queries[0][0])
+        print(json.dumps(json.loads(compacted), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local performance benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    scorer = subparsers.add_parser("scorer", help="answer-grounding scorer throughput")
+    scorer.add_argument("--backends", nargs="+", default=["torch", "quantized"], choices=["torch", "onnx", "quantized"])
+    scorer.add_argument("--requests", type=int, default=200)
+    scorer.add_argument("--concurrency", type=int, default=16)
+    scorer.add_argument("--local-only", action="store_true", help="load the model from the local Hugging Face cache only")
+    scorer.set_defaults(run=bench_scorer)
+
+    bulk = subparsers.add_parser("bulk", help="Bulk Data $export ingestion")
+    bulk.add_argument("--patients", type=int, default=2000)
+    bulk.add_argument("--workers", type=int, default=4)
+    bulk.set_defaults(run=bench_bulk)
+
+    batch = subparsers.add_parser("batch", help="multi-patient summaries by batch size")
+    batch.add_argument("--patients", type=int, default=200)
+    batch.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 5, 10, 20, 50])
+    batch.add_argument("--latency", type=float, default=20, help="milliseconds added to every request")
+    batch.add_argument("--workers", type=int, default=4)
+    batch.set_defaults(run=bench_batch)
+
+    compaction = subparsers.add_parser("compaction", help="token reduction of context compaction")
+    compaction.add_argument("--years", type=int, default=5)
+    compaction.add_argument("--visits", type=int, default=4, help="visits with vital signs per year")
+    compaction.add_argument("--budgets", type=int, nargs="+", default=[8000, 4000, 2000, 1000])
+    compaction.add_argument("--dump", action="store_true", help="print the compacted record at the smallest budget")
+    compaction.set_defaults(run=bench_compaction)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
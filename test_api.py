@@ -20,6 +20,7 @@
 
 # Test 2: Set a patient ID
 print("\n2. Testing POST /patient (set patient ID)...")
+headers = {}
 try:
     response = requests.post(
         f"{API_BASE}/patient",
@@ -27,13 +28,14 @@
     )
     print(f"   Status: {response.status_code}")
     print(f"   Response: {response.json()}")
+    headers = {"X-Session-Token": response.json().get("session_token", "")}
 except Exception as e:
     print(f"   Error: {e}")
 
 # Test 3: Get patient ID
 print("\n3. Testing GET /patient (get current patient ID)...")
 try:
-    response = requests.get(f"{API_BASE}/patient")
+    response = requests.get(f"{API_BASE}/patient", headers=headers)
     print(f"   Status: {response.status_code}")
     print(f"   Response: {response.json()}")
 except Exception as e:
@@ -45,6 +47,7 @@
     response = requests.post(
         f"{API_BASE}/ask",
         json={"query": "What is diabetes?"},
+        headers=headers,
         timeout=60  # Medical queries might take longer
     )
     print(f"   Status: {response.status_code}")
@@ -6,10 +6,11 @@
 sys.path.append(os.path.join(os.path.dirname(__file__), 'Backend'))
 
 from agent import get_agent
-from tools import stdio_mcp_client
+from tools import create_stdio_mcp_client
 
 async def main():
 
+    stdio_mcp_client = create_stdio_mcp_client()
     with stdio_mcp_client:
         agent = get_agent(stdio_mcp_client.list_tools_sync())
 
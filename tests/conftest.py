@@ -0,0 +1,61 @@
+import threading
+import pytest
+from strands.types.tools import AgentTool
+from bulk_stub_server import synthetic_fixtures
+from fhir_stub import make_server
+
+
+@pytest.fixture
+def stub_server():
+    """Start fhir_stub servers for a test: stub_server(**make_server kwargs) -> base URL"""
+    servers = []
+
+    def start(files=None, **kwargs):
+        server = make_server(files if files is not None else synthetic_fixtures(4, observations_per_patient=3),
+                             **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}/fhir"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+class FakeTool(AgentTool):
+    """An agent tool answering every call with handler(input) as its text, recording the inputs"""
+
+    def __init__(self, name, handler, properties=None, sdk_events=False):
+        super().__init__()
+        self.name = name
+        self.handler = handler
+        self.properties = properties or {}
+        self.sdk_events = sdk_events
+        self.calls = []
+
+    @property
+    def tool_name(self):
+        return self.name
+
+    @property
+    def tool_spec(self):
+        return {"name": self.name, "description": self.name,
+                "inputSchema": {"json": {"type": "object", "properties": self.properties}}}
+
+    @property
+    def tool_type(self):
+        return "fake"
+
+    async def stream(self, tool_use, invocation_state, **kwargs):
+        self.calls.append(tool_use.get("input") or {})
+        result = {"toolUseId": tool_use["toolUseId"], "status": "success",
+                  "content": [{"text": self.handler(tool_use.get("input") or {})}]}
+        # The SDK's own tools end with an event holding the result under "tool_result"
+        yield {"tool_result": result} if self.sdk_events else result
+
+
+@pytest.fixture
+def fake_tool():
+    """fake_tool(name, handler, properties=None, sdk_events=False) -> FakeTool"""
+    return FakeTool
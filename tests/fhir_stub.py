@@ -0,0 +1,220 @@
+"""In-memory FHIR server the tests run the clients against
+
+Extends the Bulk Data stand-in in Backend/bulk_stub_server.py, so the same
+fixtures can be exported, read and searched. Searches go by _id, patient or
+_lastUpdated, can be sorted by _lastUpdated and are paged with next links;
+Patient searches ignore, honor or reject _revinclude. Transaction Bundles
+POSTed to the base URL and resources POSTed to a type add to the data, PUT
+and DELETE of Type/id change it, and every stored resource carries
+meta.versionId and lastUpdated. Patient reads answer with an ETag and honour
+If-None-Match with 304. The first requests can be answered 503, to exercise
+retries.
+"""
+
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
+
+from bulk_stub_server import BulkDataHandler, BulkDataServer
+
+
+class FHIRStubServer(BulkDataServer):
+    """Bulk Data stand-in that also serves and stores the exported resources"""
+
+    def __init__(self, address, handler, files, latency=0.0, page_size=100, failing_patients=(),
+                 revinclude="ignore", absolute_locations=True, unavailable_first=0, **export_options):
+        super().__init__(address, handler, files, **export_options)
+        self.latency = latency
+        self.unavailable_left = unavailable_first
+        self.page_size = page_size
+        self.failing_patients = set(failing_patients)
+        self.revinclude = revinclude
+        self.absolute_locations = absolute_locations
+        # Search index: {resourceType: {patient id: [resources]}}
+        self.by_patient = {}
+        # lastUpdated of the next write; one second apart so every write sorts after the last
+        self.clock = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for resource_type, body in files.items():
+            self.by_patient.setdefault(resource_type, {})
+            for line in body.splitlines():
+                if line.strip():
+                    self.add(json.loads(line))
+
+    def stamp(self, resource, previous=None):
+        self.clock += timedelta(seconds=1)
+        version = int(((previous or {}).get("meta") or {}).get("versionId", "0")) + 1
+        resource["meta"] = {"versionId": str(version), "lastUpdated": self.clock.strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    def add(self, resource, previous=None):
+        """Stamp a resource and index it under its patient; call with the lock held"""
+        self.stamp(resource, previous)
+        index = self.by_patient.setdefault(resource["resourceType"], {})
+        index.setdefault(patient_of(resource), []).append(resource)
+
+    def find(self, path):
+        """(list holding the resource, its index) for a /fhir/Type/id path, or None"""
+        segments = [s for s in path.split("/") if s]
+        if len(segments) != 3 or segments[0] != "fhir" or segments[1] not in self.by_patient:
+            return None
+        for resources in self.by_patient[segments[1]].values():
+            for index, resource in enumerate(resources):
+                if resource.get("id") == segments[2]:
+                    return resources, index
+        return None
+
+
+def patient_of(resource):
+    if resource["resourceType"] == "Patient":
+        return resource.get("id")
+    return (resource.get("subject") or {}).get("reference", "").split("/")[-1]
+
+
+class FHIRStubHandler(BulkDataHandler):
+    """Adds reads, searches and writes to the Bulk Data requests"""
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self._unavailable():
+            return
+        parts = urlsplit(self.path)
+        segments = [s for s in parts.path.split("/") if s]
+        by_patient = self.server.by_patient
+        if len(segments) == 2 and segments[0] == "fhir" and segments[1] in by_patient:
+            return self._search(segments[1], parse_qs(parts.query))
+        if len(segments) == 3 and segments[:2] == ["fhir", "Patient"] and by_patient["Patient"].get(segments[2]):
+            return self._read(by_patient["Patient"][segments[2]][0])
+        super().do_GET()
+
+    def do_POST(self):
+        if self._unavailable():
+            return
+        path = urlsplit(self.path).path.rstrip("/")
+        if path.startswith("/fhir/") and path.count("/") == 2:
+            return self._create(json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0)))))
+        if path != "/fhir":
+            return self._send(404, b'{"resourceType":"OperationOutcome"}')
+        bundle = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if bundle.get("type") != "transaction":
+            return self._send(400, b'{"resourceType":"OperationOutcome"}')
+        # Assign ids first, then point urn:uuid references at them
+        references = {}
+        for entry in bundle.get("entry", []):
+            resource = entry["resource"]
+            resource["id"] = uuid.uuid4().hex[:12]
+            references[entry.get("fullUrl")] = f"{resource['resourceType']}/{resource['id']}"
+        response = {"resourceType": "Bundle", "type": "transaction-response", "entry": []}
+        for entry in bundle.get("entry", []):
+            resource = entry["resource"]
+            subject = resource.get("subject") or {}
+            if subject.get("reference") in references:
+                subject["reference"] = references[subject["reference"]]
+            with self.server.lock:
+                self.server.add(resource)
+            location = f"{references[entry.get('fullUrl')]}/_history/1"
+            response["entry"].append({"response": {
+                "status": "201 Created",
+                "location": f"{self._base()}/{location}" if self.server.absolute_locations else location,
+            }})
+        self._send(200, json.dumps(response).encode(), {"Content-Type": "application/fhir+json"})
+
+    def do_PUT(self):
+        resource = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        with self.server.lock:
+            found = self.server.find(urlsplit(self.path).path)
+            if found is None:
+                return self._send(404, b'{"resourceType":"OperationOutcome"}')
+            resources, index = found
+            resource["id"] = resources[index]["id"]
+            previous = resources.pop(index)
+            self.server.add(resource, previous)
+        self._send(200, json.dumps(resource).encode(), {"Content-Type": "application/fhir+json"})
+
+    def do_DELETE(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/fhir/status/"):
+            return super().do_DELETE()
+        with self.server.lock:
+            found = self.server.find(path)
+            if found is None:
+                return self._send(404, b'{"resourceType":"OperationOutcome"}')
+            resources, index = found
+            del resources[index]
+        self._send(204, b"")
+
+    def _unavailable(self):
+        """Answer 503 while unavailable_first requests remain"""
+        with self.server.lock:
+            if self.server.unavailable_left <= 0:
+                return False
+            self.server.unavailable_left -= 1
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        self._send(503, b'{"resourceType":"OperationOutcome"}', {"Retry-After": "0"})
+        return True
+
+    def _read(self, resource):
+        etag = f'W/"{resource["meta"]["versionId"]}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, b"", {"ETag": etag})
+        self._send(200, json.dumps(resource).encode(), {"Content-Type": "application/fhir+json", "ETag": etag})
+
+    def _create(self, resource):
+        resource["id"] = uuid.uuid4().hex[:12]
+        with self.server.lock:
+            self.server.add(resource)
+        location = f"{self._base()}/{resource['resourceType']}/{resource['id']}/_history/1"
+        self._send(201, json.dumps(resource).encode(), {"Content-Type": "application/fhir+json", "Location": location})
+
+    def _search(self, resource_type, query):
+        server = self.server
+        ids = (query.get("_id") or query.get("patient") or [""])[0].split(",")
+        if server.failing_patients & set(ids):
+            return self._send(500, b'{"resourceType":"OperationOutcome"}')
+        includes = query.get("_revinclude", []) if resource_type == "Patient" else []
+        if includes and server.revinclude == "reject":
+            return self._send(400, b'{"resourceType":"OperationOutcome"}')
+        with server.lock:
+            if "_id" in query or "patient" in query:
+                matches = [r for patient_id in ids for r in server.by_patient[resource_type].get(patient_id, [])]
+            else:
+                matches = [r for resources in server.by_patient[resource_type].values() for r in resources]
+            included = [
+                r for include in (includes if server.revinclude == "honor" else [])
+                for patient_id in ids for r in server.by_patient.get(include.split(":")[0], {}).get(patient_id, [])
+            ]
+        since = query.get("_lastUpdated", [""])[0]
+        if since[:2] in ("ge", "gt"):
+            matches = [r for r in matches if r["meta"]["lastUpdated"] > since[2:]
+                       or since[:2] == "ge" and r["meta"]["lastUpdated"] == since[2:]]
+        sort = query.get("_sort", [""])[0]
+        if sort.lstrip("-") == "_lastUpdated":
+            matches.sort(key=lambda r: r["meta"]["lastUpdated"], reverse=sort.startswith("-"))
+        count = int(query.get("_count", [server.page_size])[0])
+        offset = int(query.get("_offset", ["0"])[0])
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(matches),
+            "entry": [{"resource": r, "search": {"mode": "match"}} for r in matches[offset:offset + count]],
+        }
+        if offset == 0:
+            bundle["entry"] += [{"resource": r, "search": {"mode": "include"}} for r in included]
+        if offset + count < len(matches):
+            params = "&".join(f"{name}={values[0]}" for name, values in query.items() if name != "_offset")
+            bundle["link"] = [{"relation": "next",
+                               "url": f"{self._base()}/{resource_type}?{params}&_offset={offset + count}"}]
+        self._send(200, json.dumps(bundle).encode(), {"Content-Type": "application/fhir+json"})
+
+
+def make_server(files, host="127.0.0.1", port=0, **options):
+    """Create (but do not start) a stub FHIR server over {resourceType: NDJSON bytes}
+
+    Takes the Bulk Data options of bulk_stub_server.make_server plus latency,
+    page_size, failing_patients, revinclude ("ignore", "honor" or "reject"),
+    absolute_locations and unavailable_first (requests answered 503).
+    """
+    return FHIRStubServer((host, port), FHIRStubHandler, files, **options)
@@ -0,0 +1,61 @@
+from answer_cache import AnswerCache
+from FHIRClient import FHIRClient
+
+
+def observation(patient_id, value):
+    return {
+        "resourceType": "Observation",
+        "status": "final",
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "code": {"coding": [{"system": "http://loinc.org", "code": "2339-0"}]},
+        "valueQuantity": {"value": value, "unit": "mg/dL"},
+    }
+
+
+def test_data_version_changes_with_any_edit_create_or_delete(stub_server):
+    client = FHIRClient(stub_server())
+    version = client.patient_data_version("bulk-0")
+    assert version is not None
+    assert client.patient_data_version("bulk-0") == version
+    other = client.patient_data_version("bulk-1")
+    assert other != version
+
+    # An edit to an older observation, in a field no summary projection keeps
+    oldest = client.get_patient_observations("bulk-0")["entry"][0]["resource"]
+    oldest["note"] = [{"text": "repeat fasting"}]
+    assert "error" not in client.update_observation(oldest["id"], oldest)
+    edited = client.patient_data_version("bulk-0")
+    assert edited != version
+
+    created = client.create_observation(observation("bulk-0", 130))
+    assert "error" not in created
+    added = client.patient_data_version("bulk-0")
+    assert added != edited
+
+    # Deleting an older observation leaves the newest lastUpdated alone; the total moves
+    assert "error" not in client.delete_observation("bulk-0-o1")
+    assert client.patient_data_version("bulk-0") not in (version, edited, added)
+    assert client.patient_data_version("bulk-1") == other
+
+
+def test_data_version_is_none_when_the_server_fails():
+    client = FHIRClient("http://127.0.0.1:9/fhir", timeout=(0.2, 0.2), max_retries=0)
+    assert client.patient_data_version("bulk-0") is None
+
+
+def test_answers_stop_matching_when_the_version_changes():
+    cache = AnswerCache(max_entries=8)
+    cache.store("smart", "p1", "What are the active conditions?", "v1", "Diabetes", seconds=4.0)
+    assert cache.lookup("smart", "p1", "what are the ACTIVE conditions", "v1") == "Diabetes"
+    assert cache.lookup("smart", "p1", "What are the active conditions?", "v2") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+
+def test_may_hit_only_when_the_patient_has_answers():
+    cache = AnswerCache(max_entries=8)
+    assert not cache.may_hit("smart", "p1")
+    cache.store("smart", "p1", "What are the active conditions?", "v1", "Diabetes", seconds=4.0)
+    assert cache.may_hit("smart", "p1")
+    assert not cache.may_hit("hapi", "p1") and not cache.may_hit("smart", "p2")
+    assert cache.stats()["misses"] == 3
@@ -0,0 +1,40 @@
+import asyncio
+import threading
+import time
+from AsyncFHIRClient import AsyncFHIRClient
+from FHIRClient import FHIRClient
+
+
+def test_calls_never_exceed_max_concurrency():
+    client = FHIRClient("http://fhir.invalid/fhir")
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def get_patient(patient_id, elements=None):
+        with lock:
+            running.append(patient_id)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(patient_id)
+        return {"resourceType": "Patient", "id": patient_id}
+
+    client.get_patient = get_patient
+    async_client = AsyncFHIRClient(client, max_concurrency=2)
+
+    async def read_all():
+        return await asyncio.gather(*(async_client.get_patient(f"p{i}") for i in range(8)))
+
+    patients = asyncio.run(read_all())
+    assert [p["id"] for p in patients] == [f"p{i}" for i in range(8)]
+    assert max(peak) == 2
+
+
+def test_summary_sections_fan_out_against_the_server(stub_server):
+    async_client = AsyncFHIRClient(base_url=stub_server(latency=0.1), max_concurrency=4)
+    started = time.monotonic()
+    summary = asyncio.run(async_client.get_patient_summary("bulk-0"))
+    assert summary["patient"]["id"] == "bulk-0"
+    # Four sequential 0.1s reads would take 0.4s
+    assert time.monotonic() - started < 0.35
@@ -0,0 +1,50 @@
+import asyncio
+import json
+from context_compaction import ContextCompactor, collapse_observations, fit_budget
+from tools import run_tool
+
+
+def glucose(value, day, flag=None):
+    observation = {
+        "resourceType": "Observation", "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "2339-0", "display": "Glucose"}]},
+        "effectiveDateTime": f"2024-01-{day:02d}T08:00:00Z",
+        "valueQuantity": {"value": value, "unit": "mg/dL"},
+    }
+    if flag:
+        observation["interpretation"] = [{"coding": [{"code": flag}]}]
+    return observation
+
+
+def test_repeated_observations_collapse_to_one_summary():
+    bundle = {"entry": [glucose(92, 1), glucose(140, 3, "H"), glucose(101, 2)]}
+    [record] = collapse_observations(bundle)["entry"]
+    assert record["readings"] == 3
+    assert (record["first"], record["last"]) == ("2024-01-01T08:00:00Z", "2024-01-03T08:00:00Z")
+    assert record["latest"] == "140 mg/dL" and record["previous"] == "101 mg/dL"
+    assert (record["min"], record["max"]) == ("92 mg/dL", "140 mg/dL")
+    assert record["flagged"] == 1 and record["latestFlagged"]
+
+
+def test_fit_budget_keeps_the_records_the_query_asks_about():
+    records = [{"condition": f"Condition {i}", "note": "x" * 200, "onset": "2020-01-01"} for i in range(10)]
+    records.append({"medication": "Metformin 500 MG", "status": "active", "authoredOn": "2020-01-01"})
+    value = fit_budget({"records": records}, budget=150, query="Is the patient taking metformin?")
+    assert {"medication": "Metformin 500 MG", "status": "active", "authoredOn": "2020-01-01"} in value["records"]
+    assert value["omitted"] == 11 - len(value["records"]) > 0
+
+
+def test_compacted_tool_compacts_read_results_only(fake_tool):
+    bundle = json.dumps({"resourceType": "Bundle", "entry": [{"resource": glucose(90 + day, day)} for day in range(1, 6)]})
+    read = fake_tool("get_patient_observations", lambda args: bundle, sdk_events=True)
+    write = fake_tool("create_observation", lambda args: bundle)
+    compactor = ContextCompactor(budget=4000, query="glucose trend")
+    tools = compactor.wrap([read, write])
+    assert tools[1] is write
+    assert tools[0].tool_name == "get_patient_observations"
+
+    result = asyncio.run(run_tool(tools[0], {"toolUseId": "t1", "input": {}}, {}))
+    compacted = json.loads(result["content"][0]["text"])
+    assert [record["readings"] for record in compacted["entry"]] == [5]
+    stats = compactor.stats.summary()
+    assert stats["calls"] == 1 and stats["saved_tokens"] > 0
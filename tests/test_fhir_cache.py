@@ -0,0 +1,55 @@
+import json
+import requests
+from fhir_cache import CacheEntry, ResourceCache, tags_for_url
+
+META = {"versionId": "3", "lastUpdated": "2024-05-01T10:00:00Z"}
+
+
+def response(body, headers=None):
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content = json.dumps(body).encode()
+    resp.headers.update(headers or {})
+    return resp
+
+
+def test_single_resources_fall_back_to_meta_validators():
+    entry = CacheEntry("http://x/fhir/Patient/1", response({"resourceType": "Patient", "id": "1", "meta": META}))
+    assert entry.validators() == {"If-None-Match": 'W/"3"', "If-Modified-Since": "Wed, 01 May 2024 10:00:00 GMT"}
+
+
+def test_bundles_are_not_revalidated_by_their_own_meta():
+    bundle = {"resourceType": "Bundle", "type": "searchset", "meta": META, "entry": []}
+    assert CacheEntry("http://x/fhir/Condition?patient=1", response(bundle)).validators() == {}
+    # Validators the server sent are still used
+    entry = CacheEntry("http://x/fhir/Condition?patient=1", response(bundle, {"ETag": 'W/"b7"'}))
+    assert entry.validators() == {"If-None-Match": 'W/"b7"'}
+
+
+def test_writes_invalidate_the_patients_entries_and_untagged_searches():
+    cache = ResourceCache(max_entries=2, ttl=60)
+    base = "http://x/fhir"
+    for url in (f"{base}/Patient/1", f"{base}/Condition?patient=1", f"{base}/Condition?patient=1,2"):
+        cache.store(url, response({"resourceType": "Bundle"}), base)
+    assert cache.stats()["evictions"] == 1 and cache.get_entry(f"{base}/Patient/1") is None
+    cache.store(f"{base}/Observation?patient=2", response({"resourceType": "Bundle"}), base)
+
+    assert tags_for_url(f"{base}/Condition?patient=1,2", base) == ("Condition", None)
+    assert cache.invalidate(patient_id="2", resource_type="Condition") == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_client_revalidates_with_304_and_drops_entries_on_write(stub_server):
+    from FHIRClient import FHIRClient
+    cache = ResourceCache(ttl=0)
+    client = FHIRClient(stub_server(), cache=cache)
+    patient = client.get_patient("bulk-0")
+    assert client.get_patient("bulk-0") == patient
+    assert cache.stats()["revalidated"] == 1
+
+    patient["gender"] = "other"
+    assert "error" not in client.update_patient("bulk-0", patient)
+    assert cache.stats()["entries"] == 0
+    updated = client.get_patient("bulk-0")
+    assert updated["gender"] == "other" and updated["meta"]["versionId"] == "2"
+    assert cache.stats()["revalidated"] == 1
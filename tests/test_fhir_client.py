@@ -0,0 +1,136 @@
+import pytest
+from FHIRClient import FHIRClient, _location_id
+
+
+@pytest.mark.parametrize("location", [
+    "Patient/123/_history/1",
+    "Patient/123",
+    "http://example.org/fhir/Patient/123/_history/1",
+    "https://example.org:8443/base/r4/Patient/123",
+])
+def test_location_id_handles_relative_and_absolute_locations(location):
+    assert _location_id(location, "Patient") == "123"
+
+
+def test_location_id_without_the_resource_type():
+    assert _location_id("http://example.org/fhir/Condition/9", "Patient") is None
+    assert _location_id("", "Patient") is None
+
+
+@pytest.mark.parametrize("absolute", [True, False])
+def test_create_patient_record_reads_ids_from_the_transaction_response(stub_server, absolute):
+    client = FHIRClient(stub_server(absolute_locations=absolute))
+    result = client.create_patient_record(
+        {"name": [{"family": "Doe", "given": ["Jane"]}], "gender": "female"},
+        conditions=["Diabetes"],
+        observations=["Glucose 140 mg/dL"],
+    )
+
+    assert [c["resourceType"] for c in result["created"]] == ["Patient", "Condition", "Observation"]
+    assert all(c["id"] and c["status"] == "201 Created" for c in result["created"])
+    assert result["patient_id"] == result["created"][0]["id"]
+    # The id is the one the server assigned, so the patient can be read back
+    assert client.get_patient(result["patient_id"])["name"][0]["family"] == "Doe"
+
+
+def test_search_params_keep_falsy_filters():
+    params = FHIRClient._search_params("Observation", "p1", {"count": 0, "sort": "-date"})
+    assert ("_count", 0) in params
+
+
+@pytest.mark.parametrize("with_store", [False, True])
+def test_count_zero_returns_only_the_total(stub_server, with_store):
+    from fhir_store import ResourceStore
+    client = FHIRClient(stub_server(), store=ResourceStore() if with_store else None)
+    everything = client.get_patient_observations("bulk-0")
+    assert len(everything["entry"]) == 3
+
+    bundle = client.get_patient_observations("bulk-0", count=0)
+    assert "error" not in bundle
+    assert bundle["entry"] == []
+    assert len(client.get_patient_observations("bulk-0", count=2)["entry"]) == 2
+
+
+def test_get_patient_summaries_fails_only_the_batches_that_failed(stub_server):
+    from bulk_stub_server import synthetic_fixtures
+    client = FHIRClient(stub_server(synthetic_fixtures(6, observations_per_patient=2), failing_patients=("bulk-4",)))
+    ids = [f"bulk-{i}" for i in range(6)] + ["missing", "bulk-0"]
+    result = client.get_patient_summaries(ids, batch_size=2)
+
+    assert result["requested"] == 7
+    # bulk-5 shares a batch with bulk-4; "missing" only lacks its Patient
+    assert result["failed"] == ["bulk-4", "bulk-5", "missing"]
+    assert result["succeeded"] == 4
+    assert {e["resource_type"] for e in result["errors"]} == {"Patient", "Condition", "MedicationRequest", "Observation"}
+    assert all(e["patient_ids"] == ["bulk-4", "bulk-5"] for e in result["errors"])
+
+    summary = result["summaries"]["bulk-3"]
+    assert summary["patient"]["id"] == "bulk-3"
+    assert [len(summary[s]["entry"]) for s in ("conditions", "medications", "observations")] == [1, 1, 2]
+    assert "error" in result["summaries"]["bulk-5"]["observations"]
+    assert result["summaries"]["missing"]["observations"]["entry"] == []
+
+
+def summary_sizes(summary):
+    return [len(summary[s]["entry"]) for s in ("conditions", "medications", "observations")]
+
+
+def test_revinclude_ignored_settles_to_per_section_reads(stub_server):
+    client = FHIRClient(stub_server(revinclude="ignore"))
+    empty_id = client.create_patient("Empty", "Record")["id"]
+
+    # Only the Patient came back, but the patient has no records: still undecided
+    assert summary_sizes(client.get_patient_summary(empty_id)) == [0, 0, 0]
+    assert client.capabilities()["revinclude"] is None
+
+    # The per-section reads found records the _revinclude search left out
+    summary = client.get_patient_summary("bulk-0")
+    assert summary["patient"]["id"] == "bulk-0"
+    assert summary_sizes(summary) == [1, 1, 3]
+    assert client.capabilities()["revinclude"] is False
+    assert client.get_patient_summary_bundle("bulk-1") is None
+
+
+@pytest.mark.parametrize("mode, supported", [("honor", True), ("reject", False)])
+def test_revinclude_support_is_learned_from_the_first_search(stub_server, mode, supported):
+    client = FHIRClient(stub_server(revinclude=mode))
+    summary = client.get_patient_summary("bulk-2")
+    assert summary["patient"]["id"] == "bulk-2"
+    assert summary_sizes(summary) == [1, 1, 3]
+    assert client.capabilities()["revinclude"] is supported
+    assert (client.get_patient_summary_bundle("bulk-3") is not None) is supported
+
+
+@pytest.mark.parametrize("mode, supported", [("ignore", False), ("honor", True)])
+def test_concurrent_summaries_settle_revinclude_once(stub_server, mode, supported):
+    from concurrent.futures import ThreadPoolExecutor
+    from bulk_stub_server import synthetic_fixtures
+    client = FHIRClient(stub_server(synthetic_fixtures(16, observations_per_patient=2), revinclude=mode))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        summaries = list(executor.map(client.get_patient_summary, [f"bulk-{i}" for i in range(16)] * 2))
+    assert all(summary_sizes(summary) == [1, 1, 2] for summary in summaries)
+    assert client.capabilities()["revinclude"] is supported
+    assert not client._revinclude_unproven
+
+
+def test_requests_to_one_host_reuse_a_pooled_connection(stub_server):
+    client = FHIRClient(stub_server())
+    for i in range(10):
+        assert client.get_patient(f"bulk-{i % 4}")["resourceType"] == "Patient"
+    [pool] = client.pool_stats()
+    assert pool["requests"] == 10
+    assert pool["connections"] == 1
+    assert pool["reuse_rate"] == 0.9
+
+
+@pytest.mark.parametrize("max_retries, ok", [(0, False), (2, True)])
+def test_reads_retry_unavailable_servers(stub_server, max_retries, ok):
+    client = FHIRClient(stub_server(unavailable_first=2), max_retries=max_retries)
+    patient = client.get_patient("bulk-0")
+    assert ("error" not in patient) is ok
+
+
+def test_writes_are_not_retried(stub_server):
+    client = FHIRClient(stub_server(unavailable_first=1), max_retries=2)
+    assert "error" in client.create_patient("Jane", "Doe")
+    assert "error" not in client.create_patient("Jane", "Doe")
@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+import time
+import pytest
+from fhir_store import ResourceStore
+
+LOINC = "http://loinc.org"
+
+
+def observation(resource_id, code, effective, status="final", patient_id="p1", system=LOINC):
+    return {
+        "resourceType": "Observation",
+        "id": resource_id,
+        "status": status,
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "code": {"coding": [{"system": system, "code": code}]},
+        "effectiveDateTime": effective,
+    }
+
+
+@pytest.fixture
+def store():
+    store = ResourceStore()
+    store.upsert([
+        observation("o1", "2339-0", "2024-01-10T08:00:00Z"),
+        observation("o2", "2339-0", "2024-01-31T23:00:00Z"),
+        observation("o3", "2339-0", "2024-02-01T08:00:00Z", status="amended"),
+        observation("o4", "8867-4", "2024-01-20T08:00:00Z", status="preliminary"),
+        observation("o5", "2339-0", "2024-01-15T08:00:00Z", system="http://example.org/local"),
+        observation("o6", "2339-0", "2024-01-12T08:00:00Z", patient_id="p2"),
+    ])
+    return store
+
+
+def ids(resources):
+    return [resource["id"] for resource in resources]
+
+
+def test_search_filters_by_code_and_system(store):
+    assert ids(store.search("Observation", "p1", code="2339-0")) == ["o3", "o2", "o5", "o1"]
+    assert ids(store.search("Observation", "p1", code=f"{LOINC}|2339-0")) == ["o3", "o2", "o1"]
+    assert ids(store.search("Observation", "p1", code=["8867-4", f"{LOINC}|2339-0"])) == ["o3", "o2", "o4", "o1"]
+
+
+def test_search_filters_by_status_and_inclusive_dates(store):
+    assert ids(store.search("Observation", "p1", status=["final", "amended"], code=f"{LOINC}|2339-0")) \
+        == ["o3", "o2", "o1"]
+    # A bare date_to includes the whole day
+    assert ids(store.search("Observation", "p1", date_from="2024-01-15", date_to="2024-01-31")) == ["o2", "o4", "o5"]
+    assert ids(store.search("Observation", "p1", limit=2)) == ["o3", "o2"]
+
+
+def test_replace_patient_resources_drops_gone_resources_and_marks_the_set_fresh(store):
+    assert not store.is_fresh("Observation", "p1")
+    store.replace_patient_resources("Observation", "p1", [observation("o7", "2339-0", "2024-03-01T08:00:00Z")])
+
+    assert ids(store.search("Observation", "p1")) == ["o7"]
+    assert ids(store.search("Observation", "p1", code="2339-0")) == ["o7"]
+    assert ids(store.search("Observation", "p2")) == ["o6"]
+    assert store.is_fresh("Observation", "p1")
+    assert not store.is_fresh("Observation", "p1", max_age=0)
+    store.invalidate_patient("p1")
+    assert not store.is_fresh("Observation", "p1")
+
+
+def test_writes_wait_for_another_connections_write(tmp_path):
+    path = str(tmp_path / "store.db")
+    store = ResourceStore(path, busy_timeout=5)
+    other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    release = threading.Timer(0.3, other.execute, ("COMMIT",))
+    release.start()
+
+    started = time.monotonic()
+    assert store.upsert([observation("o1", "2339-0", "2024-01-10T08:00:00Z")]) == 1
+    assert time.monotonic() - started >= 0.25
+    assert ids(store.search("Observation", "p1")) == ["o1"]
+    release.join()
+    other.close()
@@ -0,0 +1,69 @@
+import json
+import time
+from FHIRClient import FHIRClient
+from fhir_store import ResourceStore
+from fhir_sync import SyncWorker
+
+
+def observation_values(client, patient_id):
+    return {e["resource"]["id"]: e["resource"]["valueQuantity"]["value"]
+            for e in client.get_patient_observations(patient_id)["entry"]}
+
+
+def test_sync_applies_remote_changes_to_the_local_store(stub_server, tmp_path):
+    base_url = stub_server()
+    client = FHIRClient(base_url, store=ResourceStore())
+    before = client.get_patient_observations("bulk-0")["entry"]
+    stale = observation_values(client, "bulk-0")
+    assert len(stale) == 3
+
+    # Resume from the newest change already seen instead of the server's clock
+    mark = max(entry["resource"]["meta"]["lastUpdated"] for entry in client.search_all("Observation", {})["entry"])
+    state_path = tmp_path / "sync_state.json"
+    state_path.write_text(json.dumps({base_url: {"Observation": mark}}))
+
+    # Changes made by someone else, behind the client's back
+    other = FHIRClient(base_url)
+    edited = dict(before[0]["resource"], valueQuantity={"value": 250, "unit": "mg/dL"})
+    assert "error" not in other.update_observation(edited["id"], edited)
+    created = other.create_observation({
+        "resourceType": "Observation", "status": "final", "subject": {"reference": "Patient/bulk-0"},
+        "code": {"coding": [{"system": "http://loinc.org", "code": "2339-0"}]},
+        "effectiveDateTime": "2024-03-01T08:00:00Z", "valueQuantity": {"value": 77, "unit": "mg/dL"},
+    })
+    # The fresh store still answers with what it had
+    assert observation_values(client, "bulk-0") == stale
+
+    worker = SyncWorker(client, resource_types=("Observation",), state_path=str(state_path))
+    assert worker.sync_once() >= 2
+    assert observation_values(client, "bulk-0") == dict(stale, **{edited["id"]: 250, created["id"]: 77})
+
+    # The high-water mark moved and was saved; nothing new to apply
+    assert json.loads(state_path.read_text())[base_url]["Observation"] > mark
+    assert worker.sync_once() == 0
+    assert worker.stats()["types"]["Observation"]["mode"] == "search"
+
+
+def test_patient_version_counts_synced_changes_while_sync_is_current(stub_server, tmp_path):
+    base_url = stub_server()
+    client = FHIRClient(base_url)
+    mark = max(entry["resource"]["meta"]["lastUpdated"] for entry in client.search_all("Observation", {})["entry"])
+    state_path = tmp_path / "sync_state.json"
+    state_path.write_text(json.dumps({base_url: {"Observation": mark}}))
+    worker = SyncWorker(client, resource_types=("Observation",), interval=60, state_path=str(state_path))
+    assert worker.patient_version("bulk-0") is None
+    worker.start()
+    deadline = time.time() + 5
+    while worker.patient_version("bulk-0") is None and time.time() < deadline:
+        time.sleep(0.01)
+    version, other = worker.patient_version("bulk-0"), worker.patient_version("bulk-1")
+    assert version is not None
+
+    observation = FHIRClient(base_url).get_patient_observations("bulk-0")["entry"][0]["resource"]
+    assert "error" not in FHIRClient(base_url).update_observation(observation["id"], observation)
+    assert worker.sync_once() == 1
+
+    assert worker.patient_version("bulk-0") != version
+    assert worker.patient_version("bulk-1") == other
+    worker.stop()
+    assert worker.patient_version("bulk-0") is None
@@ -0,0 +1,86 @@
+import threading
+import time
+from MCPSessionManager import MCPSessionManager
+
+
+class FakeMCPClient:
+    """Stands in for a strands MCPClient; list_tools_sync fails once the process has died"""
+
+    def __init__(self):
+        self.dead = False
+        self.stopped = False
+
+    def start(self):
+        pass
+
+    def stop(self, exc_type, exc_value, traceback):
+        self.stopped = True
+
+    def list_tools_sync(self):
+        if self.dead:
+            raise ConnectionError("MCP server process exited")
+        return ["tool"]
+
+
+def make_session(**kwargs):
+    clients = []
+
+    def factory():
+        clients.append(FakeMCPClient())
+        return clients[-1]
+
+    return MCPSessionManager(client_factory=factory, health_interval=0, **kwargs), clients
+
+
+def test_restart_waits_for_running_turns():
+    session, clients = make_session(drain_timeout=5)
+    finish_turn = threading.Event()
+    turn_started = threading.Event()
+    seen = {}
+
+    def turn():
+        with session.turn() as generation:
+            turn_started.set()
+            finish_turn.wait(5)
+            seen["stopped during turn"] = clients[0].stopped
+            seen["generation"] = generation
+
+    worker = threading.Thread(target=turn)
+    worker.start()
+    turn_started.wait(5)
+    clients[0].dead = True
+    restarter = threading.Thread(target=session.ensure_healthy)
+    restarter.start()
+    time.sleep(0.1)
+    assert session.restarts == 0
+
+    finish_turn.set()
+    worker.join(5)
+    restarter.join(5)
+    assert seen == {"stopped during turn": False, "generation": 1}
+    assert session.restarts == 1 and session.generation == 2
+    with session.turn() as generation:
+        assert generation == 2
+
+
+def test_turns_that_failed_on_the_same_server_restart_it_once():
+    session, clients = make_session()
+    with session.turn() as generation:
+        pass
+    clients[0].dead = True
+
+    assert not session.ensure_healthy(generation)
+    assert session.restarts == 1
+    # A second failed turn from the old server finds it already replaced
+    clients[1].dead = True
+    assert not session.ensure_healthy(generation)
+    assert session.restarts == 1
+    assert session.ensure_healthy() is False and session.restarts == 2
+
+
+def test_a_healthy_server_is_left_alone():
+    session, clients = make_session()
+    with session.turn() as generation:
+        pass
+    assert session.ensure_healthy(generation)
+    assert session.restarts == 0 and len(clients) == 1
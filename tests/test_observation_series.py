@@ -0,0 +1,68 @@
+import observation_series
+
+
+def observation(code, value, unit, time, low=None, high=None):
+    resource = {
+        "resourceType": "Observation",
+        "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": "Glucose"}]},
+        "effectiveDateTime": time,
+        "valueQuantity": {"value": value, "unit": unit},
+    }
+    if low is not None:
+        resource["referenceRange"] = [{"low": {"value": low}, "high": {"value": high}}]
+    return resource
+
+
+def test_convertible_units_share_one_series():
+    series = observation_series.extract([
+        observation("2339-0", 90, "mg/dL", "2024-01-01T08:00:00Z", 70, 100),
+        observation("2339-0", 7.0, "mmol/l", "2024-02-01T08:00:00Z", 3.9, 5.6),
+    ])
+    assert list(series) == ["2339-0"]
+    glucose = series["2339-0"]
+    assert glucose["code"] == "2339-0"
+    assert glucose["unit"] == "mg/dL"
+    assert glucose["count"] == 2
+    assert glucose["value"] == [90.0, round(7.0 * 18.016, 4)]
+    assert glucose["flag"] == ["normal", "high"]
+
+
+def test_unconvertible_units_stay_in_separate_series():
+    observations = [
+        observation("2339-0", 90, "mg/dL", "2024-01-01T08:00:00Z"),
+        observation("2339-0", 95, "mg/dL", "2024-01-02T08:00:00Z"),
+        observation("2339-0", 5.0, "mEq/L", "2024-01-03T08:00:00Z"),
+    ]
+    series = observation_series.extract(observations)
+    assert set(series) == {"2339-0 [mg/dL]", "2339-0 [mEq/L]"}
+    assert series["2339-0 [mg/dL]"]["value"] == [90.0, 95.0]
+    assert series["2339-0 [mg/dL]"]["count"] == 2
+    assert series["2339-0 [mEq/L]"]["value"] == [5.0]
+    assert series["2339-0 [mEq/L]"]["code"] == "2339-0"
+
+    resampled = observation_series.extract(observations, rule="W", max_points=2)
+    assert set(resampled) == set(series)
+    assert resampled["2339-0 [mg/dL]"]["value"] == [92.5]
+    assert resampled["2339-0 [mg/dL]"]["count"] == 2
+
+
+def test_downsample_counts_each_unit_separately():
+    observations = [observation("2339-0", 80 + i, "mg/dL", f"2024-01-{i + 1:02d}T08:00:00Z") for i in range(20)]
+    observations.append(observation("2339-0", 5.0, "mEq/L", "2024-01-05T08:00:00Z"))
+    series = observation_series.extract(observations, max_points=4)
+    assert len(series["2339-0 [mg/dL]"]["time"]) <= 4
+    assert series["2339-0 [mg/dL]"]["count"] == 20
+    assert series["2339-0 [mEq/L]"]["value"] == [5.0]
+
+
+def test_partial_date_to_includes_the_whole_year_or_month():
+    observations = [
+        observation("2339-0", 90, "mg/dL", "2024-03-31T23:00:00Z"),
+        observation("2339-0", 91, "mg/dL", "2024-12-31T12:00:00Z"),
+        observation("2339-0", 92, "mg/dL", "2025-01-01T00:00:00Z"),
+    ]
+    assert observation_series.extract(observations, date_to="2024-03")["2339-0"]["value"] == [90.0]
+    assert observation_series.extract(observations, date_to="2024")["2339-0"]["value"] == [90.0, 91.0]
+    assert observation_series.extract(observations, date_to="2024-12-31")["2339-0"]["value"] == [90.0, 91.0]
+    assert observation_series.extract(observations, date_to="2024-12-31T12:00:00Z")["2339-0"]["value"] == [90.0, 91.0]
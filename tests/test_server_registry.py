@@ -0,0 +1,60 @@
+import pytest
+from FHIRClient import FHIRClient
+from server_registry import CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, ServerRegistry, load_servers
+
+
+def registry(servers, **kwargs):
+    return ServerRegistry(servers, client_factory=lambda name, url: FHIRClient(url, max_retries=0),
+                          probe_interval=0, **kwargs)
+
+
+def test_server_names_are_case_insensitive(monkeypatch):
+    monkeypatch.setenv("FHIR_SERVER_URLS", '{"Epic": "http://127.0.0.1:9/fhir"}')
+    monkeypatch.delenv("FHIR_BASE_URL", raising=False)
+    servers = load_servers()
+    assert "epic" in servers and "Epic" not in servers
+    assert registry(servers, default="smart").endpoint("EPIC").base_url == "http://127.0.0.1:9/fhir"
+    with pytest.raises(KeyError):
+        registry(servers).endpoint("cerner")
+
+
+def test_circuit_opens_after_failed_probes_and_closes_on_success():
+    reg = registry({"down": "http://127.0.0.1:9/fhir"}, failure_threshold=2, reset_timeout=0.05, probe_timeout=0.2)
+    endpoint = reg.endpoint("down")
+    assert not endpoint.probe(0.2)
+    assert endpoint.state == CIRCUIT_CLOSED and endpoint.available()
+    assert not endpoint.probe(0.2)
+    assert endpoint.state == CIRCUIT_OPEN and not endpoint.available()
+
+    # After reset_timeout one try is let through; the next probe decides
+    endpoint.opened_at -= 0.05
+    assert endpoint.available() and endpoint.state == CIRCUIT_HALF_OPEN
+    endpoint.record_failure("still down")
+    assert endpoint.state == CIRCUIT_OPEN
+    endpoint.record_success(0.01)
+    assert endpoint.state == CIRCUIT_CLOSED and endpoint.failures == 0
+
+
+def test_mirrored_reads_go_to_a_healthy_fast_server_and_writes_stay():
+    reg = registry({"a": "http://127.0.0.1:9/a", "b": "http://127.0.0.1:9/b"}, mirror=True, latency_slack=1.5)
+    a, b = reg.endpoint("a"), reg.endpoint("b")
+    a.record_success(0.10)
+    b.record_success(0.09)
+    assert reg.route("a") is a  # within the slack of the fastest
+
+    a.record_success(1.0)
+    assert reg.route("a") is b
+    assert reg.route("a", read=False) is a
+
+    for _ in range(3):
+        b.record_failure("down")
+    assert reg.route("a") is a
+    assert b.info()["state"] == CIRCUIT_OPEN
+
+
+def test_without_mirror_the_requested_server_always_serves():
+    reg = registry({"a": "http://127.0.0.1:9/a", "b": "http://127.0.0.1:9/b"})
+    for _ in range(3):
+        reg.endpoint("a").record_failure("down")
+    assert reg.route("a") is reg.endpoint("a")
+    assert reg.route() is reg.endpoint("a")  # the first server is the default without "smart"
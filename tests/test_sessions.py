@@ -0,0 +1,91 @@
+import threading
+import time
+from sessions import SessionStore
+
+
+def test_least_recently_used_sessions_are_evicted_over_max_sessions():
+    store = SessionStore(lambda patient_id, server: {"id": patient_id}, max_sessions=2)
+    first = store.create("p1", "smart")
+    second = store.create("p2", "smart")
+    assert store.get(first.token) is first
+    store.create("p3", "smart")
+
+    assert store.get(second.token) is None
+    assert store.get(first.token) is first
+    assert store.stats()["evictions"] == 1
+    store.shutdown()
+
+
+def test_snapshot_bytes_cap_evicts_other_sessions():
+    store = SessionStore(lambda patient_id, server: {"data": "x" * 1000}, max_snapshot_bytes=1500)
+    first = store.create("p1", "smart")
+    assert first.get_snapshot(timeout=5) is not None
+    second = store.create("p2", "smart")
+    assert second.get_snapshot(timeout=5) is not None
+
+    assert store.get(first.token) is None
+    assert store.get(second.token) is second
+    store.shutdown()
+
+
+def test_idle_sessions_expire():
+    store = SessionStore(lambda patient_id, server: {}, idle_ttl=0.05)
+    session = store.create("p1", "smart")
+    time.sleep(0.1)
+    assert store.get(session.token) is None
+    store.shutdown()
+
+
+def test_a_superseded_prefetch_never_replaces_a_newer_snapshot():
+    calls = []
+    release_first = threading.Event()
+
+    def fetch(patient_id, server):
+        calls.append(server)
+        number = len(calls)
+        if number == 1:
+            # Data read before the write, arriving after the refetch the write started
+            release_first.wait(5)
+        return {"fetch": number}
+
+    store = SessionStore(fetch)
+    session = store.create("p1", "smart")
+    while not calls:
+        time.sleep(0.01)
+    store.refresh("smart", "p1")
+    assert session.get_snapshot(timeout=5) == {"fetch": 2}
+
+    release_first.set()
+    store.shutdown(wait=True)
+    assert session.snapshot == {"fetch": 2}
+
+
+def test_refresh_refetches_the_sessions_of_the_written_patient():
+    versions = {"p1": 1, "p2": 1}
+    store = SessionStore(lambda patient_id, server: {"version": versions[patient_id]})
+    p1 = store.create("p1", "smart")
+    other_server = store.create("p1", "hapi")
+    p2 = store.create("p2", "smart")
+    for session in (p1, other_server, p2):
+        session.get_snapshot(timeout=5)
+
+    versions["p1"] = 2
+    assert store.refresh("smart", "p1") == 1
+
+    assert p1.get_snapshot(timeout=5) == {"version": 2}
+    assert other_server.get_snapshot(timeout=5) == {"version": 1}
+    assert p2.get_snapshot(timeout=5) == {"version": 1}
+    store.shutdown()
+
+
+def test_snapshots_older_than_max_age_are_refetched_on_use():
+    fetches = []
+    store = SessionStore(lambda patient_id, server: fetches.append(patient_id) or {"fetch": len(fetches)},
+                         max_snapshot_age=0.05)
+    session = store.create("p1", "smart")
+    assert session.get_snapshot(timeout=5) == {"fetch": 1}
+    assert store.get(session.token).get_snapshot(timeout=5) == {"fetch": 1}
+
+    time.sleep(0.1)
+    assert store.get(session.token).get_snapshot(timeout=5) == {"fetch": 2}
+    store.shutdown()
@@ -0,0 +1,35 @@
+import asyncio
+import pytest
+from tools import DelegatingTool, bind_server, run_tool
+
+SERVER_PROPERTIES = {"patient_id": {"type": "string"}, "server": {"type": "string", "default": ""}}
+
+
+@pytest.mark.parametrize("sdk_events", [False, True])
+def test_run_tool_returns_the_final_result(fake_tool, sdk_events):
+    tool = fake_tool("get_patient", lambda args: "ok", sdk_events=sdk_events)
+    result = asyncio.run(run_tool(tool, {"toolUseId": "t1", "name": "get_patient", "input": {}}, {}))
+    assert result == {"toolUseId": "t1", "status": "success", "content": [{"text": "ok"}]}
+
+
+def test_delegating_tool_passes_the_wrapped_tool_through(fake_tool):
+    tool = fake_tool("get_patient", lambda args: "ok", SERVER_PROPERTIES)
+    wrapper = DelegatingTool(tool)
+    assert (wrapper.tool_name, wrapper.tool_spec, wrapper.tool_type) == (tool.tool_name, tool.tool_spec, "fake")
+
+    async def events():
+        return [event async for event in wrapper.stream({"toolUseId": "t1", "input": {}}, {})]
+
+    # The agent takes the last event of a stream as the tool result
+    assert asyncio.run(events())[-1]["content"] == [{"text": "ok"}]
+
+
+def test_server_bound_tool_hides_and_fills_the_server_argument(fake_tool):
+    tool = fake_tool("get_patient", lambda args: args["server"], SERVER_PROPERTIES, sdk_events=True)
+    bound = bind_server([tool], "hapi")[0]
+    assert "server" not in bound.tool_spec["inputSchema"]["json"]["properties"]
+    assert "server" in tool.tool_spec["inputSchema"]["json"]["properties"]
+
+    result = asyncio.run(run_tool(bound, {"toolUseId": "t1", "input": {"patient_id": "p1", "server": "smart"}}, {}))
+    assert result["content"] == [{"text": "hapi"}]
+    assert tool.calls == [{"patient_id": "p1", "server": "hapi"}]
@@ -0,0 +1,55 @@
+import asyncio
+import json
+import pytest
+from answer_cache import AnswerCache
+from tools import run_tool
+from turn_memo import TurnMemo, _filtered
+
+
+def test_falsy_filter_values_still_filter():
+    assert _filtered({"patient_id": "p1", "count": 0})
+    assert _filtered({"patient_id": "p1", "summary_count": True})
+    assert not _filtered({"patient_id": "p1", "count": None, "status": "", "summary_count": False})
+
+
+def test_repeated_reads_share_one_call_and_writes_invalidate(fake_tool):
+    cache = AnswerCache(max_entries=8)
+    cache.store("smart", "p1", "latest glucose?", "v1", "92 mg/dL", seconds=3.0)
+    cache.store("smart", "p2", "latest glucose?", "v1", "88 mg/dL", seconds=3.0)
+    read = fake_tool("get_patient_observations", lambda args: json.dumps({"records": [args["patient_id"]]}),
+                     {"patient_id": {"type": "string"}, "count": {"type": "integer", "default": None}})
+    write = fake_tool("create_observation", lambda args: "{}", {"patient_id": {"type": "string"}}, sdk_events=True)
+    memo = TurnMemo(on_write=lambda tool_name, patient_id: cache.invalidate("smart", patient_id))
+    tools = {tool.tool_name: tool for tool in memo.wrap([read, write])}
+
+    def call(name, **args):
+        return asyncio.run(run_tool(tools[name], {"toolUseId": "t", "name": name, "input": args}, {}))
+
+    assert call("get_patient_observations", patient_id="p1") == call("get_patient_observations", patient_id="p1")
+    assert len(read.calls) == 1 and memo.hits == 1
+
+    assert call("create_observation", patient_id="p1")["status"] == "success"
+    call("get_patient_observations", patient_id="p1")
+    assert len(read.calls) == 2
+    assert cache.lookup("smart", "p1", "latest glucose?", "v1") is None
+    assert cache.lookup("smart", "p2", "latest glucose?", "v1") == "88 mg/dL"
+
+
+def test_failures_count_broken_tool_calls_but_not_fhir_errors(fake_tool):
+    def broken(args):
+        raise ConnectionError("MCP server process exited")
+
+    fhir_error = fake_tool("get_patient_conditions", lambda args: json.dumps({"error": "404 Not Found"}),
+                           {"patient_id": {"type": "string"}})
+    failing = fake_tool("get_patient_observations", broken, {"patient_id": {"type": "string"}})
+    memo = TurnMemo()
+    tools = {tool.tool_name: tool for tool in memo.wrap([fhir_error, failing])}
+
+    def call(name, **args):
+        return asyncio.run(run_tool(tools[name], {"toolUseId": "t", "name": name, "input": args}, {}))
+
+    call("get_patient_conditions", patient_id="p1")
+    assert memo.failures == 0
+    with pytest.raises(ConnectionError):
+        call("get_patient_observations", patient_id="p1")
+    assert memo.failures == 1
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+import pytest
+from worker_pool import AgentWorkerPool, PoolSaturated, QueueTimeout
+
+
+def test_rejects_when_workers_and_queue_are_full():
+    pool = AgentWorkerPool(max_workers=1, max_queue=1, queue_timeout=0)
+    release = threading.Event()
+
+    async def scenario():
+        running = asyncio.ensure_future(pool.run(release.wait, 5))
+        queued = asyncio.ensure_future(pool.run(lambda: "queued"))
+        await asyncio.sleep(0.05)
+        assert pool.is_saturated()
+        with pytest.raises(PoolSaturated):
+            await pool.run(lambda: "rejected")
+        release.set()
+        return await running, await queued
+
+    try:
+        assert asyncio.run(scenario()) == (True, "queued")
+        assert pool.stats()["rejected"] == 1
+        assert not pool.is_saturated()
+    finally:
+        pool.shutdown()
+
+
+def test_queue_timeout_fires_before_the_backlog_clears():
+    pool = AgentWorkerPool(max_workers=1, max_queue=4, queue_timeout=0.2)
+    release = threading.Event()
+    ran = []
+
+    async def scenario():
+        running = asyncio.ensure_future(pool.run(release.wait, 5))
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        with pytest.raises(QueueTimeout):
+            await pool.run(ran.append, "late")
+        waited = time.monotonic() - started
+        release.set()
+        await running
+        return waited
+
+    try:
+        waited = asyncio.run(scenario())
+        assert waited < 1
+        # The timed-out call was withdrawn from the queue, not run later
+        time.sleep(0.05)
+        assert ran == []
+        stats = pool.stats()
+        assert stats["timed_out"] == 1
+        assert stats["queued"] == 0
+        assert not pool.is_saturated()
+    finally:
+        pool.shutdown()
+
+
+def test_cancelled_caller_keeps_its_job_counted_until_it_finishes():
+    pool = AgentWorkerPool(max_workers=1, max_queue=0, queue_timeout=0)
+    release = threading.Event()
+
+    async def scenario():
+        caller = asyncio.ensure_future(pool.run(release.wait, 5))
+        await asyncio.sleep(0.05)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        # The job is still running on its worker, so the pool is still full
+        assert pool.is_saturated()
+        with pytest.raises(PoolSaturated):
+            await pool.run(lambda: None)
+        release.set()
+        await asyncio.sleep(0.05)
+        assert not pool.is_saturated()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        pool.shutdown()